@@ -1,4 +1,5 @@
 import numpy as np
+import os
 import warnings     # suppress certain errors when dealing with NaN arrays
 
 # NOTE p_half = half-level = layer interfaces
@@ -37,45 +38,79 @@ def fms_press_calc(psfc, ak, bk, lev_type='full'):
         psfc = np.array([np.squeeze(psfc)])
 
     # Flatten psfc array to generalize it to N dimensions
-    psfc_flat = psfc.flatten()
+    psfc_flat = psfc.reshape(-1)
+    ak = np.asarray(ak)
+    bk = np.asarray(bk)
 
-    # Expand the dimensions. Vectorized calculations:
-    psfc_v  = np.repeat(psfc_flat[:, np.newaxis], Nk, axis=1)   # (Np) -> (Np, Nk)
-    ak_v    = np.repeat(ak[np.newaxis, :], len(
-                        psfc_flat), axis=0)                     # (Nk) -> (Np, Nk)
-    bk_v    = np.repeat(bk[np.newaxis, :], 1, axis=0)           # (Nk) -> (1,  Nk)
+    # Pressure at layer interfaces, broadcast (Nk, 1) x (1, Np) -> (Nk, Np). The size of Z axis is 'Nk'
+    PRESS_h = bk[:, np.newaxis]*psfc_flat[np.newaxis, :]+ak[:, np.newaxis]
 
-    # Pressure at layer interfaces. The size of Z axis is 'Nk'
-    PRESS_h = psfc_v*bk_v+ak_v
+    if lev_type == "half":
+        # Reshape PRESS(Nk, :) to the original pressure shape PRESS(Nk, :, :, :)
+        new_dim_h = np.append(Nk, psfc.shape)
+        return np.squeeze(PRESS_h.reshape(new_dim_h))
+    elif lev_type != "full":
+        raise Exception(
+            """Pressure level type not recognized by press_lev(): use 'full' or 'half' """)
 
     # Pressure at layer midpoints. The size of Z axis is 'Nk-1'
-    PRESS_f = np.zeros((len(psfc_flat), Nk-1))
+    PRESS_f = np.empty((Nk-1, len(psfc_flat)))
     # Top layer (1st element is i = 0 in Python)
     if ak[0] == 0 and bk[0] == 0:
-        PRESS_f[:, 0] = 0.5*(PRESS_h[:, 0]+PRESS_h[:, 1])
+        PRESS_f[0, :] = 0.5*(PRESS_h[0, :]+PRESS_h[1, :])
     else:
-        PRESS_f[:, 0] = (PRESS_h[:, 1]-PRESS_h[:, 0]) / \
-            np.log(PRESS_h[:, 1]/PRESS_h[:, 0])
+        PRESS_f[0, :] = (PRESS_h[1, :]-PRESS_h[0, :]) / \
+            np.log(PRESS_h[1, :]/PRESS_h[0, :])
 
     # The rest of the column (i = 1 ... Nk).
     # [2:] goes from the 3rd element to 'Nk' and
     # [1:-1] goes from the 2nd element to 'Nk-1'
-    PRESS_f[:, 1:] = (PRESS_h[:, 2:]-PRESS_h[:, 1:-1]) / \
-        np.log(PRESS_h[:, 2:]/PRESS_h[:, 1:-1])
+    PRESS_f[1:, :] = (PRESS_h[2:, :]-PRESS_h[1:-1, :]) / \
+        np.log(PRESS_h[2:, :]/PRESS_h[1:-1, :])
+
+    # Reshape PRESS(Nk-1, :) to the original pressure shape PRESS(Nk-1, :, :, :)
+    new_dim_f = np.append(Nk-1, psfc.shape)
+    return np.squeeze(PRESS_f.reshape(new_dim_f))
 
-    # First, transpose PRESS(:, Nk) to PRESS(Nk, :),
-    # then reshape PRESS(Nk, :) to the original pressure shape PRESS(Nk, :, :, :) (resp. 'Nk-1')
 
+def fms_press_calc_chunks(psfc, ak, bk, lev_type='full', chunk_size=10):
+    """
+    Generator version of fms_press_calc(): yields the 3D pressure field for successive chunks
+    along the first (time) axis of 'psfc', so that the full 4D field and its intermediate copies
+    never need to be held in memory at once.
+
+    Args:
+        psfc:       the surface pressure in [Pa] with time as the first axis, e.g. ps(time, lat, lon).
+                    This may also be a netCDF variable, in which case only one chunk is read at a time.
+        ak:         1st vertical coordinate parameter
+        bk:         2nd vertical coordinate parameter
+        lev_type:   "full" (layer midpoints) or  "half" (layer interfaces).
+                    Defaults to "full."
+        chunk_size: number of time steps per chunk. Defaults to 10.
+    Yields:
+        it, PRESS:  the time slice and the pressure for that chunk, e.g. PRESS_f(Nk-1, it, lat, lon)
+                    (no dimension is squeezed)
+    ***NOTE***
+        Typical usage, filling a pre-allocated array or writing directly to a file:
+            for it, PRESS in fms_press_calc_chunks(ps, ak, bk, 'full'):
+                p_3D[:, it, ...] = PRESS
+    """
     if lev_type == "full":
-        new_dim_f = np.append(Nk-1, psfc.shape)
-        return np.squeeze(PRESS_f.T.reshape(new_dim_f))
+        Nlev = len(ak)-1
     elif lev_type == "half":
-        new_dim_h = np.append(Nk, psfc.shape)
-        return np.squeeze(PRESS_h.T.reshape(new_dim_h))
+        Nlev = len(ak)
     else:
         raise Exception(
             """Pressure level type not recognized by press_lev(): use 'full' or 'half' """)
 
+    Nt = psfc.shape[0]
+    chunk_size = max(int(chunk_size), 1)
+    for i0 in range(0, Nt, chunk_size):
+        it = slice(i0, min(i0+chunk_size, Nt))
+        psfc_chunk = psfc[it]
+        PRESS = fms_press_calc(psfc_chunk, ak, bk, lev_type)
+        yield it, PRESS.reshape(np.append(Nlev, psfc_chunk.shape))
+
 
 def fms_Z_calc(psfc, ak, bk, T, topo=0., lev_type='full'):
     """
@@ -153,44 +188,18 @@ def fms_Z_calc(psfc, ak, bk, T, topo=0., lev_type='full'):
     Using the isentropic relation above:
         Z_full = Z_half[k+1] + (R Tfull[k])/(gγ)(p_half[k+1]/p_full[k])**(R/Cp)-1)
     """
-    g       = 3.72      # acc. m/s2
-    r_co2   = 191.00    # kg/mol
-    Nk      = len(ak)
-
-    # Get the half and full pressure levels from fms_press_calc
-    PRESS_f = fms_press_calc(psfc, ak, bk, 'full')  # Z axis is first
-    PRESS_h = fms_press_calc(psfc, ak, bk, 'half')  # Z axis is first
-
+    Nk = len(ak)
     # If 'psfc' is a float, turn it into a 1-element array:
     if len(np.atleast_1d(psfc)) == 1:
         psfc = np.array([np.squeeze(psfc)])
-    if len(np.atleast_1d(topo)) == 1:
-        topo = np.array([np.squeeze(topo)])
-
-    psfc_flat = psfc.flatten()
-    topo_flat = topo.flatten()
-
-    # Reshape arrays for vector calculations and compute the log pressure
-    PRESS_h = PRESS_h.reshape((Nk, len(psfc_flat)))
-    PRESS_f = PRESS_f.reshape((Nk-1, len(psfc_flat)))
-    T = T.reshape((Nk-1, len(psfc_flat)))
 
-    logPPRESS_h = np.log(PRESS_h)
+    # Match the columns of T and topo to the flattened 'psfc'
+    T = np.reshape(T, np.append(Nk-1, psfc.shape))
+    if np.size(topo) != 1:
+        topo = np.reshape(topo, psfc.shape)
 
-    # Initialize the output arrays
-    Z_f = np.zeros((Nk-1, len(psfc_flat)))
-    Z_h = np.zeros((Nk, len(psfc_flat)))
-
-    # First half-layer is equal to the surface elevation
-    Z_h[-1, :] = topo_flat
-
-    # Other layers from the bottom-up:
-    # Isothermal within the layer, we have Z = Z0 + r*T0/g*ln(P0/P)
-    for k in range(Nk-2, -1, -1):
-        Z_h[k, :] = Z_h[k+1, :]+(r_co2*T[k, :]/g) * \
-            (logPPRESS_h[k+1, :]-logPPRESS_h[k, :])
-        Z_f[k, :] = Z_h[k+1, :]+(r_co2*T[k, :]/g) * \
-            (1-PRESS_h[k, :]/PRESS_f[k, :])
+    # Single pass for the pressure and altitude at the full and half levels
+    PRESS_f, PRESS_h, Z_f, Z_h = fms_PZ_calc(psfc, ak, bk, T, topo=topo)
 
     # Return the arrays
     if lev_type == "full":
@@ -204,6 +213,112 @@ def fms_Z_calc(psfc, ak, bk, T, topo=0., lev_type='full'):
         raise Exception(
             """Altitude level type not recognized: use 'full' or 'half' """)
 
+
+def fms_PZ_calc(psfc, ak, bk, T, topo=0., out=None, dtype=np.float64):
+    """
+    Returns the pressure [Pa] and altitude [m] at both the full and half levels in a single pass.
+    This is the solver behind fms_Z_calc() (see its documentation for the equations).
+
+    Args:
+        psfc:       The surface pressure [Pa] or array of surface pressures (ND).
+        ak:         1st vertical coordinate parameter.
+        bk:         2nd vertical coordinate parameter.
+        T:          The air temperature with VERTICAL AXIS FIRST, e.g. T[Nk-1, time, lat, lon]. The other
+                    dimensions are broadcast against 'psfc'.
+        topo:       The surface elevation, broadcast against 'psfc'. Defaults to 0 (AGL).
+        out:        (optional) tuple of preallocated arrays (p_full, p_half, Z_full, Z_half) with shapes
+                    [Nk-1, ...] and [Nk, ...] where the results are written.
+        dtype:      The precision used for the calculation. Defaults to np.float64, use np.float32 to
+                    halve the memory. Ignored if 'out' is provided.
+    Returns:
+        p_full, p_half, Z_full, Z_half: the pressure [Pa] and altitude [m] at the layer midpoints [Nk-1, ...]
+                    and layer interfaces [Nk, ...]
+    ***NOTE***
+        ak, bk and psfc are combined by broadcasting, no expanded copies are created and the altitude
+        is integrated bottom-up with a cumulative sum instead of a loop on the levels.
+        Masked arrays (e.g. read from a netCDF file) follow the numpy.ma arithmetic of the former solver: layers
+        with a masked T or psfc have no thickness. If psfc is a masked array, so is ln(p_half), and layers where it
+        is undefined have no thickness too, e.g. for a model top at p=0 the top Z_half is that of the level below.
+        Otherwise, the top Z_half is infinite if the model top is at p=0.
+    """
+    g       = 3.72      # acc. m/s2
+    r_co2   = 191.00    # kg/mol
+    Nk      = len(ak)
+    ak      = np.asarray(ak)
+    bk      = np.asarray(bk)
+    # Masked arrays, e.g. read from a netCDF file, follow the numpy.ma arithmetic, see NOTE
+    use_mask = np.ma.isMaskedArray(T) or np.ma.isMaskedArray(psfc)
+    T_mask  = np.ma.getmaskarray(T)
+    T       = np.ma.getdata(T)
+
+    # Horizontal (and time) shape, common to 'psfc' and 'T'
+    shape   = np.broadcast_shapes(np.shape(psfc), T.shape[1:], np.shape(topo))
+    Np      = int(np.prod(shape))
+    psfc_flat = np.broadcast_to(np.ma.getdata(psfc), shape).reshape(Np)
+    # Align the trailing dimensions of T, e.g. [Nk-1] -> [Nk-1, 1] for a single column
+    T_shape = (Nk-1,)+(1,)*(len(shape)-T.ndim+1)+T.shape[1:]
+    T       = np.broadcast_to(T.reshape(T_shape), (Nk-1,)+shape).reshape((Nk-1, Np))
+    if use_mask:
+        # Layers with a masked temperature or surface pressure (Nk-1, Np)
+        invalid = np.broadcast_to(T_mask.reshape(T_shape), (Nk-1,)+shape).reshape((Nk-1, Np)) | \
+            np.broadcast_to(np.ma.getmaskarray(psfc), shape).reshape(Np)
+
+    if out is None:
+        PRESS_f = np.empty((Nk-1,)+shape, dtype=dtype)
+        PRESS_h = np.empty((Nk,)+shape, dtype=dtype)
+        Z_f     = np.empty((Nk-1,)+shape, dtype=dtype)
+        Z_h     = np.empty((Nk,)+shape, dtype=dtype)
+    else:
+        PRESS_f, PRESS_h, Z_f, Z_h = out
+
+    # Flat (lev, Np) views on the output arrays
+    p_f = PRESS_f.reshape((Nk-1, Np))
+    p_h = PRESS_h.reshape((Nk, Np))
+    z_f = Z_f.reshape((Nk-1, Np))
+    z_h = Z_h.reshape((Nk, Np))
+
+    # Pressure at layer interfaces (Nk, 1) x (1, Np) -> (Nk, Np)
+    np.multiply(bk[:, np.newaxis], psfc_flat[np.newaxis, :], out=p_h)
+    p_h += ak[:, np.newaxis]
+
+    # Log-pressure thickness of the layers, shared by the pressure and altitude calculations
+    dlogp = np.diff(np.log(p_h), axis=0)
+
+    # Pressure at layer midpoints. Top layer (1st element is i = 0 in Python):
+    if ak[0] == 0 and bk[0] == 0:
+        p_f[0, :] = 0.5*(p_h[0, :]+p_h[1, :])
+    else:
+        p_f[0, :] = (p_h[1, :]-p_h[0, :])/dlogp[0, :]
+    # The rest of the column (i = 1 ... Nk)
+    p_f[1:, :] = (p_h[2:, :]-p_h[1:-1, :])/dlogp[1:, :]
+
+    # Scale height rT/g for each layer, reused by Z_half and Z_full
+    H = np.multiply(T, r_co2/g, dtype=p_h.dtype)
+
+    # First half-layer is equal to the surface elevation. Other layers from the bottom-up:
+    # Isothermal within the layer, we have Z = Z0 + r*T0/g*ln(P0/P), i.e. a cumulative sum of the thicknesses
+    z_h[-1, :] = np.broadcast_to(topo, shape).reshape(Np)
+    np.multiply(H, dlogp, out=z_h[:-1, :])
+    if use_mask:
+        # Skip the layers with masked values, and where ln(p) is masked (p<=0, e.g. model top at p=0)
+        skip = invalid
+        if np.ma.isMaskedArray(psfc):
+            skip = skip | (p_h[:-1, :] <= 0) | (p_h[1:, :] <= 0)
+        z_h[:-1, :][skip] = 0.
+    z_h_rev = z_h[::-1, :]
+    np.cumsum(z_h_rev, axis=0, out=z_h_rev)
+
+    # Z_f(k) = Z_h(k+1) + rT/g (1-p_h(k)/p_f(k))
+    np.divide(p_h[:-1, :], p_f, out=z_f)
+    np.subtract(1, z_f, out=z_f)
+    z_f *= H
+    z_f += z_h[1:, :]
+    if use_mask:
+        # Layer midpoints with masked values are at the altitude of the interface below
+        z_f[invalid] = z_h[1:, :][invalid]
+
+    return PRESS_f, PRESS_h, Z_f, Z_h
+
 # TODO: delete: Former version of find_n() : only provides 1D >1D and ND > 1D mapping
 
 
@@ -278,6 +393,12 @@ def find_n(X_IN, X_OUT, reverse_input=False, modulo=None):
 
        Therefore, the cyclic values must therefore be handled during the interpolation but not at this stage.
 
+       *** Note on performance ***
+       The search is vectorized: a single np.searchsorted() for a 1D input, or a binary search carried out
+       simultaneously on all the columns (log2(N_IN) passes) for an ND input, whose columns must be INCREASING
+       (after reverse_input is applied). Non-monotonic 1D inputs (e.g. Ls wrapping around 360) fall back on
+       the closest-element search.
+
        '''
     # number of original layers
     if type(X_IN) != np.ndarray:
@@ -310,27 +431,30 @@ def find_n(X_IN, X_OUT, reverse_input=False, modulo=None):
     if reverse_input:
         X_IN = X_IN[::-1, :]
 
-    n = np.zeros((N_OUT, Ndim), dtype=int)
-
-    # Some repetition below but that allows to keep the 'if' statement out of the big loop over all array elements
-    if len(dimsIN) == 1:
-        for i in range(N_OUT):
-            for j in range(Ndim):
-                n[i, j] = np.argmin(np.abs(X_OUT[i, j]-X_IN[:]))
-                if X_IN[n[i, j]] > X_OUT[i, j]:
-                    n[i, j] = n[i, j]-1
-    elif len(dimsOUT) == 1:
-        for i in range(N_OUT):
-            for j in range(Ndim):
-                n[i, j] = np.argmin(np.abs(X_OUT[i]-X_IN[:, j]))
-                if X_IN[n[i, j], j] > X_OUT[i]:
-                    n[i, j] = n[i, j]-1
+    if NdimsIN == 1:
+        X_1D = X_IN[:, 0]
+        if np.all(np.diff(X_1D) >= 0):
+            # Monotonic source: one binary search for all the requested values
+            n = np.searchsorted(X_1D, X_OUT, side='right')-1
+        else:
+            # Non-monotonic source (e.g. wrapped Ls): closest element, then step below if needed
+            n = np.argmin(np.abs(X_OUT[..., np.newaxis]-X_1D), axis=-1)
+            n[X_1D[n] > X_OUT] -= 1
     else:
-        for i in range(N_OUT):
-            for j in range(Ndim):
-                n[i, j] = np.argmin(np.abs(X_OUT[i, j]-X_IN[:, j]))
-                if X_IN[n[i, j], j] > X_OUT[i, j]:
-                    n[i, j] = n[i, j]-1
+        # Binary search down all the (monotonic) columns at once. 'lo' and 'hi' bracket, for each
+        # output element, the position of the first input level that is strictly above X_OUT.
+        X_OUT = np.broadcast_to(X_OUT, (N_OUT, Ndim))
+        Ndimall = np.arange(0, Ndim)
+        lo = np.zeros((N_OUT, Ndim), dtype=int)
+        hi = np.full((N_OUT, Ndim), N_IN, dtype=int)
+        active = lo < hi
+        while np.any(active):
+            mid = (lo+hi)//2
+            below = X_IN[np.minimum(mid, N_IN-1), Ndimall] <= X_OUT
+            lo = np.where(active & below, mid+1, lo)
+            hi = np.where(active & ~below, mid, hi)
+            active = lo < hi
+        n = lo-1
 
     if len(dimsOUT) == 1:
         n = np.squeeze(n)
@@ -346,12 +470,15 @@ def expand_index(Nindex, VAR_shape_axis_FIRST, axis_list):
         axis_list (int or list): position or list of positions for axis to insert, e.g. '2' for LEV in (tod,time,LEV,lat,lon), '[2,4]' for LEV and LON
                                  The axis position are those for the final shape (VAR_shape_axis_FIRST) and must be INCREASING
     Returns:
-        LFULL: a 2D array size(n_axis, NfFULL= time x LEV x lat x lon) with the indices expended  along the LEV dimensions and flattened
+        LFULL: a read-only ND array (n_axis, time, LEV, lat, lon) with the indices expended along the LEV dimensions.
+               This is a broadcast view of Nindex (zero stride along LEV), no memory is allocated.
     ***NOTE***
     Example of application:
      Observational time of day  may the same at all vertical levels so the interpolation of a 5D variable
     (tod,time,LEV,lat,lon) only requires the interpolation indices for (tod,time,lat,lon).
-    This routines expands the indices from (tod,time,lat,lon) to (tod,time,LEV,lat,lon) with Nfull=time x lev x lat x lon for use in interpolation
+    This routines expands the indices from (tod,time,lat,lon) to (tod,time,LEV,lat,lon) for use in interpolation, e.g.
+    as the 'index' argument of vinterp() or VerticalInterpPlan, which gather along the repeated axes without a copy.
+    Use np.reshape(LFULL, (n_axis, -1)) if a flattened copy (n_axis, time x LEV x lat x lon) is needed.
 
     '''
     # If one element, turn axis to list
@@ -360,8 +487,8 @@ def expand_index(Nindex, VAR_shape_axis_FIRST, axis_list):
 
     # size for the interpolation, e.g. (tod, time x lev x lat x lon)
     Nfull = Nindex.shape[0]
-    # Desired output size with LEV axis repeated(tod, time x lev x lat x lon)
-    dimsOUT_flat = tuple(np.append(Nfull, np.prod(VAR_shape_axis_FIRST[1:])))
+    # Desired output size with LEV axis repeated(tod, time, lev, lat, lon)
+    dimsOUT = tuple(np.append(Nfull, VAR_shape_axis_FIRST[1:]))
 
     dimsIN = []  # Reconstruct  the initial (un-flattened) size of Nindex
     # using the dimenions from VAR_shape_axis_FIRST
@@ -372,13 +499,139 @@ def expand_index(Nindex, VAR_shape_axis_FIRST, axis_list):
     dimsIN = np.insert(dimsIN, 0, Nfull)  # Initial shape for :Nindex
     # Reshape Nindex from its iniatial flattened sahpe (Nfull,time x lat x lon) to a  ND array (tod, time , lat , lon)
     Nindex = np.reshape(Nindex, dimsIN)
-    # Repeat the interpolation indices on the requested axis
-    for ii, len_axis in enumerate(VAR_shape_axis_FIRST):
-        if ii in axis_list:
-            Nindex = np.repeat(np.expand_dims(Nindex, axis=ii), len_axis, ii)
+    # Insert a length-1 axis at the requested positions, e.g. (tod, time , 1, lat , lon)
+    for ii in sorted(axis_list):
+        Nindex = np.expand_dims(Nindex, axis=ii)
+    # Repeat the interpolation indices on the requested axis with a zero stride (no copy)
     #e.g. Nindex is now (tod, time ,LEV, lat , lon)
-    # Return the new, flattened version of Nindex
-    return Nindex.reshape(dimsOUT_flat)
+    return np.broadcast_to(Nindex, dimsOUT)
+
+
+def _collapse_broadcast(index):
+    '''
+    Return the length-1 layout of a broadcast view, e.g. the output of expand_index() (tod, time, LEV, lat, lon)
+    with a zero stride along LEV is returned as (tod, time, 1, lat, lon). Other arrays are returned unchanged.
+    '''
+    collapse = tuple(slice(0, 1) if (stride == 0 and length > 1) else slice(None)
+                     for stride, length in zip(index.strides, index.shape))
+    return index[collapse]
+
+
+class VerticalInterpPlan(object):
+    '''
+    Pre-computed vertical interpolation, for use when several variables share the same 3D pressure or altitude field.
+    The gather indices and the log/lin weights are computed once for all the target levels and
+    applied to any number of variables with apply(). vinterp() is a one-time use of this object.
+    Args:
+        Lfull: pressure [Pa] or altitude [m] at full layers, N-dimensional array with VERTICAL AXIS FIRST
+        Llev : desired level for interpolation as a 1D array in [Pa] or [m]
+        type_int : 'log' for logarithmic (typically pressure), 'lin' for linear (typically altitude)
+        reverse_input (boolean) : reverse input arrays, e.g if zfull(0)=120 km, zfull(N)=0km
+        masktop: set to NaN values if above the model top
+        index: indices for the interpolation, already processed as [klev,Ndim], or as an ND array [klev, time, lat, lon]
+               e.g. from expand_index(). Indices will be recalculated if not provided.
+    USAGE:
+        plan = VerticalInterpPlan(L_3D_P, lev_in, type_int='log', masktop=True)
+        temp_pstd = plan.apply(temp)
+        ucomp_pstd = plan.apply(ucomp)
+    ***NOTE***
+    Each application is a single gather-multiply-add: X_OUT = Xn+1 + A*(Xn - Xn+1), see vinterp() for the definition of A.
+    Indices repeated along an axis (broadcast view from expand_index()) are kept in their length-1 layout and gathered
+    with np.take_along_axis(), so they are never expanded to the full size of the variable.
+    '''
+    def __init__(self, Lfull, Llev, type_int='log', reverse_input=False, masktop=True, index=None):
+        Llev = np.atleast_1d(np.asarray(Llev, dtype=float))
+        Nlev = len(Llev)
+
+        Lfull = np.asarray(Lfull)
+        Nfull = Lfull.shape[0]
+        # Special case where Lfull is a single profile
+        if len(Lfull.shape) == 1:
+            Lfull = Lfull.reshape([Nfull, 1])
+        # Dimensions other than the vertical axis, e.g. (time, lat, lon)
+        dims_other = Lfull.shape[1:]
+        if reverse_input:
+            Lfull = Lfull[::-1, ...]
+
+        if index is not None:
+            # Index have been pre-computed, either flattened [klev,Ndim] or with the shape of the other dimensions
+            n = np.asarray(index)
+            if n.ndim != Lfull.ndim:
+                n = np.reshape(n, (Nlev,)+dims_other)
+            n = _collapse_broadcast(n)
+        else:
+            # Note that reversed_input is always set to False as if desired, Lfull was reversed earlier
+            n = np.reshape(find_n(Lfull, Llev, False), (Nlev,)+dims_other)
+
+        np1 = n+1
+        # n = -1 (requested level above the first element) refers to the last layer
+        n = np.mod(n, Nfull)
+        # Only calculate alpha where n+1 exists
+        Ndo = np1 < Nfull
+        # Here, we need to make sure n+1 is never> Nfull by setting n+1=n, if it is the case.
+        # This does not affect the calculation as alpha is set to NaN for those values.
+        np1[~Ndo] = n[~Ndo]
+
+        L_n = np.take_along_axis(Lfull, n, axis=0)
+        L_np1 = np.take_along_axis(Lfull, np1, axis=0)
+        # Reshape Llev for broadcasting, e.g. (Nlev, 1, 1, 1)
+        Llev_ND = Llev.reshape((Nlev,)+(1,)*len(dims_other))
+        if type_int == 'log':
+            alpha = np.where(Ndo, np.log(Llev_ND/L_np1)/np.log(L_n/L_np1), np.NaN)
+        elif type_int == 'lin':
+            alpha = np.where(Ndo, (Llev_ND-L_np1)/(L_n-L_np1), np.NaN)
+
+        # Mask if Llev[k]<model top for the pressure interpolation
+        if masktop:
+            alpha[Llev_ND < L_n] = np.NaN
+
+        self.Nfull = Nfull
+        self.dims_other = dims_other
+        self.reverse_input = reverse_input
+        self.alpha = alpha
+        self.Nlev = Nlev
+        if n.shape[1:] == dims_other:
+            # Indices are defined for every column: gather from the flattened array, which is faster.
+            # Flattened indices in the (Nfull, Ndim) array: nindex=i*ncol+j
+            Ndim = int(np.prod(dims_other))
+            Ndimall = np.arange(0, Ndim).reshape(dims_other)
+            self.nindex = n*Ndim+Ndimall
+            self.nindexp1 = np1*Ndim+Ndimall
+            self.n = self.np1 = None
+        else:
+            # Indices repeated along some axes: gather along the vertical axis without expanding them
+            self.nindex = self.nindexp1 = None
+            self.n = n
+            self.np1 = np1
+
+    def _gather(self, varIN, n, nindex):
+        '''
+        Gather the values of varIN (Nfull, time, lat, lon) at the levels n, using the flattened indices if available.
+        '''
+        if nindex is not None:
+            return varIN.ravel()[nindex]
+        return np.take_along_axis(varIN, n, axis=0)
+
+    def apply(self, varIN):
+        '''
+        Interpolate one variable with the pre-computed indices and weights.
+        Args:
+            varIN: variable to interpolate (N-dimensional array with VERTICAL AXIS FIRST), same dimensions as Lfull
+        Returns:
+            varOUT: variable interpolated on the Llev pressure or altitude levels
+        '''
+        varIN = np.asarray(varIN)
+        # Special case where varIN is a single profile
+        if len(varIN.shape) == 1:
+            varIN = varIN.reshape([self.Nfull, 1])
+        dimsOUT = tuple(np.append(self.Nlev, varIN.shape[1:]))
+        # Match the other dimensions of Lfull
+        varIN = np.reshape(varIN, (self.Nfull,)+self.dims_other)
+        if self.reverse_input:
+            varIN = varIN[::-1, ...]
+        var_np1 = self._gather(varIN, self.np1, self.nindexp1)
+        varOUT = var_np1+self.alpha*(self._gather(varIN, self.n, self.nindex)-var_np1)
+        return np.reshape(varOUT, dimsOUT)
 
 
 def vinterp(varIN, Lfull, Llev, type_int='log', reverse_input=False, masktop=True, index=None):
@@ -391,11 +644,14 @@ def vinterp(varIN, Lfull, Llev, type_int='log', reverse_input=False, masktop=Tru
         reverse_input (boolean) : reverse input arrays, e.g if zfull(0)=120 km, zfull(N)=0km (which is typical) or if your input data is pfull(0)=1000Pa, pfull(N)=0Pa
         type_int : 'log' for logarithmic (typically pressure), 'lin' for linear (typically altitude)
         masktop: set to NaN values if above the model top
-        index: indices for the interpolation, already processed as [klev,Ndim]
+        index: indices for the interpolation, already processed as [klev,Ndim], or as an ND array, see VerticalInterpPlan
                Indices will be recalculated if not provided.
     Returns:
         varOUT: variable interpolated on the Llev pressure or altitude levels
 
+    ***NOTE***
+    To interpolate several variables on the same levels, build a VerticalInterpPlan() once and call its apply() method.
+
     *** IMPORTANT NOTE***
     This interpolation assumes pressure are increasing downward, i.e:
 
@@ -415,83 +671,11 @@ def vinterp(varIN, Lfull, Llev, type_int='log', reverse_input=False, masktop=Tru
 
 
     '''
-    # Special case where only 1 layer is requested
-    Nlev = len(np.atleast_1d(Llev))
-    if Nlev == 1:
-        Llev = np.array([Llev])
-
-    dimsIN = varIN.shape  # get input variable dimensions
-    Nfull = dimsIN[0]
-
-    # Special case where varIN and Lfull are a single profile
-    if len(varIN.shape) == 1:
-        varIN = varIN.reshape([Nfull, 1])
-    if len(Lfull.shape) == 1:
-        Lfull = Lfull.reshape([Nfull, 1])
+    return VerticalInterpPlan(Lfull, Llev, type_int=type_int, reverse_input=reverse_input,
+                              masktop=masktop, index=index).apply(varIN)
 
-    dimsIN = varIN.shape  # repeat in case varIN and Lfull were reshaped
-
-    dimsOUT = tuple(np.append(Nlev, dimsIN[1:]))
-    # Ndim is the product  of all dimensions but the vertical axis
-    Ndim = int(np.prod(dimsIN[1:]))
-    # flatten the other dimensions to (Nfull, Ndim)
-    varIN = np.reshape(varIN, (Nfull, Ndim))
-    # flatten the other dimensions to (Nfull, Ndim)
-    Lfull = np.reshape(Lfull, (Nfull, Ndim))
-    varOUT = np.zeros((Nlev, Ndim))
-    Ndimall = np.arange(0, Ndim)  # all indices (does not change)
-
-    #
-    if reverse_input:
-        Lfull = Lfull[::-1, :]
-        varIN = varIN[::-1, :]
-
-    for k in range(0, Nlev):
-        # Find nearest layer to Llev[k]
-        if np.any(index):
-            # index have been pre-computed:
-            n = index[k, :]
-        else:
-            # Compute index on the fly for that layer.
-            # Note that reversed_input is always set to False as if desired, Lfull was reversed earlier
-            n = np.squeeze(find_n(Lfull, Llev[k], False))
-        # ==Slower method (but explains what is done below): loop over Ndim======
-        # for ii in range(Ndim):
-        #     if n[ii]<Nfull-1:
-        #         alpha=np.log(Llev[k]/Lfull[n[ii]+1,ii])/np.log(Lfull[n[ii],ii]/Lfull[n[ii]+1,ii])
-        #         varOUT[k,ii]=varIN[n[ii],ii]*alpha+(1-alpha)*varIN[n[ii]+1,ii]
-
-        # =================    Fast method  no loop  =======================
-        # Convert the layers n to indexes, for a 2D matrix using nindex=i*ncol+j
-        nindex = n*Ndim+Ndimall  # n
-        nindexp1 = (n+1)*Ndim+Ndimall  # n+1
-
-        # initialize alpha, size is [Ndim]
-        alpha = np.NaN*Ndimall
-        # Only calculate alpha  where the indices are <Nfull
-        Ndo = Ndimall[nindexp1 < Nfull*Ndim]
-        if type_int == 'log':
-            alpha[Ndo] = np.log(Llev[k]/Lfull.flatten()[nindexp1[Ndo]])/np.log(
-                Lfull.flatten()[nindex[Ndo]]/Lfull.flatten()[nindexp1[Ndo]])
-        elif type_int == 'lin':
-            alpha[Ndo] = (Llev[k]-Lfull.flatten()[nindexp1[Ndo]]) / \
-                (Lfull.flatten()[nindex[Ndo]] - Lfull.flatten()[nindexp1[Ndo]])
 
-        # Mask if Llev[k]<model top for the pressure interpolation
-        if masktop:
-            alpha[Llev[k] < Lfull.flatten()[nindex]] = np.NaN
-
-        # Here, we need to make sure n+1 is never> Nfull by setting n+1=Nfull, if it is the case.
-        # This does not affect the calculation as alpha is set to NaN for those values.
-        nindexp1[nindexp1 >= Nfull*Ndim] = nindex[nindexp1 >= Nfull*Ndim]
-
-        varOUT[k, :] = varIN.flatten()[nindex]*alpha+(1-alpha) * \
-            varIN.flatten()[nindexp1]
-
-    return np.reshape(varOUT, dimsOUT)
-
-
-def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin', modulo=None):
+def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin', modulo=None, out=None):
     '''
     One dimensional linear /log interpolation along one axis. [Alex Kling, May 2021]
     Args:
@@ -502,6 +686,7 @@ def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin', modulo
         reverse_input (boolean) : reverse input arrays, e.g if zfull(0)=120 km, zfull(N)=0km (which is typical)
         type_int : 'log' for logarithmic (typically pressure), 'lin' for linear
         modulo (float)    : for 'lin' interpolation only, use cyclic input (e.g when using modulo = 24 for time of day, 23.5 and 00am are considered 30 min appart, not 23.5hr)
+        out (N-D array)   : optional, preallocated array with the shape of VAR_OUT to write the result into
     Returns:
         VAR_OUT: interpolated data on the requested axis
 
@@ -511,6 +696,9 @@ def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin', modulo
 
     > For lon/lat interpolation, you may consider using  interp_KDTree() instead
 
+    > The bracketing slabs for all the target values are gathered along 'axis' with a single np.take() and blended with
+      broadcasted weights, so the interpolation axis does not need to be moved first.
+
     We have:
 
     X_OUT= Xn*A + (1-A)*Xn+1
@@ -518,46 +706,52 @@ def axis_interp(var_IN, x, xi, axis, reverse_input=False, type_int='lin', modulo
          A =    (xi-xn+1)/(xn-xn+1)    in 'lin' mode
     '''
     # Convert list to numpy array as needed
-    if type(var_IN) != np.ndarray:
-        var_IN = np.array(var_IN)
-    # Move interpolated axis to 1st axis:
-    var_IN = np.moveaxis(var_IN, axis, 0)
+    var_IN = np.asarray(var_IN)
+    # The weights are computed in double precision, also for float32 axes
+    x = np.asarray(x, dtype=float)
+    xi = np.atleast_1d(np.asarray(xi, dtype=float))
+    axis = axis % var_IN.ndim
     if reverse_input:
-        var_IN = var_IN[::-1, ...]
+        var_IN = np.flip(var_IN, axis)
         x = x[::-1]
 
     # This is called everytime as it is fast on a 1D array
-    index = find_n(x, xi, False)
-
-    dimsIN = var_IN.shape
-    dimsOUT = tuple(np.append(len(xi), dimsIN[1:]))
-    var_OUT = np.zeros(dimsOUT)
-
-    for k in range(0, len(index)):
-        n = index[k]
-        np1 = n+1
-        # Treatment of edge cases where the interpolated value is outside the domain, i.e. n is the last element  and n+1 does not exist
-        if np1 >= len(x):
-            # If looping around (e.g. longitude, time of day...)replace n+1 by the first element
-            if modulo is not None:
-                np1 = 0
-            else:
-                # This will set the interpolated value to NaN in xi as last value  as x[n] - x[np1] =0
-                np1 -= 1
-        # Also set n=n+1 (which results in NaN) if n =-1 (requested value is samller than first element array) and the values are NOT cyclic
-        if n == -1 and modulo is None:
-            n = 0
-        if type_int == 'log':
-            alpha = np.log(xi[k]/x[np1])/np.log(x[n]/x[np1])
-        elif type_int == 'lin':
-            if modulo is None:
-                alpha = (xi[k]-x[np1])/(x[n] - x[np1])
-            else:
-                alpha = np.mod(xi[k]-x[np1]+modulo, modulo) / \
-                    np.mod(x[n] - x[np1]+modulo, modulo)
-        var_OUT[k, :] = var_IN[n, ...]*alpha+(1-alpha)*var_IN[np1, ...]
-
-    return np.moveaxis(var_OUT, 0, axis)
+    n = np.atleast_1d(find_n(x, xi, False))
+    np1 = n+1
+    # Treatment of edge cases where the interpolated value is outside the domain, i.e. n is the last element  and n+1 does not exist
+    if modulo is not None:
+        # If looping around (e.g. longitude, time of day...)replace n+1 by the first element
+        np1[np1 >= len(x)] = 0
+    else:
+        # This will set the interpolated value to NaN in xi as last value  as x[n] - x[np1] =0
+        np1[np1 >= len(x)] -= 1
+        # Also set n=n+1 (which results in NaN) if n =-1 (requested value is samller than first element array)
+        n[n == -1] = 0
+
+    if type_int == 'log':
+        alpha = np.log(xi/x[np1])/np.log(x[n]/x[np1])
+    elif type_int == 'lin':
+        if modulo is None:
+            alpha = (xi-x[np1])/(x[n] - x[np1])
+        else:
+            alpha = np.mod(xi-x[np1]+modulo, modulo) / \
+                np.mod(x[n] - x[np1]+modulo, modulo)
+
+    # Broadcast the weights along the interpolation axis, e.g. (1, Nxi, 1, 1)
+    shape_alpha = np.ones(var_IN.ndim, dtype=int)
+    shape_alpha[axis] = len(xi)
+    alpha = alpha.reshape(shape_alpha)
+
+    # Gather Xn and Xn+1 for all the target values at once
+    var_n, var_np1 = np.split(np.take(var_IN, np.append(n, np1), axis=axis), 2, axis=axis)
+
+    # X_OUT = Xn+1 + A*(Xn - Xn+1), computed in place
+    if out is None:
+        out = np.empty(var_n.shape, dtype=np.result_type(var_n, alpha))
+    np.subtract(var_n, var_np1, out=out)
+    out *= alpha
+    out += var_np1
+    return out
 
 
 def layers_mid_point_to_boundary(pfull, sfc_val):
@@ -642,7 +836,96 @@ def polar2XYZ(lon, lat, alt, Re=3400*10**3):  # radian
     return X, Y, Z
 
 
-def interp_KDTree(var_IN, lat_IN, lon_IN, lat_OUT, lon_OUT, N_nearest=10):
+# In-memory storage for the nearest neighbour indices and weights, see KDTree_weights()
+KDTree_cache = dict()
+
+
+def KDTree_weights(lat_IN, lon_IN, lat_OUT, lon_OUT, N_nearest=10, weights_file=None, sparse=False):
+    '''
+    Nearest neighbours and normalized inverse-distance weights for the regridding of a source grid onto a target grid.
+    The results are kept in memory (and optionally on disk) so the KDTree is only built and queried once per grid pair.
+    Args:
+        lat_IN,lon_IN   (1D or 2D): lat, lon 1D arrays or LAT[y,x] LON[y,x] for irregular grids in [deg]
+        lat_OUT,lon_OUT (1D or 2D): lat,lon for the TARGET grid structure in [deg]
+        N_nearest: integer, number of nearest neighbours for the search.
+        weights_file: optional, full path to a .npz file used to store and re-load the weights across sessions
+        sparse: if True, return the weights as a single sparse matrix instead
+    Returns:
+        inds: indices of the nearest neighbours in the flattened source grid, size is (nlat_OUT x nlon_OUT, N_nearest)
+        w   : the inverse-distance weights for these neighbours, normalized to 1, same size as 'inds'
+     or, if sparse is True:
+        W   : the weights as a scipy CSR matrix of size (nlat_OUT x nlon_OUT, nlat_IN x nlon_IN), so that
+              VAR_OUT = W @ VAR_IN for a VAR_IN flattened on the source grid
+    ***NOTE***
+    The cache is keyed on the source grid, the target grid and N_nearest: a weights file computed for another
+    grid pair is ignored and overwritten.
+    '''
+    import hashlib
+
+    lat_IN, lon_IN, lat_OUT, lon_OUT = [np.asarray(x, dtype=float) for x in [lat_IN, lon_IN, lat_OUT, lon_OUT]]
+    sha = hashlib.sha1()
+    for x in [lat_IN, lon_IN, lat_OUT, lon_OUT]:
+        sha.update(str(x.shape).encode())
+        sha.update(np.ascontiguousarray(x).tobytes())
+    sha.update(str(N_nearest).encode())
+    key = sha.hexdigest()
+
+    if sparse:
+        if key+'_csr' not in KDTree_cache:
+            from scipy.sparse import csr_matrix
+            inds, w = KDTree_weights(lat_IN, lon_IN, lat_OUT, lon_OUT, N_nearest, weights_file)
+            Nout = inds.shape[0]
+            if len(lat_IN.shape) == 1:
+                Nin = len(lat_IN)*len(lon_IN)
+            else:
+                Nin = lat_IN.size
+            W = csr_matrix((w.flatten(), (np.repeat(np.arange(Nout), inds.shape[1]), inds.flatten())),
+                           shape=(Nout, Nin))
+            W.eliminate_zeros()
+            KDTree_cache[key+'_csr'] = W
+        return KDTree_cache[key+'_csr']
+
+    if key in KDTree_cache:
+        return KDTree_cache[key]
+
+    if weights_file is not None and os.path.isfile(weights_file):
+        with np.load(weights_file) as f:
+            if str(f['key']) == key:
+                KDTree_cache[key] = (f['inds'], f['w'])
+                return KDTree_cache[key]
+
+    from scipy.spatial import cKDTree  # Only imported when the weights need to be computed
+
+    # If input/output latitudes/longitudes are 1D, extend the dimensions for generality:
+    if len(lat_IN.shape) == 1:
+        lon_IN, lat_IN = np.meshgrid(lon_IN, lat_IN)
+    if len(lat_OUT.shape) == 1:
+        lon_OUT, lat_OUT = np.meshgrid(lon_OUT, lat_OUT)
+
+    # Compute cartesian coordinate for source and target files  polar2XYZ(lon,lat,lev)
+    xs, ys, zs = polar2XYZ(lon_IN*np.pi/180, lat_IN*np.pi/180, 0., Re=1.)
+    xt, yt, zt = polar2XYZ(lon_OUT*np.pi/180, lat_OUT*np.pi/180, 0., Re=1.)
+
+    tree = cKDTree(np.column_stack([xs.flatten(), ys.flatten(), zs.flatten()]))
+    d, inds = tree.query(
+        np.column_stack([xt.flatten(), yt.flatten(), zt.flatten()]), k=N_nearest)
+    # Inverse distance
+    with np.errstate(divide='ignore'):
+        w = 1.0 / d**2
+    # Where the source and target points coincide, use the source value
+    exact = np.isinf(w)
+    has_exact = np.any(exact, axis=1)
+    w[has_exact] = exact[has_exact]
+    # Normalize the weights
+    w = w/np.sum(w, axis=1)[:, np.newaxis]
+
+    KDTree_cache[key] = (inds, w)
+    if weights_file is not None:
+        np.savez(weights_file, inds=inds, w=w, key=key)
+    return inds, w
+
+
+def interp_KDTree(var_IN, lat_IN, lon_IN, lat_OUT, lon_OUT, N_nearest=10, weights_file=None, sparse=False, chunk_size=100):
     '''
     Inverse-distance-weighted interpolation using nearest neighboor for ND variables.  [Alex Kling , May 2021]
     Args:
@@ -650,6 +933,9 @@ def interp_KDTree(var_IN, lat_IN, lon_IN, lat_OUT, lon_OUT, N_nearest=10):
         lat_IN,lon_IN        (1D or 2D):   lat, lon 1D arrays or LAT[y,x] LON[y,x] for irregular grids in [deg]
         lat_OUT,lon_OUT(1D or 2D):lat,lon for the TARGET grid structure , e.g. lat1,lon1 or LAT1[y,x], LON1[y,x] for irregular grids in [deg]
         N_nearest: integer, number of nearest neighbours for the search.
+        weights_file: optional, .npz file to store and re-use the interpolation weights, see KDTree_weights()
+        sparse: if True, apply the weights as a sparse matrix product, 'chunk_size' 2D fields at the time
+        chunk_size: integer, number of 2D (lat, lon) fields processed together in sparse mode
     Returns:
         VAR_OUT: interpolated data on the target grid
 
@@ -658,9 +944,13 @@ def interp_KDTree(var_IN, lat_IN, lon_IN, lat_OUT, lon_OUT, N_nearest=10):
     > The nearest neighbour interpolation is only done on the lon/lat axis, (not level).  Although this interpolation work well on the 3D field (x,y,z),
     this is typically not what is expected: In a 4°x4° run, the closest points East, West, North and South, on the target grid  are 100's of km away
     while the closest points in the vertical are a few 10's -100's meter in the PBL, which would results in excessive weighting in the vertical.
+    > The neighbours and weights are computed once per grid pair and re-used for all the variables, see KDTree_weights()
+    > The default mode builds a temporary array of size (Ndim, nlat_OUT x nlon_OUT, N_nearest). For large files (e.g. daily files with
+    a vertical axis), use sparse=True: the temporary arrays are then limited to 'chunk_size' fields. Note that var_IN and VAR_OUT
+    are still fully in memory.
+    > In sparse mode, masked values (e.g. _FillValue) are excluded and the weights of the valid neighbours are re-normalized.
+    Target points with no valid neighbour are masked.
     '''
-    from scipy.spatial import cKDTree  # TODO Import called each time. May be moved out of the routine is scipy is a requirement for the pipeline
-
     dimsIN = var_IN.shape
     nlon_IN = dimsIN[-1]
     nlat_IN = dimsIN[-2]
@@ -669,38 +959,46 @@ def interp_KDTree(var_IN, lat_IN, lon_IN, lat_OUT, lon_OUT, N_nearest=10):
     if len(dimsIN) == 2:
         var_IN = var_IN.reshape(1, nlat_IN, nlon_IN)
 
-    # If input/output latitudes/longitudes are 1D, extend the dimensions for generality:
-    if len(lat_IN.shape) == 1:
-        lon_IN, lat_IN = np.meshgrid(lon_IN, lat_IN)  # TODO broadcast instead?
-    if len(lat_OUT.shape) == 1:
-        lon_OUT, lat_OUT = np.meshgrid(lon_OUT, lat_OUT)
-
-    nlat_OUT = lat_OUT.shape[0]
-    nlon_OUT = lon_OUT.shape[1]
-
-    # If lat, lon are 1D, broadcast dimensions:
+    if len(np.shape(lat_OUT)) == 1:
+        nlat_OUT = len(lat_OUT)
+        nlon_OUT = len(lon_OUT)
+    else:
+        nlat_OUT, nlon_OUT = np.shape(lat_OUT)
 
     # Ndim is the product of all input dimensions but lat & lon
     Ndim = int(np.prod(dimsIN[0:-2]))
     dims_IN_reshape = tuple(np.append(Ndim, nlon_IN*nlat_IN))
-    dims_OUT_reshape = tuple(np.append(Ndim, nlat_OUT*nlon_OUT))
     # Needed if var is (lat,lon)
     dims_OUT = np.append(dimsIN[0:-2], [nlat_OUT, nlon_OUT]).astype(int)
-    var_OUT = np.zeros(dims_OUT_reshape)  # Initialization
-    Ndimall = np.arange(0, Ndim)  # all indices (does not change)
-
-    # Compute cartesian coordinate for source and target files  polar2XYZ(lon,lat,lev)
-    xs, ys, zs = polar2XYZ(lon_IN*np.pi/180, lat_IN*np.pi/180, 0., Re=1.)
-    xt, yt, zt = polar2XYZ(lon_OUT*np.pi/180, lat_OUT*np.pi/180, 0., Re=1.)
 
-    tree = cKDTree(list(zip(xs.flatten(), ys.flatten(), zs.flatten())))
-    d, inds = tree.query(
-        list(zip(xt.flatten(), yt.flatten(), zt.flatten())), k=N_nearest)
-    # Inverse distance
-    w = 1.0 / d**2
-    # sum the weights  and normalize
-    var_OUT = np.sum(w*var_IN.reshape(dims_IN_reshape)
-                     [:, inds], axis=2)/np.sum(w, axis=1)
+    if sparse:
+        W = KDTree_weights(lat_IN, lon_IN, lat_OUT, lon_OUT,
+                           N_nearest=N_nearest, weights_file=weights_file, sparse=True)
+        var_IN = var_IN.reshape(dims_IN_reshape)
+        var_OUT = np.zeros((Ndim, nlat_OUT*nlon_OUT))
+        mask_OUT = None
+        # Process the fields by chunks: VAR_OUT.T = W @ VAR_IN.T
+        for i0 in range(0, Ndim, chunk_size):
+            i1 = min(i0+chunk_size, Ndim)
+            mask = np.ma.getmaskarray(var_IN[i0:i1, :])
+            if not mask.any():
+                var_OUT[i0:i1, :] = (W @ np.ma.getdata(var_IN[i0:i1, :]).T).T
+            else:
+                # Zero the masked values and re-normalize by the weights of the valid neighbours
+                data = np.where(mask, 0., np.ma.getdata(var_IN[i0:i1, :]))
+                wsum = (W @ (~mask).T.astype(float)).T
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    var_OUT[i0:i1, :] = (W @ data.T).T/wsum
+                if mask_OUT is None:
+                    mask_OUT = np.zeros(var_OUT.shape, dtype=bool)
+                mask_OUT[i0:i1, :] = wsum == 0
+        if mask_OUT is not None:
+            var_OUT = np.ma.array(var_OUT, mask=mask_OUT)
+    else:
+        inds, w = KDTree_weights(lat_IN, lon_IN, lat_OUT, lon_OUT,
+                                 N_nearest=N_nearest, weights_file=weights_file)
+        # Weighted sum of the neighbours, the weights are already normalized
+        var_OUT = np.sum(w*var_IN.reshape(dims_IN_reshape)[:, inds], axis=2)
     return var_OUT.reshape(dims_OUT)
 
 
@@ -908,7 +1206,7 @@ def areo_avg(VAR, areo, Ls_target, Ls_angle, symmetric=True):
     return VAR_avg.reshape(shape_out)
 
 
-def mass_stream(v_avg, lat, level, type='pstd', psfc=700, H=8000., factor=1.e-8):
+def mass_stream(v_avg, lat, level, type='pstd', psfc=700, H=8000., factor=1.e-8, chunk_size=None):
     '''
     Compute the mass stream function.
                             P
@@ -926,6 +1224,8 @@ def mass_stream(v_avg, lat, level, type='pstd', psfc=700, H=8000., factor=1.e-8)
         psfc : reference surface pressure in [Pa]
         H    : reference scale height in [m] when pressure are used.
         factor: normalize the mass stream function by a factor, use factor =1. to obtain [kg/s]
+        chunk_size: optional, integer. Process the dimensions after 'lat' (flattened, e.g. lon x time) by chunks of that size
+                    to limit the memory used by the temporary arrays.
     Returns:
         MSF: The meridional mass stream function in factor*[kg/s]
     ***NOTE***
@@ -942,6 +1242,7 @@ def mass_stream(v_avg, lat, level, type='pstd', psfc=700, H=8000., factor=1.e-8)
                                                             ⌠
     The integral is calculated using trapezoidal rule, e.g. ⌡ f(z)dz  = (Zn-Zn-1){f(Zn)+f(Zn-1)}/2
                                                             n-1
+    The integrals for all the levels are obtained at once from a cumulative sum of the trapezoids, starting from the bottom.
     '''
     g = 3.72  # m/s2
     a = 3400*1000  # m
@@ -956,9 +1257,6 @@ def mass_stream(v_avg, lat, level, type='pstd', psfc=700, H=8000., factor=1.e-8)
     v_avg = v_avg.reshape((nlev, len(lat), np.prod(v_avg.shape[2:])))
     MSF = np.zeros_like(v_avg)
 
-    # Sum variable, same dimensions as v_avg but for the first dimension
-    I = np.zeros(v_avg.shape[2:])
-
     # Make note of NaN positions and replace by zero for downward integration
     isNan = False
     if np.isnan(v_avg).any():
@@ -980,16 +1278,22 @@ def mass_stream(v_avg, lat, level, type='pstd', psfc=700, H=8000., factor=1.e-8)
     else:  # Copy zagl or zstd instead of using a pseudo height
         Z = level.copy()
 
-    for k0 in range(nlev-2, 0, -1):
-        I[:] = 0.
-        for k in range(nlev-2, k0, -1):
-            zn = Z[k]
-            znp1 = Z[k+1]
-            fn = v_avg[k, :, ...] * np.exp(-zn/H)
-            fnp1 = v_avg[k+1, :, ...]*np.exp(-znp1/H)
-            I = I+0.5*(znp1-zn)*(fnp1+fn)
-        MSF[k0, :, ...] = 2*np.pi*a*psfc / \
-            (g*H)*np.cos(np.pi/180*lat).reshape([len(lat), 1])*I*factor
+    dZ = (Z[1:]-Z[:-1]).reshape([nlev-1, 1, 1])
+    expZ = np.exp(-Z/H).reshape([nlev, 1, 1])
+    cst = 2*np.pi*a*psfc/(g*H)*np.cos(np.pi/180*lat).reshape([len(lat), 1])*factor
+
+    Ncol = v_avg.shape[2]
+    if chunk_size is None:
+        chunk_size = max(Ncol, 1)
+    for i0 in range(0, Ncol, chunk_size):
+        i1 = min(i0+chunk_size, Ncol)
+        f = v_avg[:, :, i0:i1]*expZ
+        # Trapezoid between levels k and k+1, size is (nlev-1, lat, chunk)
+        trapz = 0.5*dZ*(f[1:, ...]+f[:-1, ...])
+        # Reverse cumulative sum: I[k] is the integral from level k to the bottom level
+        I = np.cumsum(trapz[::-1, ...], axis=0)[::-1, ...]
+        # MSF at k0 integrates from level k0+1, the top and bottom levels are set to zero
+        MSF[1:nlev-2, :, i0:i1] = cst*I[2:, ...]
 
     # Replace NaN where they initially were:
     if isNan:
@@ -1313,18 +1617,26 @@ def get_trend_2D(VAR, LON, LAT, type_trend='wmean'):
     reshape_flat = np.append(nflatten, var_shape[-2:])
     VAR = VAR.reshape(reshape_flat)
 
+    # All the (lat,lon) slices are processed at once
     TREND = np.zeros(reshape_flat)
-    for ii in range(nflatten):
-        if type_trend == 'mean':
-            TREND[ii, ...] = np.mean(VAR[ii, ...].flatten())
-        elif type_trend == 'wmean':
-            W = area_weights_deg(var_shape[-2:], LAT[:, 0])
-            TREND[ii, ...] = np.mean((VAR[ii, ...]*W).flatten())
-        elif type_trend == '2D':
-            TREND[ii, ...] = regression_2D(LON, LAT, VAR[ii, :, :], order=1)
+    if type_trend == 'mean':
+        TREND[...] = np.mean(VAR, axis=(1, 2))[:, np.newaxis, np.newaxis]
+    elif type_trend == 'wmean':
+        W = area_weights_deg(var_shape[-2:], LAT[:, 0])
+        if np.ma.is_masked(VAR):
+            # Same as np.mean(VAR*W) on a masked array: the masked values are excluded from both the sum and the count
+            valid = ~np.ma.getmaskarray(VAR)
+            VAR_sum = np.tensordot(np.where(valid, np.ma.getdata(VAR), 0.), W, axes=([1, 2], [0, 1]))
+            Nvalid = np.sum(valid, axis=(1, 2))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                TREND[...] = np.where(Nvalid > 0, VAR_sum/Nvalid, 0.)[:, np.newaxis, np.newaxis]
         else:
-            print("Error, in area_trend, type '%s' not recognized" % (type_trend))
-            return None
+            TREND[...] = (np.tensordot(VAR, W, axes=([1, 2], [0, 1]))/W.size)[:, np.newaxis, np.newaxis]
+    elif type_trend == '2D':
+        TREND[...] = regression_2D(LON, LAT, VAR, order=1)
+    else:
+        print("Error, in area_trend, type '%s' not recognized" % (type_trend))
+        return None
     return TREND.reshape(var_shape)
 
 
@@ -1334,8 +1646,10 @@ def regression_2D(X, Y, VAR, order=1):
     Args:
         X: 2D array of first coordinate
         Y: 2D array of decond coordinate
-        VAR: 2D array, same size as X
+        VAR: 2D array, same size as X, or a stack of 2D arrays (N,...,X.shape) with the plane dimensions LAST
         order : 1 (linear) or 2 (quadratic)
+    Returns:
+        Z: the regression, same size as VAR
 
 
     ***NOTE***
@@ -1352,38 +1666,31 @@ def regression_2D(X, Y, VAR, order=1):
             [n,3]           [3]       [n]
 
     The least square regression provides the solution that that minimizes  ||b – A x||**2
+
+    The design matrix A only depends on the grid: its pseudo-inverse is computed once and applied to all
+    the 2D slices in VAR with a single matrix product.
     '''
+    XX = X.flatten()
+    YY = Y.flatten()
+    # Flatten the stack of 2D arrays to (n, Nslices)
+    B = VAR.reshape((-1, XX.size)).T
+
     if order == 1:
-        A = np.array([X.flatten(), Y.flatten(), np.ones_like(X.flatten())]).T
+        A = np.array([XX, YY, np.ones_like(XX)]).T
 
         # An Equivalent notation is:
         # A=np.c_[X.flatten(),Y.flatten(),np.ones_like(X.flatten())]
 
-        b = VAR.flatten()
-
-        # P is the solution of  A X =b, ==> P[0] x + P[1]y + P[2] = z
-        P, residuals, rank, s = np.linalg.lstsq(A, b, rcond=None)
-
-        Z = P[0]*X + P[1]*Y+np.ones_like(X)*P[2]
-
     elif order == 2:
         # best-fit quadratic curve: a X**2 + 2b X*Y +c Y**2 +2dX +2eY+f
-        XX = X.flatten()
-        YY = Y.flatten()
-        ZZ = VAR.flatten()
-        data = np.zeros((len(XX), 3))
-        data[:, 0] = XX
-        data[:, 1] = YY
-        data[:, 2] = ZZ
+        A = np.c_[np.ones(XX.shape), XX, YY, XX*YY, XX**2, YY**2]
 
-        A = np.c_[np.ones(data.shape[0]), data[:, :2], np.prod(
-            data[:, :2], axis=1), data[:, :2]**2]
-        P, _, _, _ = np.linalg.lstsq(A, data[:, 2], rcond=None)
+    # P is the solution of  A X =b, e.g. P[0] x + P[1]y + P[2] = z for each slice, size is (3 or 6, Nslices)
+    P = np.dot(np.linalg.pinv(A), B)
 
-        # evaluate it on a grid (using vector product)
-        Z = np.dot(np.c_[np.ones(XX.shape), XX, YY, XX *
-                   YY, XX**2, YY**2], P).reshape(X.shape)
-    return Z
+    # evaluate it on a grid (using vector product)
+    Z = np.dot(A, P).T
+    return Z.reshape(VAR.shape)
 
 
 def daily_to_average(varIN, dt_in, nday=5, trim=True):
@@ -1604,55 +1911,25 @@ def polar_warming(T, lat, outside_range=np.NaN):
 
     def PW_half_hemisphere(T_half, lat_half, outside_range=np.NaN):
 
-        # Easy case, T is a 1D on the latitude direction only
-        if len(T_half.shape) == 1:
-            imin = np.argmin(T_half)
-            imax = np.argmax(T_half)
-
-            # Note that we compute polar warming at ALL latitudes and then set NaN the latitudes outside the desired range.
-            # We test on the absolute values (np.abs) of the latitudes, therefore the function is usable on both hemispheres
-            DT_PW_half = T_half-T_half[imin]
-            exclude = np.append(np.where(np.abs(
-                lat_half)-np.abs(lat_half[imin]) < 0), np.where(np.abs(lat_half[imax])-np.abs(lat_half) < 0))
-            DT_PW_half[exclude] = outside_range  # set to NaN
-            return DT_PW_half
-
-        # General case for N dimensions
-        else:
-
-            # Flatten the diemnsions but the first dimension (the latitudes)
-            arr_flat = T_half.reshape(
-                [T_half.shape[0], np.prod(T_half.shape[1:])])
-            LAT_HALF = np.repeat(
-                lat_half[:, np.newaxis], arr_flat.shape[1], axis=1)
-
-            imin = np.argmin(arr_flat, axis=0)
-            imax = np.argmax(arr_flat, axis=0)
-
-            # Initialize four working arrays
-            tmin0, tmax0, latmin0, latmax0 = [
-                np.zeros_like(arr_flat) for _ in range(4)]
+        # Latitudes reshaped for broadcasting with T_half, e.g. [lat,1,1,1] for a 4D variable
+        # We test on the absolute values (np.abs) of the latitudes, therefore the function is usable on both hemispheres
+        abs_lat = np.abs(lat_half).reshape(
+            [len(lat_half)]+[1]*(len(T_half.shape)-1))
 
-            # get the min/max temperature and latitudes
-            for i in range(0, arr_flat.shape[1]):
-                tmax0[:, i] = arr_flat[imax[i], i]
-                tmin0[:, i] = arr_flat[imin[i], i]
-                latmin0[:, i] = lat_half[imin[i]]
-                latmax0[:, i] = lat_half[imax[i]]
+        # Indices of the min/max temperatures for each column, kept as size-1 first dimension, e.g. [1,time,lev,lon]
+        imin = np.expand_dims(np.argmin(T_half, axis=0), axis=0)
+        imax = np.expand_dims(np.argmax(T_half, axis=0), axis=0)
 
-            # Compute polar warming for that hemisphere
-            DT_PW_half = arr_flat-tmin0
+        # Gather the min temperature and the latitudes of the extrema without looping over the columns
+        tmin = np.take_along_axis(T_half, imin, axis=0)
+        latmin = np.abs(lat_half)[imin]
+        latmax = np.abs(lat_half)[imax]
 
-            # Set to NaN values outside the range.
-            tuple_lower_than_latmin = np.where(
-                np.abs(LAT_HALF)-np.abs(latmin0) < 0)
-            tuple_larger_than_latmax = np.where(
-                np.abs(latmax0)-np.abs(LAT_HALF) < 0)
+        # Note that we compute polar warming at ALL latitudes and then set NaN the latitudes outside the desired range.
+        DT_PW_half = T_half-tmin
+        DT_PW_half[(abs_lat < latmin) | (abs_lat > latmax)] = outside_range
 
-            DT_PW_half[tuple_lower_than_latmin] = outside_range
-            DT_PW_half[tuple_larger_than_latmax] = outside_range
-
-            return DT_PW_half.reshape(T_half.shape)
+        return DT_PW_half
 
     # ======================================================
     # ======Actual calculations for both hemispheres========
@@ -1666,6 +1943,95 @@ def polar_warming(T, lat, outside_range=np.NaN):
     return np.concatenate((PW_half_hemisphere(T_SH, lat_SH, outside_range), PW_half_hemisphere(T_NH, lat_NH, outside_range)), axis=0)
 
 
+class LocalTimeShiftPlan(object):
+    '''
+    Pre-computed conversion to uniform local time, for use with all the variables of a 'diurn' file.
+    The interpolation indices and weights are computed once for every (longitude, output local time) pair and
+    applied to any number of variables with apply(). tshift() is a one-time use of this object.
+    Args:
+        lon: longitude
+        timeo : time_of_day index from input file
+        timex (optional) : local time (hr) to shift to, e.g. '3. 15.'
+    USAGE:
+        plan = LocalTimeShiftPlan(lon, tod, timex=[3., 15.])
+        temp_LT = plan.apply(temp)    # temp is (lon, ..., time_of_day)
+    ***Note***
+    If timex is not specified, the file is interpolated on the same time_of_day as the input
+    '''
+    def __init__(self, lon, timeo, timex=None):
+        timeo = np.atleast_1d(np.squeeze(timeo))
+        nsteps = len(timeo)    # number of timesteps per day in input
+        nsf = float(nsteps)    # number of timesteps per day in input
+
+        # array dimensions for output
+        if timex is None:       # time shift all local times
+            nsteps_out = nsteps
+        else:
+            nsteps_out = len(timex)
+
+        dt_samp = 24.0/nsteps  # Time increment of input data (in hours)
+
+        # time increment of output
+        if timex is None:       # match dimensions of output file to input
+            dt_save = dt_samp  # Time increment of output data (in hours)
+        else:
+            dt_save = 1.    # assume output time increament in 1 hour
+
+        # calculate interpolation indeces
+        # convert east longitude to equivalent hours
+        xshif = 24.0*np.asarray(lon)/360.
+        kk = np.where(xshif < 0)
+        xshif[kk] = xshif[kk]+24.
+
+        # Local time difference for all longitudes (first) and output times (last) at once
+        if timex is None:
+            dtt = np.arange(nsteps_out)[np.newaxis, :]*dt_save-xshif[:, np.newaxis] - timeo[0] + dt_samp
+        else:
+            # time_out - xfshif - tod[0] + hrs/stpe in input
+            dtt = np.asarray(timex)[np.newaxis, :] - xshif[:, np.newaxis]
+
+        #      insure that data local time is bounded by [0,24] hours
+        kk = np.where(dtt < 0.)
+        dtt[kk] = dtt[kk] + 24.
+
+        im = np.floor(dtt/dt_samp)  # this is index into the data aray
+        fraction = dtt-im*dt_samp
+        kk = np.where(im < 0.)
+        im[kk] = im[kk] + nsf
+
+        ipa = im + 1.
+        kk = np.where(ipa >= nsf)
+        ipa[kk] = ipa[kk] - nsf
+
+        self.nsteps = nsteps
+        self.nsteps_out = nsteps_out
+        # Indices and weights, size is (lon, nsteps_out)
+        self.imm = np.int32(im) % nsteps
+        self.ipp = np.int32(ipa)
+        self.fraction = fraction / dt_samp  # assume uniform tinc between input data samples
+
+    def apply(self, array):
+        '''
+        Shift one variable to uniform local time.
+        Args:
+            array: variable to be shifted. Longitude is the first dimension and time_of_day is the last dimension
+        Returns:
+            narray: array shifted to uniform local time. The precision of floating point input (e.g. float32) is preserved.
+        '''
+        array = np.asarray(array)
+        dims = np.shape(array)
+        id = dims[0]
+        # Flatten all the dimensions in between to (lon, recl, time_of_day)
+        array = np.reshape(array, (id, -1, self.nsteps))
+
+        frac = self.fraction.astype(np.result_type(array, np.float32))[:, np.newaxis, :]
+        # Now carry out the interpolation for all longitudes and output time levels at once
+        narray = (1.-frac)*np.take_along_axis(array, self.imm[:, np.newaxis, :], axis=2) + \
+            frac*np.take_along_axis(array, self.ipp[:, np.newaxis, :], axis=2)
+
+        return np.reshape(narray, dims[:-1]+(self.nsteps_out,))
+
+
 def tshift(array, lon, timeo, timex=None):
     '''
     Conversion to uniform local time.
@@ -1679,6 +2045,7 @@ def tshift(array, lon, timeo, timex=None):
 
     ***Note***
     If timex is not specified, the file is interpolated on the same time_of_day as the input
+    To shift several variables to the same local times, build a LocalTimeShiftPlan() once and call its apply() method.
     '''
     if np.shape(array) == len(array):
         print('Need longitude and time dimensions')
@@ -1686,19 +2053,8 @@ def tshift(array, lon, timeo, timex=None):
 
     dims = np.shape(array)  # get dimensions of array
     end = len(dims)-1
-    id = dims[0]  # number of longitudes in file
     nsteps = len(timeo)   # number of timesteps per day in input
 
-    nsf = float(nsteps)   # number of timesteps per day in input
-
-    timeo = np.squeeze(timeo)
-
-    # array dimensions for output
-    if timex is None:       # time shift all local times
-        nsteps_out = nsteps
-    else:
-        nsteps_out = len(timex)
-
     # Assuming time is last dimension, check if it is local time timex
     # If not, reshape the array into (stuff, days, local time)
     if dims[end] != nsteps:
@@ -1712,79 +2068,7 @@ def tshift(array, lon, timeo, timex=None):
         newdims[len(dims)] = len(dims)-1
         array = np.transpose(array, newdims)
 
-    dims = np.shape(array)  # get new dims of array if reshaped
-
-    if len(dims) > 2:
-        recl = np.prod(dims[1:len(dims)-1])
-    else:
-        recl = 1
-
-    array = np.reshape(array, (id, recl, nsteps))
-
-    # create output array
-    narray = np.zeros((id, recl, nsteps_out))
-
-    dt_samp = 24.0/nsteps  # Time increment of input data (in hours)
-
-    # time increment of output
-    if timex is None:       # match dimensions of output file to input
-        dt_save = dt_samp  # Time increment of output data (in hours)
-    else:
-        dt_save = 1.    # assume output time increament in 1 hour
-
-    # calculate interpolation indeces
-    # convert east longitude to equivalent hours
-    xshif = 24.0*lon/360.
-    kk = np.where(xshif < 0)
-    xshif[kk] = xshif[kk]+24.
-
-    fraction = np.zeros((id, nsteps_out))
-    imm = np.zeros((id, nsteps_out))
-    ipp = np.zeros((id, nsteps_out))
-
-    for nd in range(nsteps_out):
-        #dtt = nd*dt_save - xshif - timex[0] + dt_samp
-        if timex is None:
-            dtt = nd*dt_save-xshif - timeo[0] + dt_samp
-        else:
-            # time_out - xfshif - tod[0] + hrs/stpe in input
-            dtt = timex[nd] - xshif
-
-        #      insure that data local time is bounded by [0,24] hours
-        kk = np.where(dtt < 0.)
-        dtt[kk] = dtt[kk] + 24.
-
-        im = np.floor(dtt/dt_samp)  # this is index into the data aray
-        fraction[:, nd] = dtt-im*dt_samp
-        kk = np.where(im < 0.)
-        im[kk] = im[kk] + nsf
-
-        ipa = im + 1.
-        kk = np.where(ipa >= nsf)
-        ipa[kk] = ipa[kk] - nsf
-
-        imm[:, nd] = im[:]
-        ipp[:, nd] = ipa[:]
-
-    fraction = fraction / dt_samp  # assume uniform tinc between input data samples
-
-    #           Now carry out the interpolation
-    for nd in range(nsteps_out):  # Number of output time levels
-        for i in range(id):  # Number of longitudes
-            im = np.int32(imm[i, nd]) % 24
-            ipa = np.int32(ipp[i, nd])
-            frac = fraction[i, nd]
-            narray[i, :, nd] = (1.-frac)*array[i, :, im] + \
-                frac*array[i, :, ipa]
-
-    narray = np.squeeze(narray)
-    ndimsfinal = np.zeros(len(dims), dtype=int)
-    for nd in range(end):
-        ndimsfinal[nd] = dims[nd]
-    ndimsfinal[end] = nsteps_out
-    narray = np.reshape(narray, ndimsfinal)
-
-    return narray
+    return LocalTimeShiftPlan(lon, timeo, timex).apply(array)
 
 
 def lin_interp(X_in, X_ref, Y_ref):
@@ -2118,9 +2402,9 @@ def ref_atmosphere_Mars_PTD(Zi):
     '''
     Analytical atmospheric model for Martian pressure, temperature and density,  [Alex Kling, June 2021]
     Args:
-        Zi (float or 1D array): input altitude in m (must be >= 0)
+        Zi (float or ND array): input altitude in m (must be >= 0)
     Return:
-        P,T,D (floats ot 1D arrays): tuple of corresponding pressure [Pa], temperature [K] and density  [kg/m3]
+        P,T,D (floats ot ND arrays): tuple of corresponding pressure [Pa], temperature [K] and density  [kg/m3]
 
     ***NOTE***
 
@@ -2135,6 +2419,9 @@ def ref_atmosphere_Mars_PTD(Zi):
 
     Above ~120km P=P0 exp(-(z-z0)g/rT) is not a good approximation as the fluid is in molecula regime. For those altitude, we  provide
     fit in the form P=P0 exp(-az-bz**2),based on diurnal average of the MCD database at lat 0, Ls 150.
+
+    Each segment is evaluated on the masked array elements with np.piecewise(), for any array shape. The precision of
+    floating point input (e.g. float32) is preserved.
     '''
     # =================================
     # =======Internal functions========
@@ -2190,42 +2477,42 @@ def ref_atmosphere_Mars_PTD(Zi):
         return P0*np.exp(-p1*(Zi-Z0)-p2*(Zi-Z0)**2)
     # The following is a best fit of globally averaged temperature profile from various sources: Legacy GCM, MCS, MCD
 
-    def T_analytic_scalar(Zi):
-        if Zi <= 57000:
-            return alt_to_temp_quad(Zi, Z0=0, T0=225.9, gam=-0.00213479, a=1.44823e-08)
-        elif 57000 < Zi <= 110000:
-            return alt_to_temp_quad(Zi, Z0=57000, T0=151.2, gam=-0.000367444, a=-6.8256e-09)
-        elif 110000 < Zi <= 170000:
-            return alt_to_temp_quad(Zi, Z0=110000, T0=112.6, gam=0.00212537, a=-1.81922e-08)
-        elif 170000 <= Zi:
-            return 174.6
+    def T_analytic(Zi):
+        return np.piecewise(Zi, [Zi <= 57000, (57000 < Zi) & (Zi <= 110000), (110000 < Zi) & (Zi <= 170000), 170000 < Zi],
+                            [lambda Z: alt_to_temp_quad(Z, Z0=0, T0=225.9, gam=-0.00213479, a=1.44823e-08),
+                             lambda Z: alt_to_temp_quad(Z, Z0=57000, T0=151.2, gam=-0.000367444, a=-6.8256e-09),
+                             lambda Z: alt_to_temp_quad(Z, Z0=110000, T0=112.6, gam=0.00212537, a=-1.81922e-08),
+                             174.6, np.NaN])
     # Analytical solution for the pressure derived from the temperature profile
 
-    def P_analytic_scalar(Zi):
-        if Zi <= 57000:
-            return alt_to_press_quad(Zi, Z0=0, P0=610, T0=225.9, gam=-0.00213479, a=1.44823e-08, rgas=192, g=3.72)
-        elif 57000 < Zi <= 110000:
-            return alt_to_press_quad(Zi, Z0=57000, P0=1.2415639872674782, T0=151.2, gam=-0.000367444, a=-6.8256e-09, rgas=192, g=3.72)
-        # The following must be discarded above 120 km when we enter the molecular regime
-        elif 110000 < Zi <= 120000:
-            return alt_to_press_quad(Zi, Z0=110000, P0=0.0005866878792825923, T0=112.6, gam=0.00212537, a=-1.81922e-08, rgas=192, g=3.72)
-        elif 120000 <= Zi:
-            return P_mars_120_300(Zi)
+    def P_analytic(Zi):
+        return np.piecewise(Zi, [Zi <= 57000, (57000 < Zi) & (Zi <= 110000), (110000 < Zi) & (Zi <= 120000), 120000 < Zi],
+                            [lambda Z: alt_to_press_quad(Z, Z0=0, P0=610, T0=225.9, gam=-0.00213479, a=1.44823e-08, rgas=192, g=3.72),
+                             lambda Z: alt_to_press_quad(Z, Z0=57000, P0=1.2415639872674782, T0=151.2, gam=-0.000367444, a=-6.8256e-09, rgas=192, g=3.72),
+                             # The following must be discarded above 120 km when we enter the molecular regime
+                             lambda Z: alt_to_press_quad(Z, Z0=110000, P0=0.0005866878792825923, T0=112.6, gam=0.00212537, a=-1.81922e-08, rgas=192, g=3.72),
+                             P_mars_120_300, np.NaN])
 
-    # Vectorize array as needed:
-    if len(np.atleast_1d(Zi)) > 1:
-        P_analytic_scalar = np.vectorize(P_analytic_scalar)
-        T_analytic_scalar = np.vectorize(T_analytic_scalar)
-    return P_analytic_scalar(Zi), T_analytic_scalar(Zi),  P_analytic_scalar(Zi)/(192*T_analytic_scalar(Zi))
+    # Integers are converted to float, the precision of floating point input is preserved
+    Zi = np.asarray(Zi)
+    if not np.issubdtype(Zi.dtype, np.floating):
+        Zi = Zi.astype(float)
+    P = P_analytic(Zi)
+    T = T_analytic(Zi)
+    # Return floats for scalar input
+    return P[()], T[()], (P/(192*T))[()]
 
 
 def press_to_alt_atmosphere_Mars(Pi):
     '''
     Return the altitude in m as a function of pressure from the analytical calculations derived above.
     Args:
-        Pi (float or 1D array): input pressure in Pa (must be <=610 Pa)
+        Pi (float or ND array): input pressure in Pa (must be <=610 Pa)
     Return:
-        Z (float ot 1D array): corresponding altitude in m
+        Z (float ot ND array): corresponding altitude in m
+    ***NOTE***
+    Each segment is evaluated on the masked array elements with np.piecewise(), for any array shape. The precision of
+    floating point input (e.g. float32) is preserved.
     '''
     # =================================
     # =======Internal functions========
@@ -2266,24 +2553,28 @@ def press_to_alt_atmosphere_Mars(Pi):
         delta = p1**2-4*p2*np.log(P/P0)  # delta >0 on this pressure interval
         return (-p1+np.sqrt(delta))/(2*p2) + Z0
 
-    def alt_analytic_scalar(Pi):
+    def alt_analytic(Pi):
         '''
         Analytical solution for altitude as a function of pressure.
         '''
-        if Pi >= 610:
-            return 0.
-        elif 610 > Pi >= 1.2415639872674782:  # This is the pressure from alt_to_press_quad at 57000. m
-            return press_to_alt_quad(Pi, Z0=0, P0=610, T0=225.9, gam=-0.00213479, a=1.44823e-08, rgas=192, g=3.72)
-        elif 1.2415639872674782 > Pi >= 0.0005866878792825923:  # 57000 to 110000m
-            return press_to_alt_quad(Pi, Z0=57000, P0=1.2415639872674782, T0=151.2, gam=-0.000367444, a=-6.8256e-09, rgas=192, g=3.72)
-        elif 0.0005866878792825923 > Pi >= 0.00012043158397922564:  # 110000m to 120000 m
-            return press_to_alt_quad(Pi, Z0=110000, P0=0.0005866878792825923, T0=112.6, gam=0.00212537, a=-1.81922e-08, rgas=192, g=3.72)
-        elif 0.00012043158397922564 > Pi:  # 120000m to 300000
-            return press_to_alt_mars_120_300(Pi, Z0=120000., P0=0.00012043158397922564, p1=1.09019694e-04, p2=-3.37385416e-10)
-
-    if len(np.atleast_1d(Pi)) > 1:
-        alt_analytic_scalar = np.vectorize(alt_analytic_scalar)
-    return alt_analytic_scalar(Pi)
+        return np.piecewise(Pi, [Pi >= 610,
+                                 (610 > Pi) & (Pi >= 1.2415639872674782),  # This is the pressure from alt_to_press_quad at 57000. m
+                                 (1.2415639872674782 > Pi) & (Pi >= 0.0005866878792825923),  # 57000 to 110000m
+                                 (0.0005866878792825923 > Pi) & (Pi >= 0.00012043158397922564),  # 110000m to 120000 m
+                                 0.00012043158397922564 > Pi],  # 120000m to 300000
+                            [0.,
+                             lambda P: press_to_alt_quad(P, Z0=0, P0=610, T0=225.9, gam=-0.00213479, a=1.44823e-08, rgas=192, g=3.72),
+                             lambda P: press_to_alt_quad(P, Z0=57000, P0=1.2415639872674782, T0=151.2, gam=-0.000367444, a=-6.8256e-09, rgas=192, g=3.72),
+                             lambda P: press_to_alt_quad(P, Z0=110000, P0=0.0005866878792825923, T0=112.6, gam=0.00212537, a=-1.81922e-08, rgas=192, g=3.72),
+                             lambda P: press_to_alt_mars_120_300(P, Z0=120000., P0=0.00012043158397922564, p1=1.09019694e-04, p2=-3.37385416e-10),
+                             np.NaN])
+
+    # Integers are converted to float, the precision of floating point input is preserved
+    Pi = np.asarray(Pi)
+    if not np.issubdtype(Pi.dtype, np.floating):
+        Pi = Pi.astype(float)
+    # Return a float for scalar input
+    return alt_analytic(Pi)[()]
 
 
 # ==================================Projections==================================
@@ -2460,7 +2751,7 @@ def sol2ls(jld, cummulative=False):
     zero_date = 488.  # time of perihelion passage
     equinox = 180  # day of northern equinox:  (for 668 sol year)
     small_value = 1.0e-7
-    pi = np.math.pi
+    pi = np.pi
     degrad = pi/180.0
 
     # if jld is a scalar, reshape as a 1-element arra
@@ -2473,15 +2764,13 @@ def sol2ls(jld, cummulative=False):
         '''
         Based on Tanguys' aerols.py
         Also useful link: http://www.jgiesen.de/kepler/kepler.html
+        The Kepler equation is solved for all the elements at once, until the largest correction is below 'small_value'
         '''
         # Specify orbit eccentricity and angle of planets's inclination
 
         ec = .093  # orbit eccentricity
         er = ((1.0+ec)/(1.0-ec))**0.5
 
-        # Initialize working arrays
-        w, rad, als, areols, MY = [np.zeros_like(jld) for _ in range(0, 5)]
-
         # date= days since last perihelion passage
         date = jld - zero_date
 
@@ -2491,23 +2780,22 @@ def sol2ls(jld, cummulative=False):
         e = 1.0
         diff = 1.0
         while (diff > small_value):
-            ep = e - (e-ec*np.math.sin(e)-qq) / (1.0-ec*np.cos(e))
+            ep = e - (e-ec*np.sin(e)-qq) / (1.0-ec*np.cos(e))
             diff = abs(ep-e)
             e = ep
 
-        eq1 = 2.0 * np.math.atan(er * np.math.tan(0.5*e))
+        eq1 = 2.0 * np.arctan(er * np.tan(0.5*e))
 
         # determine true anomaly at current date:  w
 
-        for i in range(0, len(jld)):
-            e = 1.0
-            diff = 1.0
-            em = 2. * pi * date[i] / year
-            while (diff > small_value):
-                ep = e - (e - ec * np.sin(e) - em) / (1.0 - ec * np.cos(e))
-                diff = abs(ep-e)
-                e = ep
-            w[i] = 2.0 * np.math.atan(er * np.math.tan(0.5*e))
+        e = np.ones_like(date)
+        diff = 1.0
+        em = 2. * pi * date / year
+        while (diff > small_value):
+            ep = e - (e - ec * np.sin(e) - em) / (1.0 - ec * np.cos(e))
+            diff = np.max(np.abs(ep-e), initial=0.)
+            e = ep
+        w = 2.0 * np.arctan(er * np.tan(0.5*e))
 
         als = w - eq1  # Aerocentric Longitude
         areols = als/degrad
@@ -2527,7 +2815,6 @@ def sol2ls(jld, cummulative=False):
         For those edges cases where Ls is close to 359.9, the routine calculate again the Ls at a later time (say 1 sols) to check for outlier points.
         '''
         # Calculate cummulative Ls using sol2ls function() and adding +360 for every mars year
-        areols, MY = [np.zeros_like(jld) for _ in range(0, 2)]
         date = jld - zero_date
         MY = (date-equinox)//(year)+1  # MY=(date-equinox)//(year)
         Ls_mod = sol2ls_mod(jld)
@@ -2537,19 +2824,17 @@ def sol2ls(jld, cummulative=False):
         # The [0] turns tuple from np.where into a list
         index = np.where(Ls_mod >= 359.9)[0]
 
-        for ii in index:
-            jld_plus1 = jld[ii] + \
-                1.  # compute Ls one day after (arbitrary length)
-            Ls_plus1 = sol2ls(jld_plus1)
-            date_plus1 = jld_plus1 - zero_date
-            MY_plus1 = (date_plus1-equinox)//(668.)+1  # Compute MY
-            Ls_cum_plus1 = Ls_plus1+MY_plus1 * \
-                360.  # Cummulative Ls 1 day after.
-            # If things are smooth the Ls should go from [359>361]. If it reads [359>721], we need to update the MY for those indices
-            # difference between two consecutive Ls, should be small unless Ls_cum was too big at the first place
-            diff = Ls_cum_plus1-Ls_cum[ii]
-            if diff < 0:
-                MY[ii] -= 1
+        jld_plus1 = jld[index] + \
+            1.  # compute Ls one day after (arbitrary length)
+        Ls_plus1 = sol2ls_mod(jld_plus1)
+        date_plus1 = jld_plus1 - zero_date
+        MY_plus1 = (date_plus1-equinox)//(668.)+1  # Compute MY
+        Ls_cum_plus1 = Ls_plus1+MY_plus1 * \
+            360.  # Cummulative Ls 1 day after.
+        # If things are smooth the Ls should go from [359>361]. If it reads [359>721], we need to update the MY for those indices
+        # difference between two consecutive Ls, should be small unless Ls_cum was too big at the first place
+        diff = Ls_cum_plus1-Ls_cum[index]
+        MY[index[diff < 0]] -= 1
         # Recompute one more more time with updated MY
         Ls_cum = Ls_mod+MY*360.
         return Ls_cum
@@ -2561,6 +2846,10 @@ def sol2ls(jld, cummulative=False):
 
 
 
+# Lookup table for ls2sol(), computed on the first call
+ls2sol_table = dict()
+
+
 def ls2sol(Ls_in):
     '''
     Ls to sol converter.
@@ -2569,22 +2858,28 @@ def ls2sol(Ls_in):
     Return:
         sol: the corresponding sol number
     ***NOTE***
-    This function simply uses a numerical solver on the sol2ls() function.
-    '''
-    #===Internal functions======
-    from scipy import optimize
-    def internal_func(Ls_in):
-        func_int = lambda x: sol2ls(x,cummulative=True)
-        errfunc = lambda x, y: func_int(x) - y # Distance to the target function
-        p0 = [0.] # Initial guess for the parameters
-        p1, success = optimize.leastsq(errfunc, p0[:], args=(Ls_in))
-        return  p1
-    Ls_in=np.array(Ls_in)
-    #=============================
-    if len(np.atleast_1d(Ls_in))==1:
-        return internal_func(Ls_in)[0]
+    The cummulative sol2ls() is tabulated once over one Mars year (sol 0 is the spring equinox) and inverted for all
+    the values at once using a linear interpolation, followed by one Newton step on sol2ls() to recover the accuracy of a numerical solver.
+    '''
+    year = 668.
+    if not ls2sol_table:
+        sol_tab = np.linspace(0., year, 6681)
+        Ls_tab = sol2ls(sol_tab, cummulative=True)
+        ls2sol_table['sol'] = sol_tab
+        ls2sol_table['Ls'] = Ls_tab
+        ls2sol_table['dLs_dsol'] = np.gradient(Ls_tab, sol_tab)
+
+    Ls_in = np.atleast_1d(np.array(Ls_in, dtype=float))
+    # Number of full Mars years and Ls within the year
+    MY = Ls_in//360.
+    Ls_year = Ls_in-MY*360.
+
+    sol = np.interp(Ls_year, ls2sol_table['Ls'], ls2sol_table['sol'])+MY*year
+    dLs_dsol = np.interp(Ls_year, ls2sol_table['Ls'], ls2sol_table['dLs_dsol'])
+    # Newton step
+    sol = sol-(sol2ls(sol, cummulative=True)-Ls_in)/dLs_dsol
+
+    if len(Ls_in) == 1:
+        return sol[0]
     else:
-        sol_all=[]
-        for ii in Ls_in:
-            sol_all.append(internal_func(ii)[0])
-        return   sol_all
+        return sol
@@ -4,6 +4,97 @@ from scipy.io import FortranFile
 from amescap.FV3_utils import daily_to_average, daily_to_diurn
 import os
 
+#=========================================================================
+#=============Encoding options for the netcdf variables===================
+#=========================================================================
+
+#Default encoding of the variables created by Ncdf and the CAP utilities, updated with set_nc_defaults()
+#   complevel : zlib compression level, 0 for no compression, 1 (fastest) to 9 (smallest)
+#   shuffle   : if True, apply the HDF5 shuffle filter before the compression
+#   chunks    : None for the netcdf library defaults, or a dictionary {dimension:chunk size}, e.g. {'time':1}.
+#               Dimensions not in the dictionary are chunked with their full size (1 for an unlimited dimension)
+#   least_significant_digit: if provided, quantize the data to that power of ten before the compression
+#   dtype     : data type on disk, e.g. 'f4', None to preserve the type of the data
+NC_DEFAULTS={'complevel':0,'shuffle':True,'chunks':None,'least_significant_digit':None,'dtype':'f4'}
+
+def set_nc_defaults(**kwargs):
+    '''
+    Update the default encoding of the netcdf variables, e.g. set_nc_defaults(complevel=4,chunks={'time':1}). See NC_DEFAULTS.
+    '''
+    for key in kwargs.keys():
+        if key not in NC_DEFAULTS.keys():raise KeyError("Unknown netcdf encoding option '%s'"%(key))
+    NC_DEFAULTS.update(kwargs)
+
+def parse_nc_chunks(chunks_list):
+    '''
+    Convert the chunks provided on the command line into a dictionary
+    Args:
+        chunks_list: list of strings, e.g. ['time=1','pfull=4']
+    Returns:
+        chunks: dictionary, e.g. {'time':1,'pfull':4} or None if chunks_list is empty
+    '''
+    if not chunks_list:return None
+    chunks={}
+    for item in chunks_list:
+        for txt in item.split(','):
+            if '=' not in txt:raise ValueError("chunks should be provided as dimension=size, e.g. time=1, got '%s'"%(txt))
+            dim_name,size=txt.split('=')
+            chunks[dim_name.strip()]=int(size)
+    return chunks
+
+def nc_variable_kwargs(Ncfile,dim_array,encoding=None):
+    '''
+    Return the keyword arguments for netCDF4.Dataset.createVariable() for the requested encoding.
+    Args:
+        Ncfile   : the netCDF4.Dataset in which the variable is created
+        dim_array: the dimensions of the variable, e.g. ('time','lat','lon')
+        encoding : (optional) dictionary to override the defaults (NC_DEFAULTS) for that variable
+    Returns:
+        kwargs: dictionary, e.g. {'zlib':True,'complevel':4,'shuffle':True,'chunksizes':[1,48,96]}
+    '''
+    options=dict(NC_DEFAULTS)
+    if encoding:options.update(encoding)
+    if type(dim_array)==str:dim_array=(dim_array,)
+
+    kwargs={}
+    if options['complevel']:
+        kwargs['zlib']=True
+        kwargs['complevel']=options['complevel']
+        kwargs['shuffle']=options['shuffle']
+    if options['least_significant_digit'] is not None:
+        kwargs['least_significant_digit']=options['least_significant_digit']
+    if options['chunks'] and len(dim_array)>0:
+        chunksizes=[]
+        for dim_name in dim_array:
+            dim=Ncfile.dimensions[dim_name]
+            if dim.isunlimited():
+                size=options['chunks'].get(dim_name,1)
+            else:
+                size=min(options['chunks'].get(dim_name,dim.size),dim.size)
+            chunksizes.append(max(size,1))
+        kwargs['chunksizes']=chunksizes
+    return kwargs
+
+def nc_dtype(data_dtype=None,encoding=None,ncformat='NETCDF4_CLASSIC'):
+    '''
+    Return the data type on disk for a variable
+    Args:
+        data_dtype: the type of the data to write, used if the dtype is None (preserve)
+        encoding  : (optional) dictionary to override the defaults (NC_DEFAULTS) for that variable
+        ncformat  : the format of the file, the classic model does not support 64-bit integers
+    Returns:
+        dtype: a string, e.g. 'f4'
+    '''
+    dtype=NC_DEFAULTS['dtype']
+    if encoding and 'dtype' in encoding.keys():dtype=encoding['dtype']
+    if dtype is None:
+        if data_dtype is None:return 'f4'
+        data_dtype=np.dtype(data_dtype)
+        if data_dtype.kind=='b':return 'i1'
+        if data_dtype.kind in ['i','u'] and (data_dtype.itemsize==8 or data_dtype.kind=='u') and 'CLASSIC' in ncformat:return 'i4'
+        return data_dtype.str[1:]
+    return dtype
+
 #=========================================================================
 #=============Wrapper for creation of netcdf files========================
 #=========================================================================
@@ -36,9 +127,12 @@ class Ncdf(object):
 
     Log.close()
 
-
+    ***NOTE***
+    The variables are compressed, chunked and typed according to NC_DEFAULTS (see set_nc_defaults()). Those can be
+    overridden for all the variables of the file with encoding, e.g.  Log=Ncdf(filename,encoding={'complevel':4})
+    or for one variable, e.g.  Log.log_variable('TG',TG,('time','Nx'),'soil temperature','K',encoding={'chunks':{'time':1}})
     '''
-    def __init__(self,filename=None,description_txt="",action='w',ncformat='NETCDF4_CLASSIC'):
+    def __init__(self,filename=None,description_txt="",action='w',ncformat='NETCDF4_CLASSIC',encoding=None):
         if filename:
             if filename[-3:]!=".nc":
             #assume that only path is provided so make a name for the file
@@ -52,15 +146,17 @@ class Ncdf(object):
             filename=pathname+\
             'run_%02d-%02d-%04d_%i-%i-%i.nc'%(now.day,now.month,now.year,now.hour,now.minute,now.second)
         self.filename=filename
+        self.ncformat=ncformat
+        self.encoding=encoding
         from netCDF4 import Dataset
         if action=='w':
             self.f_Ncdf = Dataset(filename, 'w', format=ncformat)
             self.f_Ncdf.description = description_txt
         elif action=='a': #append to file
             self.f_Ncdf = Dataset(filename, 'a', format=ncformat)
-        #create dictionaries to hold dimensions and variables
-        self.dim_dict=dict()
-        self.var_dict=dict()
+        #create dictionaries to hold dimensions and variables, including those already in the file when appending
+        self.dim_dict=dict(self.f_Ncdf.dimensions)
+        self.var_dict=dict(self.f_Ncdf.variables)
         #print(filename+ " was created")
 
     def close(self):
@@ -81,8 +177,12 @@ class Ncdf(object):
         self._def_variable(variable_name,('constant'),longname_txt,units_txt)
         self.var_dict[variable_name][:]=value
     #=====Private definitions=====
-    def _def_variable(self,variable_name,dim_array,longname_txt="",units_txt=""):
-        self.var_dict[variable_name]= self.f_Ncdf.createVariable(variable_name,'f4',dim_array)
+    def _def_variable(self,variable_name,dim_array,longname_txt="",units_txt="",data_dtype=None,encoding=None):
+        #Per-variable encoding takes precedence over the file encoding, which takes precedence over NC_DEFAULTS
+        var_encoding=dict(self.encoding) if self.encoding else {}
+        if encoding:var_encoding.update(encoding)
+        dtype=nc_dtype(data_dtype,var_encoding,self.ncformat)
+        self.var_dict[variable_name]= self.f_Ncdf.createVariable(variable_name,dtype,dim_array,**nc_variable_kwargs(self.f_Ncdf,dim_array,var_encoding))
         self.var_dict[variable_name].units=units_txt
         self.var_dict[variable_name].long_name=longname_txt
         self.var_dict[variable_name].dim_name=str(dim_array)
@@ -110,13 +210,36 @@ class Ncdf(object):
         return cart_axis
     #================================
     #Example: Log.log_variable('TG',TG,('time','Nx'),'soil temperature','K')
-    def log_variable(self,variable_name,DATAin,dim_array,longname_txt="",units_txt=""):
+    #If index is provided, only that block of the variable is written, e.g. index=(slice(None),slice(0,4))
+    #If encoding is provided, it overrides the file encoding for that variable, e.g. encoding={'complevel':4,'dtype':'f8'}
+    def log_variable(self,variable_name,DATAin,dim_array,longname_txt="",units_txt="",index=None,encoding=None):
         if variable_name not in self.var_dict.keys():
-            self._def_variable(variable_name,dim_array,longname_txt,units_txt)
+            self._def_variable(variable_name,dim_array,longname_txt,units_txt,getattr(DATAin,'dtype',None),encoding)
         self.var_dict[variable_name].long_name=longname_txt
         self.var_dict[variable_name].dim_name=str(dim_array)
         self.var_dict[variable_name].units=units_txt
-        self.var_dict[variable_name][:]=DATAin
+        if index is None:
+            self.var_dict[variable_name][:]=DATAin
+        else:
+            self.var_dict[variable_name][index]=DATAin
+
+    #Example: for it in range(0,Nt,10): Log.log_variable_slab('TG',TG[it:it+10],('time','Nx'),slice(it,it+10),'soil temperature','K')
+    #Write one slab of a variable along its first (time) dimension, so that the variable never needs to be in memory at once.
+    #The variable is created with the first slab, as well as the (unlimited) time dimension if it is not yet defined.
+    #time_slice may be a slice, the index of the first timestep of the slab, or None to append the slab at the current end of
+    #the time dimension. As the time dimension is shared, that end may already be past the last slab of that variable.
+    def log_variable_slab(self,variable_name,DATAin,dim_array,time_slice=None,longname_txt="",units_txt="",encoding=None):
+        if type(dim_array)==str:dim_array=(dim_array,)
+        if dim_array[0] not in self.dim_dict.keys():self.add_dimension(dim_array[0],None)
+        if variable_name not in self.var_dict.keys():
+            self._def_variable(variable_name,dim_array,longname_txt,units_txt,getattr(DATAin,'dtype',None),encoding)
+            self.var_dict[variable_name].long_name=longname_txt
+            self.var_dict[variable_name].dim_name=str(dim_array)
+            self.var_dict[variable_name].units=units_txt
+        Ncvar=self.var_dict[variable_name]
+        if time_slice is None:time_slice=Ncvar.shape[0]
+        if not isinstance(time_slice,slice):time_slice=slice(time_slice,time_slice+len(DATAin))
+        Ncvar[time_slice,...]=DATAin
 
     #Example: Log.log_axis1D('areo',areo,'time','degree','T')
     def log_axis1D(self,variable_name,DATAin,dim_name,longname_txt="",units_txt="",cart_txt=""):
@@ -163,7 +286,7 @@ class Ncdf(object):
             dim_array=Ncvar.dimensions
             longname_txt=getattr(Ncvar,'long_name',Ncvar._name)
             units_txt=    getattr(Ncvar,'units','')
-            self._def_variable(Ncvar._name,Ncvar.dimensions,longname_txt,units_txt)
+            self._def_variable(Ncvar._name,Ncvar.dimensions,longname_txt,units_txt,Ncvar.dtype)
             if np.any(swap_array):
                 self.log_variable(Ncvar._name,swap_array[:],Ncvar.dimensions,longname_txt,units_txt)
             else:
@@ -219,6 +342,9 @@ class Fort(object):
 
     PUBLIC METHODS:
     >> f.write_to_fixed(), f.write_to_average()  f.write_to_daily()  and f.write_to_diurn() can be used to generate FV3-like netcdf files
+
+    With f=Fort(filename,lazy=True), the 2D and 3D time-varying variables are not read in memory but are
+    views on the memory-mapped file, e.g. f.variables['temp'][0:16] only reads the first 16 timesteps of 'temp'
     '''
 
     #===Inner class for fortran_variables (Fort_var) that make up the Fort file===
@@ -243,9 +369,58 @@ class Fort(object):
             self.dimensions=dimensions_tuple
 
 
-    #==== End of inner class===
+    #===Inner class for the lazy (memory-mapped) fortran variables===
+    class Fort_lazy_var(object):
+        '''
+        Netcdf-like variable for a time-varying field of a fort.11 file, backed by a strided view on the memory-mapped file.
+        Data is only read from disk when the variable is indexed, e.g. f.variables['temp'][t0:t1], so that only the bytes of
+        the requested timesteps are accessed. The scaling and the pole correction are applied on the fly.
+        Args:
+            view        : strided array on the memory-mapped file, e.g. [time,lev,lat,lon]
+            scaling     : (optional) multiplicative factor, e.g. 100 to convert the surface pressure from mbar to Pa
+            name_txt, long_name_txt, units_txt, dimensions_tuple: same as Fort_var
+        '''
+
+        def __init__(self,view,name_txt,long_name_txt,units_txt,dimensions_tuple,scaling=None):
+            self._view=view
+            self._scaling=scaling
+            self.name = name_txt
+            self.long_name = long_name_txt
+            self.units= units_txt
+            self.dimensions=dimensions_tuple
+            self.shape=view.shape
+            self.ndim=view.ndim
+            self.dtype=view.dtype
+
+        def __len__(self):
+            return self.shape[0]
+
+        def __getitem__(self,key):
+            #Split the index between the time dimension and the other dimensions
+            if type(key)!=tuple:key=(key,)
+            key_time,key_rest=key[0],key[1:]
+            #Ellipsis, e.g. [...,0]: read all the timesteps and apply the full index
+            if key_time is Ellipsis:key_time,key_rest=slice(None),key
 
-    def __init__(self,filename=None,description_txt=""):
+            #Copy the requested timesteps from the file
+            Rec=np.array(self._view[key_time])
+            if self._scaling:Rec*=self._scaling
+
+            #Set to pole point to value at N-1
+            Rec[...,-1,:]=Rec[...,-2,:]
+
+            #Apply the index on the other dimensions, if any
+            if key_rest:
+                if Rec.ndim==self.ndim and key_rest[0] is not Ellipsis:key_rest=(slice(None),)+key_rest
+                Rec=Rec[key_rest]
+            return Rec
+
+        def __array__(self,dtype=None):
+            return self[:] if dtype is None else self[:].astype(dtype)
+
+    #==== End of inner classes===
+
+    def __init__(self,filename=None,description_txt="",lazy=False):
         from scipy.io import FortranFile
         self.filename=filename
         self.path,self.name=os.path.split(filename)
@@ -263,6 +438,7 @@ class Fort(object):
         self.tod_name=tod_name='time_of_day_%02d'%(self.nperday)
         self.tod=np.arange(0.5*24/self.nperday,24,24/self.nperday)  # i.e np.arange(0.75,24,1.5) every 1.5 hours, centered at half timestep =0.75
 
+        self.lazy=lazy
         self.dimensions={} #Initialize dictionary
         self.variables={} #Initialize dictionary
 
@@ -282,103 +458,101 @@ class Fort(object):
         '''
         Create 'fixed' file, i.e.  all static variables
         '''
-
-        Log=Ncdf(self.path+'/'+self.fdate+'.fixed.nc')
-
-        #Define dimensions
-        for ivar in ['lat','lon','pfull','phalf','zgrid']:
-            if ivar =='lon':cart_ax='X'
-            if ivar =='lat':cart_ax='Y'
-            if ivar in ['pfull' ,'phalf','zgrid']:cart_ax='Z'
-            fort_var=self.variables[ivar]
-            Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
-
-        #Log static variables
-        for ivar in self.variables.keys():
-            if 'time' not in self.variables[ivar].dimensions:
-                fort_var=self.variables[ivar]
-                Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-        Log.close()
+        self.write_to_files(['fixed'])
 
     def write_to_daily(self):
         '''
         Create daily file, e.g. contineuous time serie
         '''
-        Log=Ncdf(self.path+'/'+self.fdate+'.atmos_daily.nc')
-
-        #Define dimensions
-        for ivar in ['lat','lon','pfull','phalf','zgrid']:
-            if ivar =='lon':cart_ax='X'
-            if ivar =='lat':cart_ax='Y'
-            if ivar in ['pfull' ,'phalf','zgrid']:cart_ax='Z'
-            fort_var=self.variables[ivar]
-            Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
-
-        #Add scalar_axis dimension (size 1, only used with areo)
-        Log.add_dimension('scalar_axis',1)
-
-        #Add aggregation dimension (None size for unlimited)
-        Log.add_dimension('time',None)
-        fort_var=self.variables['time']
-        Log.log_axis1D(variable_name='time',DATAin=fort_var,dim_name='time',longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt='T')
-
-        #Special case for the solar longitude (areo): needs to be interpolated linearly every 16 timesteps
-        ivar='areo';fort_var=self.variables[ivar]
-        var_out=self._linInterpLs(np.squeeze(fort_var[:]),16).reshape([len(fort_var),1]) #areo is reshaped as [time,scalar_axis]=[160,1]
-        Log.log_variable(variable_name=ivar,DATAin=var_out,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-
-        #Log dynamic variables, as well as pk, bk
-        for ivar in self.variables.keys():
-            if 'time' in self.variables[ivar].dimensions and ivar!='areo' or ivar in ['pk','bk']:
-                fort_var=self.variables[ivar]
-                Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-        Log.close()
+        self.write_to_files(['daily'])
 
     def write_to_average(self,day_average=5):
         '''
         Create average file, e.g. N day averages (typically 5)
         '''
-        Log=Ncdf(self.path+'/'+self.fdate+'.atmos_average.nc')
-        #Define dimensions
-        for ivar in ['lat','lon','pfull','phalf','zgrid']:
-            if ivar =='lon':cart_ax='X'
-            if ivar =='lat':cart_ax='Y'
-            if ivar in ['pfull' ,'phalf','zgrid']:cart_ax='Z'
-            fort_var=self.variables[ivar]
-            Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
+        self.write_to_files(['average'],day_average)
 
-        #Add scalar_axis dimension (size 1, only used with areo)
-        Log.add_dimension('scalar_axis',1)
+    def write_to_diurn(self,day_average=5):
+        '''
+        Create diurn file, e.g.variable are organized by time of day. Additionally, the data is also binned  (typically 5)
+        '''
+        self.write_to_files(['diurn'],day_average)
 
-        #Add aggregation dimension (None size for unlimited)
-        Log.add_dimension('time',None)
+    def write_to_files(self,file_types=['fixed','average','daily','diurn'],day_average=5):
+        '''
+        Create the requested FV3-like files in a single pass over the variables.
+        Args:
+            file_types : list of the files to create, any of 'fixed', 'average', 'daily' and 'diurn'
+            day_average: binning period in sols for the average and diurn files (typically 5)
+        ***NOTE***
+        Each time-varying variable is read once and written to all the requested files. When both the average and
+        diurn files are requested, the average is obtained from the diurn composite (the mean over the time of day of
+        the N day bins is the N day average) so there is only one binning pass per variable.
+        '''
+        Logs={}
+        for file_type in ['fixed','average','daily','diurn']:
+            if file_type in file_types:Logs[file_type]=self._open_file(file_type,day_average)
 
-        #Perform day average and log new time axis
         time_in=self.variables['time']
-        time_out=daily_to_average(varIN=fort_var,dt_in=time_in[1]-time_in[0],nday=day_average,trim=True)
-        Log.log_axis1D(variable_name='time',DATAin=time_out,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
 
-        #Log static variables
-        for ivar in ['pk','bk']:
-            fort_var=self.variables[ivar]
-            Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
-
-        #Log dynamic variables
+        #Loop over all variables in file
         for ivar in self.variables.keys():
-            if 'time' in self.variables[ivar].dimensions:
-                fort_var=self.variables[ivar]
-                var_out=daily_to_average(fort_var,time_in[1]-time_in[0],nday=day_average,trim=True)
-                Log.log_variable(variable_name=ivar,DATAin=var_out,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
+            fort_var=self.variables[ivar]
 
-        Log.close()
+            #Log static variables, as well as pk, bk in the daily file
+            if 'time' not in fort_var.dimensions:
+                if 'fixed' in Logs:
+                    Logs['fixed'].log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
+                if 'daily' in Logs and ivar in ['pk','bk']:
+                    Logs['daily'].log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
+                continue
+            if not ('average' in Logs or 'daily' in Logs or 'diurn' in Logs):continue
+
+            #Read the variable only once
+            var_in=fort_var[:]
+
+            #Diurn file: bin by time of day and over day_average sols.
+            var_diurn=None
+            if 'diurn' in Logs and ivar!='time':
+                dims_in=fort_var.dimensions
+                if type(dims_in)==str: #dimensions has 'time' only, it is a string
+                    dims_out=(dims_in,)+(self.tod_name,)
+                else: #dimensions is a tuple, e.g. ('time','lat','lon')
+                    dims_out=(dims_in[0],)+(self.tod_name,)+dims_in[1:]
+
+                var_diurn=daily_to_diurn(var_in,time_in[0:self.nperday])
+                if day_average!=1:var_diurn=daily_to_average(var_diurn,1.,day_average) #dt is 1 sol between two diurn timestep
+                Logs['diurn'].log_variable(ivar,var_diurn,dims_out,fort_var.long_name,fort_var.units)
+
+            #Average file: reuse the diurn composite if available
+            if 'average' in Logs:
+                if var_diurn is not None:
+                    var_out=np.mean(var_diurn,axis=1)
+                else:
+                    var_out=daily_to_average(var_in,time_in[1]-time_in[0],nday=day_average,trim=True)
+                Logs['average'].log_variable(variable_name=ivar,DATAin=var_out,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
 
+            #Daily file: copy the time serie. areo was already logged by _open_file()
+            if 'daily' in Logs and ivar!='areo':
+                Logs['daily'].log_variable(variable_name=ivar,DATAin=var_in,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
 
+        for file_type in Logs.keys():Logs[file_type].close()
 
-    def write_to_diurn(self,day_average=5):
+    def _open_file(self,file_type,day_average=5):
         '''
-        Create diurn file, e.g.variable are organized by time of day. Additionally, the data is also binned  (typically 5)
+        Create a FV3-like file with its dimensions, time axis and the variables that do not follow the general case
+        (pk and bk, areo in the daily file). Used by write_to_files().
+        Args:
+            file_type  : 'fixed', 'average', 'daily' or 'diurn'
+            day_average: binning period in sols for the average and diurn files
+        Return:
+            Log: the Ncdf object
         '''
-        Log=Ncdf(self.path+'/'+self.fdate+'.atmos_diurn.nc')
+        if file_type=='fixed':
+            Log=Ncdf(self.path+'/'+self.fdate+'.fixed.nc')
+        else:
+            Log=Ncdf(self.path+'/'+self.fdate+'.atmos_%s.nc'%(file_type))
+
         #Define dimensions
         for ivar in ['lat','lon','pfull','phalf','zgrid']:
             if ivar =='lon':cart_ax='X'
@@ -387,47 +561,44 @@ class Fort(object):
             fort_var=self.variables[ivar]
             Log.add_dim_with_content(dimension_name=ivar,DATAin=fort_var,longname_txt=fort_var.long_name,units_txt=fort_var.units,cart_txt=cart_ax)
 
+        if file_type=='fixed':return Log
+
         #Add scalar_axis dimension (size 1, only used with areo)
         Log.add_dimension('scalar_axis',1)
 
         #Add time_of_day dimensions
-        Log.add_dim_with_content(dimension_name=self.tod_name,DATAin=self.tod,longname_txt='time of day',units_txt='hours since 0000-00-00 00:00:00',cart_txt='N')
+        if file_type=='diurn':
+            Log.add_dim_with_content(dimension_name=self.tod_name,DATAin=self.tod,longname_txt='time of day',units_txt='hours since 0000-00-00 00:00:00',cart_txt='N')
 
         #Add aggregation dimension (None size for unlimited)
         Log.add_dimension('time',None)
 
-        #Perform day average and log new time axis
         time_in=self.variables['time']
-        time_out=daily_to_average(varIN=time_in,dt_in=time_in[1]-time_in[0],nday=day_average,trim=True)
-        Log.log_axis1D(variable_name='time',DATAin=time_out,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
+        if file_type=='daily':
+            Log.log_axis1D(variable_name='time',DATAin=time_in,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
 
-        #Log static variables
-        for ivar in ['pk','bk']:
-            fort_var=self.variables[ivar]
-            Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
+            #Special case for the solar longitude (areo): needs to be interpolated linearly every 16 timesteps
+            ivar='areo';fort_var=self.variables[ivar]
+            var_out=self._linInterpLs(np.squeeze(fort_var[:]),16).reshape([len(fort_var),1]) #areo is reshaped as [time,scalar_axis]=[160,1]
+            Log.log_variable(variable_name=ivar,DATAin=var_out,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
+        else:
+            #Perform day average and log new time axis
+            time_out=daily_to_average(varIN=time_in,dt_in=time_in[1]-time_in[0],nday=day_average,trim=True)
+            Log.log_axis1D(variable_name='time',DATAin=time_out,dim_name='time',longname_txt=time_in.long_name,units_txt=time_in.units,cart_txt='T')
 
-        #Loop over all variables in file
-        for ivar in self.variables.keys():
-            if 'time' in self.variables[ivar].dimensions :
+            #Log static variables. For the daily file, those are logged with the dynamic variables
+            for ivar in ['pk','bk']:
                 fort_var=self.variables[ivar]
-                #If time is the dimension (but not just a time array)
-                if 'time' in fort_var.dimensions and ivar!='time':
-                    dims_in=fort_var.dimensions
-                    if type(dims_in)==str: #dimensions has 'time' only, it is a string
-                        dims_out=(dims_in,)+(self.tod_name,)
-                    else: #dimensions is a tuple, e.g. ('time','lat','lon')
-                        dims_out=(dims_in[0],)+(self.tod_name,)+dims_in[1:]
-
-                    var_out=daily_to_diurn(fort_var[:],time_in[0:self.nperday])
-                    if day_average!=1:var_out=daily_to_average(var_out,1.,day_average) #dt is 1 sol between two diurn timestep
-                    Log.log_variable(ivar,var_out,dims_out,fort_var.long_name,fort_var.units)
+                Log.log_variable(variable_name=ivar,DATAin=fort_var,dim_array=fort_var.dimensions,longname_txt=fort_var.long_name,units_txt=fort_var.units)
 
-        Log.close()
+        return Log
 
 
     #Public method
     def close(self):
         self.f.close()
+        #Release the memory-mapped file, the lazy variables are no longer accessible
+        self._mmap=None
         print(self.filename+" was closed")
     #Private methods
 
@@ -528,52 +699,64 @@ class Fort(object):
 
         self.zgrid = self.sdepth[1::2]    #TODO check
 
-    def _ra_1D(self,new_array,name_txt):
+    def _index_Fort11_records(self):
         '''
-        _ra stands for 'Return array': Append single timesteps along the first (time) dimensions
+        Scan the record markers of the fort.11 file once and return the byte offsets and lengths of all the records.
+        Return:
+            offsets: 1D array, position of the first byte of data (after the leading marker) for each record
+            lengths: 1D array, length of each record in bytes
+        ***NOTE***
+        Each sequential Fortran record is stored as [n (4 bytes)][n bytes of data][n (4 bytes)], only the markers are read.
         '''
-        if type(new_array)!=np.ndarray:new_array=np.array([new_array])
-
-        #Add time axis to new data e.g. turn [lat,lon]to as [1,lat,lon]
-        new_shape=np.append([1],new_array.shape)
-        #First time that varialbe is encountered
-        if name_txt not in self.variables.keys():
-            return new_array
-        else: #Get values from existing array and append to it. Note that np.concatenate((x,y)) takes a tuple as argument.
-            return np.append(self.variables[name_txt],new_array)
-
-
-    def _log_var(self,name_txt,long_name,unit_txt,dimensions,Rec=None,scaling=None):
-
-        #No Record is provided, read directly from file. Note that this is reading only one timestep at the time!
-        if Rec is None:
-            if dimensions==('time','lat','lon'):
-                Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, order='F')
-            if dimensions==('time','pfull','lat','lon'):
-                Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, self.LM, order='F')
-            if dimensions==('time','zgrid','lat','lon'):
-                Rec=self.f.read_reals('f4').reshape(self.JM,self.IM, self.NL, order='F')
-            #If scaling, scale it!
-            if scaling:Rec*=scaling
-
-
-        #Reorganize 2D and 3D vars from (lat,lon,lev) to (lev,lat,lon)
-        if dimensions==('time','pfull','lat','lon') or dimensions==('time','zgrid','lat','lon'):Rec=Rec.transpose([2,0,1])
-
-        #Set to pole point to value at N-1
-        Rec[...,-1,:]=Rec[...,-2,:]
-
-        #Add time axis to new data e.g. turn [lat,lon]to as [1,lat,lon]
-        new_shape=np.append([1],Rec.shape)
-        #First time that the variable is encountered
-        if name_txt not in self.variables.keys():
-            Rec=Rec.reshape(new_shape)
-        else: #Get values from existing array and append to it. Note that np.concatenate((x,y)) takes a tuple as argument.
-            Rec= np.concatenate((self.variables[name_txt],Rec.reshape(new_shape)))
+        offsets=[];lengths=[]
+        size=os.path.getsize(self.filename)
+        with open(self.filename,'rb') as fid:
+            pos=0
+            while pos<size:
+                fid.seek(pos)
+                n=int(np.fromfile(fid,dtype=np.uint32,count=1)[0])
+                offsets.append(pos+4);lengths.append(n)
+                pos+=n+8
+        return np.array(offsets,dtype=np.int64),np.array(lengths,dtype=np.int64)
+
+    def _view(self,irec,shape,strides,ioff=0,dtype='f4'):
+        '''
+        Return a strided view [time,...] on the memory-mapped file for the record number irec (relative to the start of
+        each timestep) with the time dimension FIRST.
+        Args:
+            irec   : record number within each timestep (e.g. 0 for TAU...GASP, 2 for P)
+            shape  : shape of the data for one timestep, after reorganization, e.g (lev,lat,lon)
+            strides: strides in number of elements of the data for one timestep, e.g. Fortran order (JM*IM,1,JM) for (lev,lat,lon)
+            ioff   : offset in number of elements from the start of the record, e.g. to select a tracer
+        '''
+        itemsize=np.dtype(dtype).itemsize
+        return np.ndarray(shape=(self.nsteps,)+tuple(shape),dtype=dtype,buffer=self._mmap,
+                          offset=self._step_offset[irec]+ioff*itemsize,
+                          strides=(self._step_stride,)+tuple(st*itemsize for st in strides))
 
+    def _log_var(self,name_txt,long_name,unit_txt,dimensions,irec,ioff=0,scaling=None):
+        '''
+        Add a time-varying field to the variables, as a lazy view on the file or read in memory if lazy=False.
+        Args:
+            irec, ioff : record number within each timestep and offset in that record, see _view()
+        ***NOTE***
+        The fields are stored in Fortran order (lat,lon) or (lat,lon,lev) and are reorganized as (lat,lon) and (lev,lat,lon)
+        with the strides of the view, without any copy.
+        '''
+        JM=self.JM;IM=self.IM
+        if dimensions==('time','lat','lon'):
+            shape=(JM,IM);strides=(1,JM)
+        if dimensions==('time','pfull','lat','lon'):
+            shape=(self.LM,JM,IM);strides=(JM*IM,1,JM)
+        if dimensions==('time','zgrid','lat','lon'):
+            shape=(self.NL,JM,IM);strides=(JM*IM,1,JM)
+
+        var=self.Fort_lazy_var(self._view(irec,shape,strides,ioff),name_txt,long_name,unit_txt,dimensions,scaling)
         #Log the variable
-        self.variables[name_txt]=  self.Fort_var(Rec ,name_txt,long_name,unit_txt,dimensions)
-
+        if self.lazy:
+            self.variables[name_txt]= var
+        else:
+            self.variables[name_txt]= self.Fort_var(var[:] ,name_txt,long_name,unit_txt,dimensions)
 
 
     def _read_Fort11_dynamic(self):
@@ -606,94 +789,98 @@ class Fort(object):
             write(11) dheat
             write(11) geot
 
+        ***NOTE***
+        All the timesteps have the same 21 records, the file is indexed in one pass (see _index_Fort11_records()) and
+        memory-mapped. Each variable is then a strided view on the file with the time dimension FIRST.
         '''
-        nsteps=   self.nperday* self.nsolfile  #typically 16 x 10 =160
-        append=False
-        for iwsol in range(0,nsteps):
-            Rec=self.f.read_record('f4')
-            #TAU=Rec[0];VPOUT=Rec[1]; RSDIST=Rec[2]; TOFDAY=Rec[3]; PSF=Rec[4]; PTROP=Rec[5]; TAUTOT=Rec[6]; RPTAU=Rec[7]; SIND=Rec[8]; GASP2=Rec[9]
-
-            self.variables['time']=  self.Fort_var(self._ra_1D(Rec[0]/24,'time')  ,'time','elapsed time from the start of the run','days since 0000-00-00 00:00:00',('time'))
-            self.variables['areo']= self.Fort_var(self._ra_1D(Rec[1].reshape([1,1]),'areo')     ,'areo','solar longitude','degree',('time','scalar_axis'))  #TODO monotically increasing ?
-            self.variables['rdist']= self.Fort_var(self._ra_1D(Rec[2],'rdist')    ,'rdist','square of the Sun-Mars distance','(AU)**2',('time'))
-            self.variables['tofday']=self.Fort_var(self._ra_1D(Rec[3],'tofday')   ,'npcflag','time of day','hours since 0000-00-00 00:00:00',('time')) #TODO edge or center ?
-            self.variables['psf']=   self.Fort_var(self._ra_1D(Rec[4]*100,'psf')  ,'psf','Initial global surface pressure','Pa',('time'))
-            self.variables['ptrop']= self.Fort_var(self._ra_1D(Rec[5],'ptrop')    ,'ptrop','pressure at the tropopause','Pa',('time'))
-            self.variables['tautot']=self.Fort_var(self._ra_1D(Rec[6],'tautot')   ,'tautot','Input (global) dust optical depth at the reference pressure','none',('time'))
-            self.variables['rptau']= self.Fort_var(self._ra_1D(Rec[7]*100,'rptau'),'rptau','reference pressure for dust optical depth','Pa',('time'))
-            self.variables['sind']=  self.Fort_var(self._ra_1D(Rec[8],'sind')     ,'sind','sine of the sub-solar latitude','none',('time'))
-            self.variables['gasp']=  self.Fort_var(self._ra_1D(Rec[9]*100,'gasp') ,'gasp','global average surface pressure','Pa',('time'))
-
-            Rec=self.f.read_record('i4')
-            #NC3=Rec[0]; NCYCLE=Rec[1]
-
-            self.variables['nc3']=     self.Fort_var(self._ra_1D(Rec[0],'nc3')     ,'nc3','full COMP3 is done every nc3 time steps.','None',('time'))
-            self.variables['ncycle']=  self.Fort_var(self._ra_1D(Rec[1],'ncycle')  ,'ncycle','ncycle','none',('time'))
-
-            self._log_var('ps','surface pressure','Pa',('time','lat','lon'),scaling=100)
-            self._log_var('temp','temperature','K',('time','pfull','lat','lon'))
-            self._log_var('ucomp','zonal wind','m/sec',('time','pfull','lat','lon'))
-            self._log_var('vcomp','meridional wind','m/s',('time','pfull','lat','lon'))
-            self._log_var('ts','surface temperature','K',('time','lat','lon'))
-            self._log_var('snow','surface amount of CO2 ice on the ground','kg/m2',('time','lat','lon'))
-            self._log_var('stressx','zonal component of surface stress','kg/m2',('time','lat','lon'))
-            self._log_var('stressy','merdional component of surface stress','kg/m2',('time','lat','lon'))
-            self._log_var('tstrat','stratosphere temperature','K',('time','lat','lon'))
-            self._log_var('tausurf','visible dust optical depth at the surface.','none',('time','lat','lon'))
-            self._log_var('ssun','solar energy absorbed by the atmosphere','W/m2',('time','lat','lon'))
-
-            #Write(11) QTRACE # dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM,self.LM,self.ntrace,order='F')
-
-
-            self._log_var('dst_mass','dust aerosol mass mixing ratio','kg/kg',('time','pfull','lat','lon')           ,Rec=Rec[...,0])
-            self._log_var('dst_num','dust aerosol number','number/kg',('time','pfull','lat','lon')                   ,Rec=Rec[...,1])
-            self._log_var('ice_mass','water ice aerosol mass mixing ratio','kg/kg',('time','pfull','lat','lon')      ,Rec=Rec[...,2])
-            self._log_var('ice_num','water ice  aerosol number','number/kg',('time','pfull','lat','lon')             ,Rec=Rec[...,3])
-            self._log_var('cor_mass','dust core mass mixing ratio for water ice','kg/kg',('time','pfull','lat','lon'),Rec=Rec[...,4])
-            self._log_var('vap_mass','water vapor mass mixing ratio','kg/kg',('time','pfull','lat','lon')            ,Rec=Rec[...,5])
-
-
-            #write(11) QCOND   dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM,self.ntrace,order='F')
-
-            self._log_var('dst_mass_sfc','dust aerosol mass on the surface','kg/m2',('time','lat','lon')           ,Rec=Rec[...,0])
-            self._log_var('dst_num_sfc','dust aerosol number on the surface','number/m2',('time','lat','lon')      ,Rec=Rec[...,1])
-            self._log_var('ice_mass_sfc','water ice aerosol mass on the surface','kg/m2',('time','lat','lon')      ,Rec=Rec[...,2])
-            self._log_var('ice_num_sfc','water ice  aerosol number on the surface','number/m2',('time','lat','lon'),Rec=Rec[...,3])
-            self._log_var('cor_mass_sfc','dust core mass for water ice on the surface','kg/m2',('time','lat','lon'),Rec=Rec[...,4])
-            self._log_var('vap_mass_sfc','water vapor mass on the surface','kg/m2',('time','lat','lon')            ,Rec=Rec[...,5])
-
-
-            #write(11) stemp
-            Rec=self.f.read_reals('f4').reshape(self.JM,self.IM,self.NL,order='F')
-            self._log_var('soil_temp','sub-surface soil temperature','K',('time','zgrid','lat','lon') ,Rec=Rec)
-
-            #write(11) fuptopv, fdntopv, fupsurfv, fdnsurfv
-            #***NOTE*** the following read in fortran order, e.g. (IM,JM)>(60,36) and not (JM,IM)>(36,60) since we are not using the order='F' flag. These need to be transposed.
-            Rec=self.f.read_record('({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM))
-
-            self._log_var('fuptopv','upward visible flux at the top of the atmosphere','W/m2',('time','lat','lon')  ,Rec=Rec[0].T)
-            self._log_var('fdntopv','downward visible flux at the top of the atmosphere','W/m2',('time','lat','lon'),Rec=Rec[1].T)
-            self._log_var('fupsurfv','upward visible flux at the surface','W/m2',('time','lat','lon')               ,Rec=Rec[2].T)
-            self._log_var('fdnsurfv','downward visible flux at the surface','W/m2',('time','lat','lon')             ,Rec=Rec[3].T)
-
-            #write(11) fuptopir, fupsurfir, fdnsurfir
-
-            #***NOTE*** the following read in fortran order, e.g. (IM,JM)>(60,36) and not (JM,IM)>(36,60) since we are not using the order='F' flag. These need to be transposed.
-            Rec=self.f.read_record('({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM),'({0},{1})f4'.format(self.IM,self.JM))
-
-            self._log_var('fuptopir','upward IR flux at the top of the atmosphere','W/m2',('time','lat','lon'),Rec=Rec[0].T)
-            self._log_var('fupsurfir','upward IR flux at the surface','W/m2',('time','lat','lon'),Rec=Rec[1].T)
-            self._log_var('fdnsurfir','downward IR flux at the surface','W/m2',('time','lat','lon'),Rec=Rec[2].T)
-
-            #write(11) surfalb
-            self._log_var('surfalb','surface albedo in the visible, soil or H2O, CO2 ices if present','none',('time','lat','lon'))
-
-            #write(11) dheat
-            #write(11) geot
-            self._log_var('dheat','diabatic heating rate','K/sol',('time','pfull','lat','lon'))
-            self._log_var('geot','geopotential','m2/s2',('time','pfull','lat','lon'))
+        self.nsteps=   self.nperday* self.nsolfile  #typically 16 x 10 =160
+        nrec_step=21  #number of records per timestep
+        nrec_static=3 #header, constants and static fields
+
+        offsets,lengths=self._index_Fort11_records()
+        if len(offsets)<nrec_static+nrec_step*self.nsteps:
+            raise ValueError('%s contains %i records, expected %i for %i timesteps'%(self.filename,len(offsets),nrec_static+nrec_step*self.nsteps,self.nsteps))
+
+        #Offsets of the records for the first timestep and distance in bytes between two timesteps
+        self._step_offset=offsets[nrec_static:nrec_static+nrec_step]
+        self._step_stride=int(offsets[nrec_static+nrec_step]-offsets[nrec_static]) if self.nsteps>1 else 0
+        self._mmap=np.memmap(self.filename,dtype=np.uint8,mode='r')
+
+        #TAU=Rec[0];VPOUT=Rec[1]; RSDIST=Rec[2]; TOFDAY=Rec[3]; PSF=Rec[4]; PTROP=Rec[5]; TAUTOT=Rec[6]; RPTAU=Rec[7]; SIND=Rec[8]; GASP2=Rec[9]
+        Rec=np.array(self._view(0,(10,),(1,)))
+
+        self.variables['time']=  self.Fort_var(Rec[:,0].astype(np.float64)/24  ,'time','elapsed time from the start of the run','days since 0000-00-00 00:00:00',('time'))
+        self.variables['areo']= self.Fort_var(Rec[:,1]     ,'areo','solar longitude','degree',('time','scalar_axis'))  #TODO monotically increasing ?
+        self.variables['rdist']= self.Fort_var(Rec[:,2]    ,'rdist','square of the Sun-Mars distance','(AU)**2',('time'))
+        self.variables['tofday']=self.Fort_var(Rec[:,3]   ,'npcflag','time of day','hours since 0000-00-00 00:00:00',('time')) #TODO edge or center ?
+        self.variables['psf']=   self.Fort_var(Rec[:,4].astype(np.float64)*100  ,'psf','Initial global surface pressure','Pa',('time'))
+        self.variables['ptrop']= self.Fort_var(Rec[:,5]    ,'ptrop','pressure at the tropopause','Pa',('time'))
+        self.variables['tautot']=self.Fort_var(Rec[:,6]   ,'tautot','Input (global) dust optical depth at the reference pressure','none',('time'))
+        self.variables['rptau']= self.Fort_var(Rec[:,7].astype(np.float64)*100,'rptau','reference pressure for dust optical depth','Pa',('time'))
+        self.variables['sind']=  self.Fort_var(Rec[:,8]     ,'sind','sine of the sub-solar latitude','none',('time'))
+        self.variables['gasp']=  self.Fort_var(Rec[:,9].astype(np.float64)*100 ,'gasp','global average surface pressure','Pa',('time'))
+
+        #NC3=Rec[0]; NCYCLE=Rec[1]
+        Rec=np.array(self._view(1,(2,),(1,),dtype='i4'))
+
+        self.variables['nc3']=     self.Fort_var(Rec[:,0]     ,'nc3','full COMP3 is done every nc3 time steps.','None',('time'))
+        self.variables['ncycle']=  self.Fort_var(Rec[:,1]  ,'ncycle','ncycle','none',('time'))
+
+        self._log_var('ps','surface pressure','Pa',('time','lat','lon'),2,scaling=100)
+        self._log_var('temp','temperature','K',('time','pfull','lat','lon'),3)
+        self._log_var('ucomp','zonal wind','m/sec',('time','pfull','lat','lon'),4)
+        self._log_var('vcomp','meridional wind','m/s',('time','pfull','lat','lon'),5)
+        self._log_var('ts','surface temperature','K',('time','lat','lon'),6)
+        self._log_var('snow','surface amount of CO2 ice on the ground','kg/m2',('time','lat','lon'),7)
+        self._log_var('stressx','zonal component of surface stress','kg/m2',('time','lat','lon'),8)
+        self._log_var('stressy','merdional component of surface stress','kg/m2',('time','lat','lon'),9)
+        self._log_var('tstrat','stratosphere temperature','K',('time','lat','lon'),10)
+        self._log_var('tausurf','visible dust optical depth at the surface.','none',('time','lat','lon'),11)
+        self._log_var('ssun','solar energy absorbed by the atmosphere','W/m2',('time','lat','lon'),12)
+
+        #Write(11) QTRACE # dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
+        #QTRACE is (JM,IM,LM,ntrace) in Fortran order, each tracer is offset by JM*IM*LM elements
+        n3D=self.JM*self.IM*self.LM
+        self._log_var('dst_mass','dust aerosol mass mixing ratio','kg/kg',('time','pfull','lat','lon')           ,13,ioff=0*n3D)
+        self._log_var('dst_num','dust aerosol number','number/kg',('time','pfull','lat','lon')                   ,13,ioff=1*n3D)
+        self._log_var('ice_mass','water ice aerosol mass mixing ratio','kg/kg',('time','pfull','lat','lon')      ,13,ioff=2*n3D)
+        self._log_var('ice_num','water ice  aerosol number','number/kg',('time','pfull','lat','lon')             ,13,ioff=3*n3D)
+        self._log_var('cor_mass','dust core mass mixing ratio for water ice','kg/kg',('time','pfull','lat','lon'),13,ioff=4*n3D)
+        self._log_var('vap_mass','water vapor mass mixing ratio','kg/kg',('time','pfull','lat','lon')            ,13,ioff=5*n3D)
+
+
+        #write(11) QCOND   dust mass:1, dust number 2|| water ice mass: 3 and water ice number 4|| dust core mass:5|| water vapor mass: 6
+        n2D=self.JM*self.IM
+        self._log_var('dst_mass_sfc','dust aerosol mass on the surface','kg/m2',('time','lat','lon')           ,14,ioff=0*n2D)
+        self._log_var('dst_num_sfc','dust aerosol number on the surface','number/m2',('time','lat','lon')      ,14,ioff=1*n2D)
+        self._log_var('ice_mass_sfc','water ice aerosol mass on the surface','kg/m2',('time','lat','lon')      ,14,ioff=2*n2D)
+        self._log_var('ice_num_sfc','water ice  aerosol number on the surface','number/m2',('time','lat','lon'),14,ioff=3*n2D)
+        self._log_var('cor_mass_sfc','dust core mass for water ice on the surface','kg/m2',('time','lat','lon'),14,ioff=4*n2D)
+        self._log_var('vap_mass_sfc','water vapor mass on the surface','kg/m2',('time','lat','lon')            ,14,ioff=5*n2D)
+
+
+        #write(11) stemp
+        self._log_var('soil_temp','sub-surface soil temperature','K',('time','zgrid','lat','lon') ,15)
+
+        #write(11) fuptopv, fdntopv, fupsurfv, fdnsurfv
+        #***NOTE*** the fluxes are written as (IM,JM) arrays one after the other, their transpose (JM,IM) is equivalent to the Fortran order.
+        self._log_var('fuptopv','upward visible flux at the top of the atmosphere','W/m2',('time','lat','lon')  ,16,ioff=0*n2D)
+        self._log_var('fdntopv','downward visible flux at the top of the atmosphere','W/m2',('time','lat','lon'),16,ioff=1*n2D)
+        self._log_var('fupsurfv','upward visible flux at the surface','W/m2',('time','lat','lon')               ,16,ioff=2*n2D)
+        self._log_var('fdnsurfv','downward visible flux at the surface','W/m2',('time','lat','lon')             ,16,ioff=3*n2D)
+
+        #write(11) fuptopir, fupsurfir, fdnsurfir
+        self._log_var('fuptopir','upward IR flux at the top of the atmosphere','W/m2',('time','lat','lon'),17,ioff=0*n2D)
+        self._log_var('fupsurfir','upward IR flux at the surface','W/m2',('time','lat','lon'),17,ioff=1*n2D)
+        self._log_var('fdnsurfir','downward IR flux at the surface','W/m2',('time','lat','lon'),17,ioff=2*n2D)
+
+        #write(11) surfalb
+        self._log_var('surfalb','surface albedo in the visible, soil or H2O, CO2 ices if present','none',('time','lat','lon'),18)
+
+        #write(11) dheat
+        #write(11) geot
+        self._log_var('dheat','diabatic heating rate','K/sol',('time','pfull','lat','lon'),19)
+        self._log_var('geot','geopotential','m2/s2',('time','pfull','lat','lon'),20)
 
     def _add_axis_as_variables(self):
         '''
@@ -422,13 +422,14 @@ def smart_reader(fNcdf,var_list,suppress_warning=False):
     return out_list
 
 
-def regrid_Ncfile(VAR_Ncdf,file_Nc_in,file_Nc_target):
+def regrid_Ncfile(VAR_Ncdf,file_Nc_in,file_Nc_target,weights_file=None):
     '''
     Regrid a Ncdf variable from one file's structure to match another file  [Alex Kling , May 2021]
     Args:
         VAR_Ncdf: A netCDF4 variable OBJECT, e.g. 'f_in.variables['temp']' from the source file
         file_Nc_in: The opened netcdf file object  for that input variable, e.g f_in=Dataset('fname','r')
         file_Nc_target: An opened netcdf file object  for the target grid t e.g f_out=Dataset('fname','r')
+        weights_file: optional, a .npz file to store and re-use the horizontal interpolation weights, see FV3_utils.KDTree_weights()
     Returns:
         VAR_OUT: the VALUES of VAR_Ncdf[:], interpolated on the grid for the target file.
 
@@ -469,7 +470,7 @@ def regrid_Ncfile(VAR_Ncdf,file_Nc_in,file_Nc_target):
     var_OUT=VAR_Ncdf[:]
 
     #STEP 1: Lat/lon interpolation are always performed unless target lon and lat are identical
-    if not (np.all(lat_in==lat_t) and np.all(lon_in==lon_t)) :
+    if not (np.array_equal(lat_in,lat_t) and np.array_equal(lon_in,lon_t)) :
         #Special case if input longitudes is 1 element (slice or zonal average). We only interpolate on the latitude axis
         if len(np.atleast_1d(lon_in))==1:
             var_OUT=axis_interp(var_OUT, lat_in,lat_t,axis=-2, reverse_input=False, type_int='lin')
@@ -477,7 +478,7 @@ def regrid_Ncfile(VAR_Ncdf,file_Nc_in,file_Nc_target):
         elif len(np.atleast_1d(lat_in))==1:
             var_OUT=axis_interp(var_OUT, lon_in,lon_t,axis=-1, reverse_input=False, type_int='lin')
         else:#Bi-directional interpolation
-            var_OUT=interp_KDTree(var_OUT,lat_in,lon_in,lat_t,lon_t) #lon/lat
+            var_OUT=interp_KDTree(var_OUT,lat_in,lon_in,lat_t,lon_t,weights_file=weights_file,sparse=True) #lon/lat
 
     #STEP 2: Linear or log interpolation if there is a vertical axis
     if zaxis_in in VAR_Ncdf.dimensions:
@@ -5,7 +5,7 @@ import numpy as np
 from amescap.Script_utils import prYellow,prCyan,prRed,prGreen
 from amescap.FV3_utils import area_weights_deg
 try:
-    from scipy.signal import butter,filtfilt,detrend
+    from scipy.signal import butter,filtfilt,sosfiltfilt,detrend
 except ImportError as error_msg:
     prYellow("Error while importing modules from scipy.signal")
     exit()
@@ -15,30 +15,6 @@ except Exception as exception:
     exit()
 
 
-def init_shtools():
-    '''
-    The following code simply loads the pyshtools module and provides adequate referencing.
-    Since dependencies may need to be solved by the user, the module import is wrapped in a function
-    that may be called when needed.
-    '''
-    try:
-        import  pyshtools
-    except ImportError as error_msg:
-        prYellow("__________________")
-        prYellow("Zonal decomposition relies on the pyshtools library, referenced at:")
-        prYellow('')
-        prYellow("Mark A. Wieczorek and Matthias Meschede (2018). SHTools - Tools for working with spherical harmonics, Geochemistry, Geophysics, Geosystems, , 2574-2592, doi:10.1029/2018GC007529")
-        prYellow("Please consult installation instructions at:")
-        prCyan("https://pypi.org/project/pyshtools")
-        prYellow("And install with:")
-        prCyan("pip install pyshtools")
-        exit()
-    except Exception as exception:
-        # Output unexpected Exceptions.
-        print(exception.__class__.__name__ + ": ", exception)
-
-
-
 def diurn_extract(VAR,N,tod,lon):
     '''
     Extract the diurnal component of a field. Original code by J.Wilson adapted by A. Kling. April, 2021
@@ -50,6 +26,9 @@ def diurn_extract(VAR,N,tod,lon):
     Return:
         amp (ND array)  :  the amplitudes for the Nth first harmonics, e.g. size (Nh,time,lat,lon)
         phase (ND array):  the phases for the Nth first harmonics, e.g. size (Nh,time,lat,lon)
+    ***NOTE***
+    If tod is uniformly spaced over the day, all the harmonics are computed with a single real FFT along the
+    time of day axis. Otherwise, the field is projected on the cos/sin of each harmonic.
     '''
     dimsIN=VAR.shape
 
@@ -73,89 +52,167 @@ def diurn_extract(VAR,N,tod,lon):
 
     Ndim= int(np.prod(dimsIN[1:]))   #Ndim is the product of all dimensions but the time of day axis, e.g. time x lat x lon
     dimsFLAT=np.append([nsteps],[Ndim])  # Shape of flattened array
-    dimsOUT_flat=np.append([N],[Ndim])   # Shape of flattened array
     VAR= VAR.reshape(dimsFLAT)     #Flatten array to  (tod,Nelements)
 
-    #Initialize output arrays
-    amp,phas=np.zeros(dimsOUT_flat),np.zeros(dimsOUT_flat)
+    nn= np.arange(1,N+1).reshape([N,1]) # harmonics, as a column for broadcasting
 
-    #if nargin > 3 (Initial code, we will assume lon is always provided)
-
-    if len(dimsIN) == 1:
-        corr= np.array([lon])
-    else : #Repeat longitude array to match the size of the input VARIABLES, minus the first (tod) axis.
-        tilenm= np.append(dimsIN[1:-1],1)  # Create axis to expend the longitude array
-        lonND=np.tile(lon,tilenm)      # if VAR is (tod,time,lat,lon) lonN is longitude repeated as (time,lat,lon)
-        corr=lonND.flatten()
+    if N <= nsteps//2 and np.allclose(np.diff(tod.flatten()),1./nsteps):
+        # Uniform sampling over the full day (always true for FV3 diurn files): all the harmonics are
+        # obtained at once with a real FFT along the time of day axis. The series below are
+        # sum(VAR cos(n arg)) + i sum(VAR sin(n arg)) = exp(i n arg[0]) conj(FFT(VAR)[n])
+        series= np.exp(1j*nn*arg[0])*np.conj(np.fft.rfft(VAR,axis=0)[1:N+1,:])
+        cosser= series.real
+        sinser= series.imag
+    else:
+        # Irregular sampling: project on all the harmonics with one matrix product, (N,tod) x (tod,Nelements)
+        cosser=   np.dot(np.cos(nn*arg.T) ,VAR)
+        sinser=   np.dot(np.sin(nn*arg.T) ,VAR)
 
-    # Python indexing starts at 0 so we index at nn-1
-    for nn in range(1,N+1):
-        cosser=   np.dot(VAR[:,...].T ,np.cos(nn*arg )).squeeze()
-        sinser=   np.dot(VAR[:,...].T ,np.sin(nn*arg )).squeeze()
+    amp=  2*rnorm*np.sqrt( cosser**2 + sinser**2)
+    phas= (180/np.pi) * np.arctan2( sinser, cosser)
 
-        amp[nn-1,:]= 2*rnorm*np.sqrt( cosser**2 + sinser**2)
-        phas[nn-1,:]= (180/np.pi) * np.arctan2( sinser, cosser)
+    #Reshape lon and harmonics for broadcasting on the output e.g. lon[96] to [1,1,1,96] for (N,time,lat,lon)
+    dimAXIS=np.ones(len(dimsOUT),dtype=int);dimAXIS[-1]=len(np.atleast_1d(lon))
+    corr= np.reshape(lon,dimAXIS)
+    dimAXIS=np.ones(len(dimsOUT),dtype=int);dimAXIS[0]=N
+    nn= nn.reshape(dimAXIS)
 
-        #Apply local time correction to the phase
-        phas[nn-1,:]= phas[nn-1,:] + 360 + nn*corr[:]
-        phas[nn-1,:]= (24/(nn)/360) * np.mod( phas[nn-1,:],360 )
+    amp= amp.reshape(dimsOUT)
+    phas= phas.reshape(dimsOUT)
 
+    #Apply local time correction to the phase
+    phas= phas + 360 + nn*corr
+    phas= (24/(nn)/360) * np.mod( phas,360 )
 
     # Return the phase and amplitude
-    return  amp.reshape( dimsOUT), phas.reshape( dimsOUT )
+    return  amp, phas
 
 
-def reconstruct_diurn(amp,phas,tod,lon,sumList=[]):
+def reconstruct_diurn_harmonics(amp,phas,tod,lon,harmonics=None):
     '''
-    Reconstruct a field wave based on its diurnal harmonics
+    Generator that reconstructs the diurnal harmonics of a field one at a time, so that only one (tod,time,lat,lon)
+    array is in memory, regardless of the number of harmonics.
     Args:
         amp   : amplitude of the signal, with  harmonics dimension FIRST, e.g. (N,time,lat,lon)
         phas : phase of the signal, in [hr], with harmonics dimension FIRST
         tod   : 1D array for the time of day, in UT [hr]
         lon   : 1D array  or float for the longitudes, used to convert UT to LT
-        sumList : (optional) list containing the harmonics to include when reconstructing the wave, e.g. sumN=[1,2,4]
-    Return:
-        VAR   : a variable with reconstructed harmonics with N dimension FIRST and time of day SECOND, e.g. (N,tod,time,lat,lon)
-                if  sumList is provided, the wave output has the harmonics already agregated, e.g. size is    (tod,time,lat,lon)
+        harmonics : (optional) list containing the harmonics to reconstruct, e.g. [1,2,4]. Default is all of them.
+                    Repeated harmonics are only reconstructed once.
+    Yield:
+        nn    : the harmonic number (1 for diurnal, 2 for semi-diurnal...)
+        VAR   : the reconstructed harmonic with time of day FIRST, e.g. (tod,time,lat,lon)
     '''
-
-    #Initialization
-    dimsIN=amp.shape
-    N=dimsIN[0]
-    dimsSUM=np.append([len(tod)],dimsIN[1:])
-    dimAXIS=np.arange(len(dimsSUM)) #Create dimensions array, e.g. [0,1,2,3] for a 4D variables
-
-    dimsOUT=np.append([dimsIN[0],len(tod)],dimsIN[1:])
-    varOUT=np.zeros(dimsOUT)
+    N=amp.shape[0]
+    if harmonics is None:harmonics=range(1,N+1)
+    #Each harmonic is reconstructed once, in increasing order, e.g. [2,1,1] -> [1,2]
+    harmonics=sorted(set(harmonics))
+    dimsSUM=(len(tod),)+amp.shape[1:]
 
     #Special case for station data (lon is a float)
     if len(np.atleast_1d(lon))==1:lon=np.array([lon])
 
     #Reshape  lon array for broadcasting, e.g. lon[96] to  [1,1,1,96]
-    dimAXIS=np.arange(len(dimsSUM));dimAXIS[:]=1;dimAXIS[-1]=len(lon)#
-    lon=lon.reshape(dimAXIS)
+    dimAXIS=np.ones(len(dimsSUM),dtype=int);dimAXIS[-1]=len(lon)
+    lon=np.reshape(lon,dimAXIS)
     #Reshape tod array
-    dimAXIS=np.arange(len(dimsSUM));dimAXIS[:]=1;dimAXIS[0]=len(tod)
-    tod=tod.reshape(dimAXIS)
+    dimAXIS=np.ones(len(dimsSUM),dtype=int);dimAXIS[0]=len(tod)
+    tod=np.reshape(tod,dimAXIS)
 
     # Shift in phase due to local time
     DT=lon/360*24
 
-    varSUM =np.zeros(dimsSUM)
-    for nn in range(1,N+1):
-        #Compute each harmonic
-        varOUT[nn-1,...]=amp[nn-1,...]*np.cos(nn*(tod-phas[nn-1,...]+DT)/24*2*np.pi)
-        # If a sum of harmonics is requested, sum it
-        if nn in sumList:varSUM+=varOUT[nn-1,...]
+    for nn in harmonics:
+        if nn<1 or nn>N:continue
+        VAR=np.empty(dimsSUM)
+        #Compute the harmonic in place: amp*cos(2 pi nn (tod-phas+DT)/24)
+        np.subtract(tod,phas[nn-1,...],out=VAR)
+        VAR+=DT
+        VAR*=nn/24*2*np.pi
+        np.cos(VAR,out=VAR)
+        VAR*=amp[nn-1,...]
+        yield nn,VAR
+
+
+def reconstruct_diurn(amp,phas,tod,lon,sumList=[]):
+    '''
+    Reconstruct a field wave based on its diurnal harmonics
+    Args:
+        amp   : amplitude of the signal, with  harmonics dimension FIRST, e.g. (N,time,lat,lon)
+        phas : phase of the signal, in [hr], with harmonics dimension FIRST
+        tod   : 1D array for the time of day, in UT [hr]
+        lon   : 1D array  or float for the longitudes, used to convert UT to LT
+        sumList : (optional) list containing the harmonics to include when reconstructing the wave, e.g. sumN=[1,2,4]
+    Return:
+        VAR   : a variable with reconstructed harmonics with N dimension FIRST and time of day SECOND, e.g. (N,tod,time,lat,lon)
+                if  sumList is provided, the wave output has the harmonics already agregated, e.g. size is    (tod,time,lat,lon)
+    ***NOTE***
+    When sumList is provided, the harmonics are accumulated one at a time and the (N,tod,time,lat,lon) array is never
+    allocated. Use reconstruct_diurn_harmonics() to process the harmonics individually with the same memory footprint.
+    '''
+    dimsIN=amp.shape
+    dimsSUM=(len(tod),)+dimsIN[1:]
 
     if sumList:
         #Return the agregated harmonics
+        varSUM=np.zeros(dimsSUM)
+        for nn,VAR in reconstruct_diurn_harmonics(amp,phas,tod,lon,harmonics=sumList):varSUM+=VAR
         return varSUM
     else:
         #Return all harmonics individually
+        varOUT=np.zeros((dimsIN[0],)+dimsSUM)
+        for nn,VAR in reconstruct_diurn_harmonics(amp,phas,tod,lon):varOUT[nn-1,...]=VAR
         return varOUT
 
-def space_time(lon,timex, varIN,kmx,tmx):
+def space_time_coeffs(varIN,lon,timex,kmx,tmx):
+    """
+    Complex coefficients of the east and west propagating waves for a block of columns, used by space_time().
+    Args:
+        varIN: input array varIN[lon,Ncolumns,time]
+        lon, timex, kmx, tmx: see space_time()
+    Returns:
+        E,W:  complex arrays [kmx,tmx,Ncolumns] for the east and west propagating waves.
+              The amplitudes are abs(E), abs(W) and the phases -angle(E), -angle(W)
+    ***NOTE***
+        With the longitude coefficient C_k(t) = 2/nlon sum_x(varIN exp(-i k x)), the waves are
+            E = 1/nt sum_t(C_k exp(+i n t))   and    W = 1/nt sum_t(C_k exp(-i n t))
+        If lon covers the full circle and timex is uniformly sampled such that each harmonic n falls on a Fourier
+        bin (n x record length in days is an integer), this is a single 2-D FFT over (time,lon). Otherwise, the sums
+        are computed as matrix products.
+    """
+    nlon,jd,nt= varIN.shape
+    argx= lon * 2*np.pi/360  #nomalize longitude array
+    arg= timex * 2* np.pi #If timex = [0/24,1/24, 2/24,.. 1] arg cycles for m [0,2 Pi]
+    norm= 0.5*(2./nlon)*(2./nt)
+
+    kk= np.arange(0,kmx)
+    nn= np.arange(0,tmx)
+
+    # Fourier bins of the harmonics nn in the time series
+    dt= (timex[-1]-timex[0])/(nt-1) if nt > 1 else 0.
+    mm= nn*nt*dt
+    do_fft= (kmx <= nlon//2+1 and np.allclose(np.diff(lon),360./nlon) and
+             nt > 1 and np.allclose(np.diff(timex),dt) and np.allclose(mm,np.round(mm)))
+
+    if do_fft:
+        # FFT over time and real FFT over longitude, (Ncolumns,time,lon) -> (Ncolumns,time,kmx)
+        G= np.fft.rfft2(np.transpose(varIN,(1,2,0)),axes=(1,2))[:,:,:kmx]
+        mm= np.round(mm).astype(int)
+        # Shift for the first longitude and the first time
+        shiftx= norm*np.exp(-1j*kk*argx[0])
+        shiftt= np.exp(1j*nn*arg[0])[:,np.newaxis]
+        E= (G[:,(-mm)%nt,:]*shiftt*shiftx).transpose((2,1,0))
+        W= (G[:,mm%nt,:]*np.conj(shiftt)*shiftx).transpose((2,1,0))
+    else:
+        # Projection on all the wavenumbers and harmonics at once
+        C= np.tensordot(norm*np.exp(-1j*np.outer(kk,argx)),varIN,axes=(1,0))  # (kmx,Ncolumns,time)
+        Et= np.exp(1j*np.outer(arg,nn))                                     # (time,tmx)
+        E= np.dot(C,Et).transpose((0,2,1))
+        W= np.dot(C,np.conj(Et)).transpose((0,2,1))
+    return E,W
+
+
+def space_time(lon,timex, varIN,kmx,tmx,chunk_size=None,nproc=None):
     """
     Obtain west and east propagating waves. This is a Python implementation of John Wilson's  space_time routine by [A. Kling, 2019]
     Args:
@@ -165,6 +222,9 @@ def space_time(lon,timex, varIN,kmx,tmx):
                First axis must be longitude and last axis must be time.  Expl: varIN[lon,time] varIN[lon,lat,time],varIN[lon,lev,lat,time]
         kmx: an integer for the number of longitudinal wavenumber to extract   (max allowable number of wavenumbers is nlon/2)
         tmx: an integer for the number of tidal harmonics to extract           (max allowable number of harmonics  is nsamples/2)
+        chunk_size: (optional) number of columns (flattened middle dimensions) processed at once. By default, this is
+               chosen to keep each block to about 4 million values.
+        nproc: (optional) number of processes to analyze the blocks in parallel. Default is serial.
 
     Returns:
         ampe:   East propagating wave amplitude [same unit as varIN]
@@ -183,6 +243,7 @@ def space_time(lon,timex, varIN,kmx,tmx):
 
                 amplitude=np.concatenate((ampw[:,::-1], ampe), axis=1)
                 phase=    np.concatenate((phasew[:,::-1], phasee), axis=1)
+            3. All wavenumbers and harmonics are obtained from a single 2-D FFT per block, see space_time_coeffs()
 
     """
 
@@ -193,62 +254,32 @@ def space_time(lon,timex, varIN,kmx,tmx):
     dim_sup_id=dims[1:-1] #additional dimensions stacked in the middle
     jd= int(np.prod( dim_sup_id))     #jd is the total number of dimensions in the middle is varIN>3D
 
-    varIN= np.reshape(varIN, (lon_id, jd, time_id) )   #flatten the middle dimensions if any
-
-    #Initialize 4 empty arrays
-    ampw, ampe,phasew,phasee =[np.zeros((kmx,tmx,jd)) for _x in range(0,4)]
+    varIN= np.reshape(np.asarray(varIN), (lon_id, jd, time_id) )   #flatten the middle dimensions if any
+    lon= np.asarray(lon,dtype=float)
+    timex= np.asarray(timex,dtype=float)
+
+    # Split the columns in memory-bounded blocks
+    if chunk_size is None:
+        chunk_size= 4*1024**2//(lon_id*time_id)
+    chunk_size= max(int(chunk_size),1)
+    blocks= [varIN[:,i0:i0+chunk_size,:] for i0 in range(0,jd,chunk_size)]
+
+    if nproc is not None and nproc > 1 and len(blocks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from itertools import repeat
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            coeffs= list(executor.map(space_time_coeffs,blocks,repeat(lon),repeat(timex),repeat(kmx),repeat(tmx)))
+    else:
+        coeffs= [space_time_coeffs(block,lon,timex,kmx,tmx) for block in blocks]
 
-    #TODO not implemented yet: zamp,zphas=[np.zeros((jd,tmx)) for _x in range(0,2)]
+    E= np.concatenate([c[0] for c in coeffs],axis=-1)
+    W= np.concatenate([c[1] for c in coeffs],axis=-1)
 
     tpi= 2*np.pi
-    argx= lon * 2*np.pi/360  #nomalize longitude array
-    rnorm= 2./len(argx)
-
-    arg= timex * 2* np.pi #If timex = [0/24,1/24, 2/24,.. 1] arg cycles for m [0,2 Pi]
-    rnormt= 2./len(arg)  #Nyquist cut off.
-
-    #
-    for kk in range(0,kmx):
-        progress(kk,kmx)
-        cosx= np.cos( kk*argx )*rnorm
-        sinx= np.sin( kk*argx )*rnorm
-
-    #   Inner product to calculate the Fourier coefficients of the cosine
-    #   and sine contributions of the spatial variation
-        acoef = np.dot(varIN.T,cosx)
-        bcoef = np.dot(varIN.T,sinx)
-
-    # Now get the cos/sine series expansions of the temporal
-    #variations of the acoef and bcoef spatial terms.
-        for nn in range(0,tmx):
-            cosray= rnormt*np.cos(nn*arg )
-            sinray= rnormt*np.sin(nn*arg )
-
-            cosA=  np.dot(acoef.T,cosray)
-            sinA=  np.dot(acoef.T,sinray)
-            cosB=  np.dot(bcoef.T,cosray)
-            sinB=  np.dot(bcoef.T,sinray)
-
-
-            wr= 0.5*(  cosA - sinB )
-            wi= 0.5*( -sinA - cosB )
-            er= 0.5*(  cosA + sinB )
-            ei= 0.5*(  sinA - cosB )
-
-            aw= np.sqrt( wr**2 + wi**2 )
-            ae= np.sqrt( er**2 + ei**2)
-            pe= np.arctan2(ei,er) * 180/np.pi
-            pw= np.arctan2(wi,wr) * 180/np.pi
-
-            pe= np.mod( -np.arctan2(ei,er) + tpi, tpi ) * 180/np.pi
-            pw= np.mod( -np.arctan2(wi,wr) + tpi, tpi ) * 180/np.pi
-
-            ampw[kk,nn,:]= aw.T
-            ampe[kk,nn,:]= ae.T
-            phasew[kk,nn,:]= pw.T
-            phasee[kk,nn,:]= pe.T
-    #End loop
-
+    ampe= np.abs(E)
+    ampw= np.abs(W)
+    phasee= np.mod( -np.angle(E) + tpi, tpi ) * 180/np.pi
+    phasew= np.mod( -np.angle(W) + tpi, tpi ) * 180/np.pi
 
     ampw=   np.reshape( ampw,    (kmx,tmx)+dim_sup_id )
     ampe=   np.reshape( ampe,    (kmx,tmx)+dim_sup_id )
@@ -305,7 +336,7 @@ def space_time(lon,timex, varIN,kmx,tmx):
     return ampe,ampw,phasee,phasew
 
 
-def zeroPhi_filter(VAR, btype, low_highcut, fs,axis=0,order=4,no_trend=False):
+def zeroPhi_filter(VAR, btype, low_highcut, fs,axis=0,order=4,no_trend=False,sos=False):
     '''
     Temporal filter: use a forward pass and a backward pass to prevent phase shift. [A. Kling, 2020]
     Args:
@@ -316,6 +347,8 @@ def zeroPhi_filter(VAR, btype, low_highcut, fs,axis=0,order=4,no_trend=False):
         axis:  if data is N-dimensional array, the filtering dimension
         order: order for the filter
         no_trend: if True, only return the filtered-output, not TREND+ FILTER
+        sos: if True, use second-order sections (numerically more stable than the (b,a) coefficients,
+             especially for narrow band-pass filters)
 
     Returns:
         out: the filtered data
@@ -327,13 +360,18 @@ def zeroPhi_filter(VAR, btype, low_highcut, fs,axis=0,order=4,no_trend=False):
     #Create the filter
     low_highcut=np.array(low_highcut)
     nyq = 0.5 * fs
-    b, a = butter(order, low_highcut/nyq, btype=btype)
 
     #Detrend the data, this is the equivalent of doing linear regressions across the time axis at each grid point
     VAR_detrend=detrend(VAR, axis=axis, type='linear')
     VAR_trend=VAR-VAR_detrend #By substracting the detrend array from the variable, we get the trend
 
-    VAR_f= filtfilt(b, a, VAR_detrend,axis=axis)
+    if sos:
+        SOS = butter(order, low_highcut/nyq, btype=btype, output='sos')
+        #Same padding as filtfilt(), 3 times the number of (b,a) coefficients
+        VAR_f= sosfiltfilt(SOS, VAR_detrend,axis=axis,padlen=3*(2*len(SOS)+1))
+    else:
+        b, a = butter(order, low_highcut/nyq, btype=btype)
+        VAR_f= filtfilt(b, a, VAR_detrend,axis=axis)
 
     if no_trend:
         return VAR_f
@@ -341,40 +379,217 @@ def zeroPhi_filter(VAR, btype, low_highcut, fs,axis=0,order=4,no_trend=False):
         return VAR_trend +VAR_f
 
 
-def zonal_decomposition(VAR):
+def zeroPhi_filter_blocks(VAR, btype, low_highcut, fs,order=4,no_trend=False,block_size=None,nproc=None):
+    '''
+    Same as zeroPhi_filter() for large arrays or netCDF variables with the time dimension FIRST. Since the filter
+    only acts along time, the data is read and filtered by blocks of columns, e.g. VAR[:,lev_slab,lat_slab,:],
+    with second-order sections. This is a generator, so each block may be written to a file before the next one is read.
+    Args:
+        VAR:  values to filter, ND array or netCDF variable, e.g. f.variables['temp'] with time FIRST
+        btype, low_high_cut, fs, order, no_trend: see zeroPhi_filter()
+        block_size: (optional) maximum number of values in a block. Default is about 4 million
+        nproc: (optional) number of processes to filter the blocks in parallel. Default is serial
+    Yields:
+        index, out: the index of the block in VAR, e.g. (slice(None),slice(0,3),slice(20,40)) and the filtered data
+    ***NOTE***
+    Typical usage:
+        for index,out in zeroPhi_filter_blocks(f.variables['temp'],'high',1/10.,4):
+            fnew.log_variable('temp',out,('time','pfull','lat','lon'),index=index)
+    '''
+    dims= VAR.shape
+    if block_size is None: block_size= 4*1024**2
+
+    #Blocks are slabs along the 2nd and 3rd axes (e.g. lev and lat), never along time or the last axis
+    split_axis= list(range(1,min(3,len(dims)-1)))
+    inner= int(np.prod([dims[ii] for ii in range(0,len(dims)) if ii not in split_axis]))
+    steps=[]
+    for ii in split_axis[::-1]:
+        step= int(np.clip(block_size//inner,1,dims[ii]))
+        steps.insert(0,step)
+        inner= inner*step
+        if step < dims[ii]:
+            #The rest of the split axis are processed one at a time
+            steps= [1 for jj in split_axis[:len(split_axis)-len(steps)]]+steps
+            break
+
+    index_list= [(slice(None),)]
+    for ii,step in zip(split_axis,steps):
+        index_list= [index+(slice(i0,i0+step),) for index in index_list for i0 in range(0,dims[ii],step)]
+
+    if nproc is not None and nproc > 1 and len(index_list) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from collections import deque
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            pending= deque()
+            for index in index_list:
+                pending.append((index,executor.submit(zeroPhi_filter,VAR[index],btype,low_highcut,fs,0,order,no_trend,True)))
+                #Limit the number of blocks held in memory
+                if len(pending) >= 2*nproc:
+                    index,future= pending.popleft()
+                    yield index,future.result()
+            while pending:
+                index,future= pending.popleft()
+                yield index,future.result()
+    else:
+        for index in index_list:
+            yield index,zeroPhi_filter(VAR[index],btype,low_highcut,fs,axis=0,order=order,no_trend=no_trend,sos=True)
+
+
+class SphericalHarmonicPlan(object):
+    '''
+    Pre-computed spherical harmonic transform for a regular (lat,lon) grid, applied to stacks of fields at once.
+    The associated Legendre functions and the quadrature weights are computed once for the grid, and each
+    analysis/synthesis is a real FFT along longitude followed by a matrix product along latitude.
+    Args:
+        lat:  1D array of latitudes [degree], cell centers, e.g. [-88.5 ... 88.5] (either order)
+        lon:  1D array of longitudes [degree], regularly spaced, e.g. [0 ... 357]
+        lmax: (optional) maximum spherical harmonic degree. Default is nlat/2-1, the largest degree resolved exactly
+    USAGE:
+        plan = SphericalHarmonicPlan(lat, lon)
+        COEFFS = plan.analysis(VAR)      # VAR is (...,lat,lon), COEFFS is (...,2,lmax+1,lmax+1)
+        VAR = plan.synthesis(COEFFS)
+    ***NOTE***
+    Coefficients use the 4-pi normalization without the Condon-Shortley phase, and are stored as COEFFS[...,i,l,m]
+    with i=0 for cos(m lon) and i=1 for sin(m lon) (same convention as pyshtools' cilm arrays).
+    For regularly spaced cell-centered latitudes, Fejer's first quadrature rule is exact for degrees up to nlat/2-1.
+    Other latitude grids use cos(lat)-weighted quadrature, which is only approximate.
+    '''
+    def __init__(self, lat, lon, lmax=None):
+        lat= np.asarray(lat,dtype=float)
+        lon= np.asarray(lon,dtype=float)
+        nlat= len(lat)
+        self.nlon= len(lon)
+        if lmax is None: lmax= nlat//2-1
+        self.lmax= lmax
+        self.lon0= lon[0]*np.pi/180
+
+        #Colatitudes and quadrature weights for the integral over cos(colatitude) in [-1,1]
+        theta= (90.-lat)*np.pi/180
+        if np.allclose(np.sort(theta),(np.arange(nlat)+0.5)*np.pi/nlat):
+            jj= np.arange(1,nlat//2+1).reshape([-1,1])
+            w= 2./nlat*(1-2*np.sum(np.cos(2*jj*theta)/(4*jj**2-1),axis=0))
+        else:
+            w= np.cos(lat*np.pi/180)
+            w= 2*w/np.sum(w)
+
+        #4-pi normalized associated Legendre functions P[m,l,lat], zero for l<m
+        x= np.cos(theta)
+        u= np.sin(theta)
+        P= np.zeros((lmax+1,lmax+1,nlat))
+        pmm= np.ones(nlat)
+        for m in range(0,lmax+1):
+            if m == 1:
+                pmm= np.sqrt(3.)*u*pmm
+            elif m > 1:
+                pmm= np.sqrt((2*m+1)/(2.*m))*u*pmm
+            P[m,m,:]= pmm
+            if m+1 <= lmax:
+                P[m,m+1,:]= np.sqrt(2*m+3.)*x*pmm
+            for l in range(m+2,lmax+1):
+                a= np.sqrt((2*l-1.)*(2*l+1)/((l-m)*(l+m)))
+                b= np.sqrt((2*l+1.)*(l+m-1)*(l-m-1)/((l-m)*(l+m)*(2*l-3)))
+                P[m,l,:]= a*x*P[m,l-1,:]-b*P[m,l-2,:]
+        self.P= P
+        #Analysis operator including the weights and the 1/(4pi) x (2pi/nlon) normalization
+        self.PW= P*w/(2.*self.nlon)
+        mm= np.arange(0,lmax+1)
+        #Phase shift for the first longitude
+        self.shift= np.exp(-1j*mm*self.lon0)
+        #Scaling of the Fourier coefficients for the inverse real FFT
+        self.scale= np.where(mm == 0,self.nlon,self.nlon/2.)
+
+    def analysis(self, VAR):
+        '''
+        Decomposition into spherical harmonics.
+        Args:
+            VAR: field(s) with latitude SECOND to LAST and longitude LAST, e.g. (lat,lon) or (time,lev,lat,lon)
+        Returns:
+            COEFFS: coefficients, e.g. (time,lev,2,lmax+1,lmax+1)
+        '''
+        VAR= np.asarray(VAR)
+        dims= VAR.shape
+        L1= self.lmax+1
+        #Fourier coefficients along longitude for all the fields at once (...,lat,m)
+        F= np.fft.rfft(VAR,axis=-1)[...,:L1]*self.shift
+        #Legendre transform for each m: (m,l,lat) x (...,lat,m) -> (...,l,m)
+        CS= np.einsum('mlk,...km->...lm',self.PW,F)
+        COEFFS= np.empty(dims[:-2]+(2,L1,L1))
+        COEFFS[...,0,:,:]= CS.real
+        COEFFS[...,1,:,:]= -CS.imag
+        return COEFFS
+
+    def synthesis(self, COEFFS):
+        '''
+        Reconstruction from the spherical harmonics coefficients.
+        Args:
+            COEFFS: coefficients (...,2,lmax+1,lmax+1) as returned by analysis()
+        Returns:
+            VAR: field(s) on the (lat,lon) grid, e.g. (time,lev,lat,lon)
+        '''
+        COEFFS= np.asarray(COEFFS)
+        L1= self.lmax+1
+        #Inverse Legendre transform for each m: (m,l,lat) x (...,l,m) -> (...,lat,m)
+        G= np.einsum('mlk,...lm->...km',self.P,COEFFS[...,0,:,:]-1j*COEFFS[...,1,:,:])
+        X= np.zeros(G.shape[:-1]+(self.nlon//2+1,),dtype=complex)
+        X[...,:L1]= G*self.scale*np.conj(self.shift)
+        return np.fft.irfft(X,n=self.nlon,axis=-1)
+
+
+def regular_latlon(nlat, nlon):
+    '''
+    Return the cell-centered latitudes and the longitudes [degree] of a regular grid, e.g. for nlat=36:  [-87.5 ... 87.5]
+    '''
+    return (np.arange(nlat)+0.5)*180./nlat-90., np.arange(nlon)*360./nlon
+
+
+def _map_blocks(func, VAR, ndim=2, nproc=None, block_size=None):
+    '''
+    Apply func() to blocks of fields, optionally on a process pool, and return the stacked results.
+    Each field is made of the last 'ndim' dimensions of VAR, e.g. (lat,lon), and the leading dimensions are flattened.
+    '''
+    nflatten= int(np.prod(VAR.shape[:-ndim]))
+    VAR= np.reshape(VAR,(nflatten,)+VAR.shape[-ndim:])
+    if block_size is None:
+        block_size= max(4*1024**2//int(np.prod(VAR.shape[-ndim:])),1)
+    blocks= [VAR[i0:i0+block_size,...] for i0 in range(0,nflatten,block_size)]
+    if nproc is not None and nproc > 1 and len(blocks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=nproc) as executor:
+            return np.concatenate(list(executor.map(func,blocks)),axis=0)
+    return np.concatenate([func(block) for block in blocks],axis=0)
+
+
+def zonal_decomposition(VAR,lat=None,lon=None,nproc=None):
     '''
     Decomposition into spherical harmonics. [A. Kling, 2020]
     Args:
         VAR:  Detrend variable for decomposition, latitude is SECOND to LAST and longitude is LAST  e.g. (time,lat,lon) or (time,lev,lat,lon)
+        lat,lon: (optional) 1D arrays of latitude and longitude [degree]. Default is a regular grid with cell-centered latitudes
+        nproc: (optional) number of processes to transform blocks of fields in parallel. Default is serial.
     Returns:
         COEFFS      : coefficient for harmonic decomposion, shape is flatten e.g. (time,2,lat/2, lat/2) (time x lev,2,lat/2, lat/2)
         power_per_l : power spectral density, shape is re-organized, e.g. (time, lat/2) or  (time,lev,lat/2)
     ***NOTE***
     Output size is (...,lat/2, lat/2) as latitude is the smallest dimension and to match the Nyquist frequency
+    All the fields are transformed in batches with a single SphericalHarmonicPlan for the grid.
+    The coefficients are 4-pi normalized and computed with Fejer's quadrature on the cell-centered latitudes:
+    they are not numerically comparable to the output of pyshtools' SHExpandDH() used in earlier versions.
     '''
-    #init_shtools() #TODO Not optimal but prevent issues when library is not installed
-
     var_shape=np.array(VAR.shape)
+    if lat is None or lon is None:
+        lat,lon= regular_latlon(var_shape[-2],var_shape[-1])
+    plan= SphericalHarmonicPlan(lat,lon)
 
-    #Flatten array e.g. turn (10,36,lat,lon) to (360,lat,lon)
-    nflatten=int(np.prod(var_shape[:-2]))
-    reshape_flat=np.append(nflatten,var_shape[-2:])
-    VAR=VAR.reshape(reshape_flat)
-
-    coeff_out_shape=np.append(var_shape[0:-2],[2,var_shape[-2]//2,var_shape[-2]//2])
-    psd_out_shape=np.append(var_shape[0:-2],var_shape[-2]//2)
-    coeff_flat_shape=np.append(nflatten,coeff_out_shape[-3:])
-    COEFFS=np.zeros(coeff_flat_shape)
+    #Flatten array e.g. turn (10,36,lat,lon) to (360,2,lat/2,lat/2)
+    COEFFS= _map_blocks(plan.analysis,np.asarray(VAR),ndim=2,nproc=nproc)
 
-    psd=np.zeros((nflatten,var_shape[-2]//2))
-
-    for ii in range(0,nflatten):
-        COEFFS[ii,...]=pyshtools.expand.SHExpandDH(VAR[ii,...], sampling=2)
-        psd[ii,:]=pyshtools.spectralanalysis.spectrum(COEFFS[ii,...])
+    #Power per degree l, sum over the order m and the cos/sin coefficients
+    psd_out_shape=np.append(var_shape[0:-2],plan.lmax+1)
+    psd= np.sum(COEFFS**2,axis=(1,3))
 
     return  COEFFS, psd.reshape(psd_out_shape)
 
-def zonal_construct(COEFFS_flat,VAR_shape,btype=None,low_highcut=None):
+def zonal_construct(COEFFS_flat,VAR_shape,btype=None,low_highcut=None,lat=None,lon=None,nproc=None):
     '''
     Recomposition into spherical harmonics
     Args:
@@ -382,6 +597,8 @@ def zonal_construct(COEFFS_flat,VAR_shape,btype=None,low_highcut=None):
         VAR_shape:    Shape of the original variable e.g. VAR_shape=temp.shape
         btype: filter type: 'low', 'high' or 'band'. If None, returns array as reconstructed using all zonal wavenumber
         low_high_cut: low , high or [low,high] cutoff zonal wavenumber(s)
+        lat,lon: (optional) 1D arrays of latitude and longitude [degree], see zonal_decomposition()
+        nproc: (optional) number of processes to transform blocks of fields in parallel. Default is serial.
     Returns:
         VAR      : reconstructed output, size is same as original detrened variable e.g. (time,lev,lat,lon)
 
@@ -392,22 +609,20 @@ def zonal_construct(COEFFS_flat,VAR_shape,btype=None,low_highcut=None):
     L_max=1./max(kmin,1.e-20)*dx ; if L_max>1.e20:L_max=np.inf
     print('(kmin,kmax)=(#g,#g)>>dx min= #g km,dx max= #g km'#(kmin,kmax,L_min,L_max))
     '''
-    #init_shtools() #Not optimal but prevent issues when library is not installed
     #--Initialization---
-
-    nflatten=COEFFS_flat.shape[0]
     kmin=0
     kmax=COEFFS_flat.shape[-1]
 
-    VAR=np.zeros((nflatten,VAR_shape[-2],VAR_shape[-1]))
+    if lat is None or lon is None:
+        lat,lon= regular_latlon(VAR_shape[-2],VAR_shape[-1])
+    plan= SphericalHarmonicPlan(lat,lon,lmax=kmax-1)
 
     if btype=='low':  kmax= int(low_highcut)
     if btype=='high': kmin= int(low_highcut)
     if btype=='band': kmin,kmax= int(low_highcut[0]), int(low_highcut[1])
 
-    for ii in range(0,nflatten):
-        #=========Filtering===========
-        COEFFS_flat[ii,:, :kmin, :] = 0.
-        COEFFS_flat[ii,:, kmax:, :] = 0.
-        VAR[ii,:,:] = pyshtools.expand.MakeGridDH(COEFFS_flat[ii,:,:], sampling=2)
+    #=========Filtering===========
+    COEFFS_flat[..., :kmin, :] = 0.
+    COEFFS_flat[..., kmax:, :] = 0.
+    VAR= _map_blocks(plan.synthesis,COEFFS_flat,ndim=3,nproc=nproc)
     return  VAR.reshape(VAR_shape)
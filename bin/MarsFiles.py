@@ -15,8 +15,8 @@ from netCDF4 import Dataset
 import warnings     # suppress certain errors when dealing with NaN arrays
 
 # ==========
-from amescap.Ncdf_wrapper import Ncdf, Fort
-from amescap.FV3_utils import tshift, daily_to_average, daily_to_diurn, get_trend_2D
+from amescap.Ncdf_wrapper import Ncdf, Fort, set_nc_defaults, parse_nc_chunks
+from amescap.FV3_utils import tshift, daily_to_average, daily_to_diurn, get_trend_2D, LocalTimeShiftPlan
 from amescap.Script_utils import prYellow, prCyan, prRed, find_tod_in_diurn, FV3_file_type, filter_vars, regrid_Ncfile, get_longname_units,extract_path_basename
 # ==========
 
@@ -78,6 +78,8 @@ parser.add_argument('-hpf', '--high_pass_filter', nargs='+', type=float,
                          """     (-lpf)  --low_pass_filter  sol_max         \n"""
                          """     (-bpf)  --band_pass_filter sol_min sol max \n"""
                          """> Usage: MarsFiles.py *.atmos_daily.nc -bpf 0.5 10. --no_trend \n"""
+                         """> Use '--nproc' to filter blocks of the variables on several processes \n"""
+                         """> Usage: MarsFiles.py *.atmos_daily.nc -hpf 10. --nproc 4 \n"""
                     """\n""")
 
 parser.add_argument('-lpf', '--low_pass_filter', nargs='+', type=float,
@@ -95,18 +97,24 @@ parser.add_argument('-no_trend', '--no_trend', action='store_true',
                          """> Usage: MarsFiles.py *.atmos_daily.nc -bpf 0.5 10. --no_trend \n"""
                     """\n""")
 
-# Decomposition in zonal harmonics, disabled for initial CAP release:
-#
-# parser.add_argument('-hpk','--high_pass_zonal',nargs='+',type=int,
-#                     help="""Spatial filtering utilities, including: low, high, and band pass filters \n"""
-#                          """> Use '--no_trend' flag  to  keep amplitudes only (data is always detrended before filtering) \n"""
-#                          """     (-hpk)  --high_pass_zonal kmin         \n"""
-#                          """     (-lpk)  --low_pass_zonal  kmax         \n"""
-#                          """     (-bpk)  --band_pass_zonal kmin kmax \n"""
-#                          """> Usage: MarsFiles.py *.atmos_daily.nc -lpk 20 --no_trend   \n"""
-#                         """\n""")
-# parser.add_argument('-lpk','--low_pass_zonal', nargs='+',type=int,help=argparse.SUPPRESS) #same as  --hpf but without the instructions
-# parser.add_argument('-bpk','--band_pass_zonal', nargs='+',help=argparse.SUPPRESS) #same as --hpf but without the instructions
+parser.add_argument('-nproc', '--nproc', type=int, default=None,
+                    help=argparse.SUPPRESS)  # this flag is used jointly with the temporal and zonal filters
+
+parser.add_argument('-hpk', '--high_pass_zonal', nargs='+', type=int,
+                    help="""Spatial filtering utilities, including: low, high, and band pass filters \n"""
+                         """> Use '--no_trend' flag  to  keep amplitudes only (data is always detrended before filtering) \n"""
+                         """     (-hpk)  --high_pass_zonal kmin         \n"""
+                         """     (-lpk)  --low_pass_zonal  kmax         \n"""
+                         """     (-bpk)  --band_pass_zonal kmin kmax \n"""
+                         """> Usage: MarsFiles.py *.atmos_daily.nc -lpk 20 --no_trend   \n"""
+                         """> Use '--nproc' to process blocks of the variables on several processes \n"""
+                    """\n""")
+
+parser.add_argument('-lpk', '--low_pass_zonal', nargs='+', type=int,
+                    help=argparse.SUPPRESS)  # same as --hpk but without the instructions
+
+parser.add_argument('-bpk', '--band_pass_zonal', nargs='+',
+                    help=argparse.SUPPRESS)  # same as --hpk but without the instructions
 
 parser.add_argument('-tidal', '--tidal', nargs='+', type=int,
                     help="""Tide analyis on 'diurn' files: extract diurnal and its harmonics. \n"""
@@ -124,7 +132,13 @@ parser.add_argument('-norm', '--normalize', action='store_true',
 parser.add_argument('-rs', '--regrid_source', nargs='+',
                     help=""" Reggrid MGCM output or observation files using another netcdf file grid structure (time, lev, lat, lon) \n"""
                     """>  Both source(s) and target files should be vertically interpolated to a standard grid (e.g. zstd, zagl, pstd) \n"""
-                    """>  Usage: MarsFiles.py ****.atmos.average_pstd.nc -rs simu2/00668.atmos_average_pstd.nc \n""")
+                    """>  Usage: MarsFiles.py ****.atmos.average_pstd.nc -rs simu2/00668.atmos_average_pstd.nc \n"""
+                    """>  Use '--save_weights' to store the interpolation weights next to the target file (***_regrid_weights.npz) \n"""
+                    """>  and re-use them in later sessions: \n"""
+                    """>  Usage: MarsFiles.py ****.atmos.average_pstd.nc -rs simu2/00668.atmos_average_pstd.nc --save_weights \n""")
+
+parser.add_argument('-sw', '--save_weights', action='store_true',
+                    help=argparse.SUPPRESS)  # this flag is used jointly with --regrid_source
 
 parser.add_argument('-za', '--zonal_avg', action='store_true',
                     help="""Apply zonal averaging to a file. \n"""
@@ -140,6 +154,16 @@ parser.add_argument('-e', '--ext', type=str, default=None,
                     help="""> Append an extension (_ext.nc) to the output file instead of replacing the existing file \n"""
                     """>  Usage: MarsFiles.py ****.atmos.average.nc [actions] -ext B \n"""
                     """   This will produce ****.atmos.average_B.nc files \n""")
+parser.add_argument('--nc-compress', '--nc_compress', type=int, default=None,
+                    help="""Compress the new variables with zlib, from 1 (fastest) to 9 (smallest file). \n"""
+                         """> Usage: MarsFiles.py *.atmos_daily.nc -hpf 10. --nc-compress 4 --nc-chunks time=1 \n"""
+                    """\n""")
+
+parser.add_argument('--nc-chunks', '--nc_chunks', nargs='+', default=None,
+                    help="""Chunk sizes of the new variables as dimension=size, dimensions not listed are not split. \n"""
+                         """Use time=1 for fast time-slice reads, e.g. with MarsPlot. \n"""
+                    """\n""")
+
 parser.add_argument('--debug',  action='store_true',
                     help='Debug flag: release the exceptions')
 
@@ -149,6 +173,9 @@ cat_method = 'internal'
 
 def main():
     file_list = parser.parse_args().input_file
+    # Compression and chunking of the new variables
+    set_nc_defaults(complevel=parser.parse_args().nc_compress or 0,
+                    chunks=parse_nc_chunks(parser.parse_args().nc_chunks))
     cwd       = os.getcwd()
     path2data = os.getcwd()
 
@@ -201,15 +228,10 @@ def main():
         else:
             print('Processing fort.11 files')
             for fname in histlist:
-                f = Fort(fname)
-                if 'fixed' in parser.parse_args().fv3:
-                    f.write_to_fixed()
-                if 'average' in parser.parse_args().fv3:
-                    f.write_to_average()
-                if 'daily' in parser.parse_args().fv3:
-                    f.write_to_daily()
-                if 'diurn' in parser.parse_args().fv3:
-                    f.write_to_diurn()
+                # The variables are read lazily from the file and each one is written to all the requested files at once
+                f = Fort(fname, lazy=True)
+                f.write_to_files(parser.parse_args().fv3)
+                f.close()
 
     # ===========================================================================
     # =============  Append netcdf files along the 'time' dimension =============
@@ -440,6 +462,8 @@ def main():
 
             # Read 4D field and do the time shift
             longitude = np.array(fdiurn.variables['lon'])
+            # The interpolation indices and weights are shared by all the variables in the file
+            tshift_plan = LocalTimeShiftPlan(longitude, tod_orig, timex=tod_in)
             var_list = filter_vars(
                 fdiurn, parser.parse_args().include)  # Get all variables
 
@@ -455,8 +479,7 @@ def main():
                     itime = vkeys.index('time')
                     itod = vkeys.index(tod_name_in)
                     newvar = np.transpose(varIN, (ilon, ilat, itime, itod))
-                    newvarOUT = tshift(newvar, longitude,
-                                       tod_orig, timex=tod_in)
+                    newvarOUT = tshift_plan.apply(newvar)
                     varOUT = np.transpose(newvarOUT, (2, 3, 1, 0))
                     fnew.log_variable(
                         ivar, varOUT, ['time', tod_name_out, 'lat', 'lon'], longname_txt, units_txt)
@@ -467,8 +490,7 @@ def main():
                     itime = vkeys.index('time')
                     itod = vkeys.index(tod_name_in)
                     newvar = np.transpose(varIN, (ilon, ilat, iz, itime, itod))
-                    newvarOUT = tshift(newvar, longitude,
-                                       tod_orig, timex=tod_in)
+                    newvarOUT = tshift_plan.apply(newvar)
                     varOUT = np.transpose(newvarOUT, (3, 4, 2, 1, 0))
                     fnew.log_variable(ivar, varOUT, [
                                       'time', tod_name_out, zaxis, 'lat', 'lon'], longname_txt, units_txt)
@@ -530,10 +552,13 @@ def main():
 
                 if 'time' in varNcf.dimensions:
                     prCyan("Processing: %s ..." % (ivar))
-                    var_out = daily_to_average(varNcf[:], dt_in, nday)
                     longname_txt, units_txt = get_longname_units(fdaily, ivar)
-                    fnew.log_variable(
-                        ivar, var_out, varNcf.dimensions, longname_txt, units_txt)
+                    # Read, bin and write one bin at the time so the memory use does not depend on the file length
+                    for ibin in range(0, max(N_even, 1)):
+                        var_out = daily_to_average(
+                            varNcf[ibin*combinedN:(ibin+1)*combinedN, ...], dt_in, nday)
+                        fnew.log_variable_slab(
+                            ivar, var_out, varNcf.dimensions, ibin, longname_txt, units_txt)
 
                 else:
                     if ivar in ['pfull', 'lat', 'lon', 'phalf', 'pk', 'bk', 'pstd', 'zstd', 'zagl']:
@@ -576,6 +601,8 @@ def main():
 
             dt_in = time_in[1]-time_in[0]
             iperday = int(np.round(1/dt_in))
+            combinedN = int(iperday*nday)
+            N_even = Nin//combinedN
 
             # define a netcdf object from the netcdf wrapper module
             fnew = Ncdf(fullnameOUT)
@@ -606,13 +633,16 @@ def main():
                     prCyan("Processing: %s ..." % (ivar))
                     dims_in = varNcf.dimensions
                     dims_out = (dims_in[0],)+(tod_name,)+dims_in[1:]
-                    var_out = daily_to_diurn(varNcf[:], time_in[0:iperday])
-                    if nday != 1:
-                        # dt is 1 sol between two 'diurn' timesteps
-                        var_out = daily_to_average(var_out, 1., nday)
                     longname_txt, units_txt = get_longname_units(fdaily, ivar)
-                    fnew.log_variable(ivar, var_out, dims_out,
-                                      longname_txt, units_txt)
+                    # Read, bin and write one bin at the time so the memory use does not depend on the file length
+                    for ibin in range(0, max(N_even, 1)):
+                        var_out = daily_to_diurn(
+                            varNcf[ibin*combinedN:(ibin+1)*combinedN, ...], time_in[0:iperday])
+                        if nday != 1:
+                            # dt is 1 sol between two 'diurn' timesteps
+                            var_out = daily_to_average(var_out, 1., nday)
+                        fnew.log_variable_slab(ivar, var_out, dims_out, ibin,
+                                               longname_txt, units_txt)
 
                 else:
                     if ivar in ['pfull', 'lat', 'lon', 'phalf', 'pk', 'bk', 'pstd', 'zstd', 'zagl']:
@@ -630,7 +660,7 @@ def main():
     elif parser.parse_args().high_pass_filter or parser.parse_args().low_pass_filter or parser.parse_args().band_pass_filter:
 
         # This functions requires scipy > 1.2.0. We import the package here.
-        from amescap.Spectral_utils import zeroPhi_filter
+        from amescap.Spectral_utils import zeroPhi_filter_blocks
 
         if parser.parse_args().high_pass_filter:
             btype = 'high'
@@ -718,11 +748,12 @@ def main():
 
                 if 'time' in varNcf.dimensions and ivar not in ['time', 'areo']:
                     prCyan("Processing: %s ..." % (ivar))
-                    var_out = zeroPhi_filter(
-                        varNcf[:], btype, low_highcut, fs, axis=0, order=4, no_trend=parser.parse_args().no_trend)
                     longname_txt, units_txt = get_longname_units(fdaily, ivar)
-                    fnew.log_variable(
-                        ivar, var_out, varNcf.dimensions, longname_txt, units_txt)
+                    # Filter by blocks of columns, each block is written directly to the new file
+                    for index, var_out in zeroPhi_filter_blocks(
+                            varNcf, btype, low_highcut, fs, order=4, no_trend=parser.parse_args().no_trend, nproc=parser.parse_args().nproc):
+                        fnew.log_variable(
+                            ivar, var_out, varNcf.dimensions, longname_txt, units_txt, index=index)
                 else:
                     if ivar in ['pfull', 'lat', 'lon', 'phalf', 'pk', 'bk', 'pstd', 'zstd', 'zagl']:
                         prCyan("Copying axis: %s..." % (ivar))
@@ -736,119 +767,136 @@ def main():
     # ========================  Zonal Decomposition Analysis ====================
     # ===========================================================================
 
-    # elif parser.parse_args().high_pass_zonal or parser.parse_args().low_pass_zonal or parser.parse_args().band_pass_zonal:
-    #
-    #     # This function requires scipy > 1.2.0. We import the package here
-    #     from amescap.Spectral_utils import zonal_decomposition, zonal_construct
-    #     #Load the module
-    #     #init_shtools()
-    #
-    #     if parser.parse_args().high_pass_zonal:
-    #         btype='high';out_ext='_hpk';nk=np.asarray(parser.parse_args().high_pass_zonal).astype(int)
-    #         if len(np.atleast_1d(nk))!=1:
-    #             prRed('***Error*** kmin accepts only one value')
-    #             exit()
-    #     if parser.parse_args().low_pass_zonal:
-    #         btype='low';out_ext='_lpk';nk=np.asarray(parser.parse_args().low_pass_zonal).astype(int)
-    #         if len(np.atleast_1d(nk))!=1:
-    #             prRed('kmax accepts only one value')
-    #             exit()
-    #     if parser.parse_args().band_pass_zonal:
-    #         btype='band';out_ext='_bpk';nk=np.asarray(parser.parse_args().band_pass_zonal).astype(int)
-    #         if len(np.atleast_1d(nk))!=2:
-    #             prRed('Requires two values: kmin kmax')
-    #             exit()
-    #
-    #     if parser.parse_args().no_trend:out_ext =out_ext+'_no_trend'
-    #
-    #     for filei in file_list:
-    #         # Add path unless full path is provided
-    #         if not ('/' in filei):
-    #             fullnameIN = path2data + '/' + filei
-    #         else:
-    #             fullnameIN=filei
-    #         fullnameOUT = fullnameIN[:-3]+out_ext+'.nc'
-    #
-    #         # Append extension, if any:
-    #         if parser.parse_args().ext:fullnameOUT=fullnameOUT[:-3]+'_'+parser.parse_args().ext+'.nc'
-    #
-    #         fname = Dataset(fullnameIN, 'r', format='NETCDF4_CLASSIC')
-    #
-    #         var_list = filter_vars(fname,parser.parse_args().include) # Get all variables
-    #
-    #         lon=fname.variables['lon'][:]
-    #         lat=fname.variables['lat'][:]
-    #         LON,LAT=np.meshgrid(lon,lat)
-    #
-    #         dlat=lat[1]-lat[0]
-    #         dx=2*np.pi*3400
-    #
-    #         # Check if the frequency domain is allowed and display some information
-    #
-    #         if any(nn > len(lat)/2 for nn in nk):
-    #             prRed('***Warning***  maximum wavenumber cut-off cannot be larger than the Nyquist criteria of nlat/2= %i sol'%(len(lat)/2))
-    #         elif btype=='low':
-    #             L_max=(1./nk)*dx
-    #             prYellow('Low pass filter, allowing only wavelength > %g km'%(L_max))
-    #         elif btype=='high':
-    #             L_min=(1./nk)*dx
-    #             prYellow('High pass filter, allowing only wavelength < %g km'%(L_min))
-    #         elif btype=='band':
-    #             L_min=(1./nk[1])*dx
-    #             L_max=1./max(nk[0],1.e-20)*dx
-    #             if L_max>1.e20:L_max=np.inf
-    #             prYellow('Band pass filter, allowing only %g km < wavelength < %g km'%(L_min,L_max))
-
-   ##
-    #         fnew = Ncdf(fullnameOUT) # Define a netcdf object from the netcdf wrapper module
-    #         # Copy all dimensions but 'time' from the old file to the new file
-    #         fnew.copy_all_dims_from_Ncfile(fname)
-    #
-    #         if btype=='low':
-    #             fnew.add_constant('kmax',nk,"Low-pass filter zonal wavenumber ","wavenumber")
-    #         elif btype=='high':
-    #             fnew.add_constant('kmin',nk,"High-pass filter zonal wavenumber ","wavenumber")
-    #         elif btype=='band':
-    #             fnew.add_constant('kmin',nk[0],"Band-pass filter low zonal wavenumber ","wavenumber")
-    #             fnew.add_constant('kmax',nk[1],"Band-pass filter high zonal wavenumber ","wavenumber")
-    #
-    #         low_highcut = nk
-    #
-    #         #Loop over all variables in the file
-    #         for ivar in var_list:
-    #             varNcf = fname.variables[ivar]
-    #
-    #             if ('lat' in varNcf.dimensions) and ('lon' in varNcf.dimensions):
-    #                 prCyan("Processing: %s ..."%(ivar))
-    #
-    #                 # Step 1 : Detrend the data
-    #                 TREND=get_trend_2D(varNcf[:],LON,LAT,'wmean')
-    #                 # Step 2 : Calculate spherical harmonic coefficients
-    #                 COEFF,PSD=zonal_decomposition(varNcf[:]-TREND)
-    #                 # Step 3 : Recompose the variable out of the coefficients
-    #                 VAR_filtered=zonal_construct(COEFF,varNcf[:].shape,btype=btype,low_highcut=low_highcut)
-    #                 #Step 4: Add the trend, if requested
-    #                 if parser.parse_args().no_trend:
-    #                     var_out=VAR_filtered
-    #                 else:
-    #                     var_out=VAR_filtered+TREND
-    #
-    #                 fnew.log_variable(ivar,var_out,varNcf.dimensions,varNcf.long_name,varNcf.units)
-    #             else:
-    #                 if  ivar in ['pfull', 'lat', 'lon','phalf','pk','bk','pstd','zstd','zagl','time']:
-    #                     prCyan("Copying axis: %s..."%(ivar))
-    #                     fnew.copy_Ncaxis_with_content(fname.variables[ivar])
-    #                 else:
-    #                     prCyan("Copying variable: %s..."%(ivar))
-    #                     fnew.copy_Ncvar(fname.variables[ivar])
-    #         fnew.close()
+    elif parser.parse_args().high_pass_zonal or parser.parse_args().low_pass_zonal or parser.parse_args().band_pass_zonal:
+
+        # The spherical harmonic transforms are batched over all the (lat, lon) fields of a variable
+        from amescap.Spectral_utils import zonal_decomposition, zonal_construct
+
+        if parser.parse_args().high_pass_zonal:
+            btype = 'high'
+            out_ext = '_hpk'
+            nk = np.asarray(parser.parse_args().high_pass_zonal).astype(int)
+            if len(np.atleast_1d(nk)) != 1:
+                prRed('***Error*** kmin accepts only one value')
+                exit()
+        if parser.parse_args().low_pass_zonal:
+            btype = 'low'
+            out_ext = '_lpk'
+            nk = np.asarray(parser.parse_args().low_pass_zonal).astype(int)
+            if len(np.atleast_1d(nk)) != 1:
+                prRed('kmax accepts only one value')
+                exit()
+        if parser.parse_args().band_pass_zonal:
+            btype = 'band'
+            out_ext = '_bpk'
+            nk = np.asarray(parser.parse_args().band_pass_zonal).astype(int)
+            if len(np.atleast_1d(nk)) != 2:
+                prRed('Requires two values: kmin kmax')
+                exit()
+
+        if parser.parse_args().no_trend:
+            out_ext = out_ext+'_no_trend'
+
+        for filei in file_list:
+            # Add path unless full path is provided
+            if not ('/' in filei):
+                fullnameIN = path2data + '/' + filei
+            else:
+                fullnameIN = filei
+            fullnameOUT = fullnameIN[:-3]+out_ext+'.nc'
+
+            # Append extension, if any:
+            if parser.parse_args().ext:
+                fullnameOUT = fullnameOUT[:-3] + \
+                    '_'+parser.parse_args().ext+'.nc'
+
+            fname = Dataset(fullnameIN, 'r', format='NETCDF4_CLASSIC')
+
+            var_list = filter_vars(
+                fname, parser.parse_args().include)  # Get all variables
+
+            lon = fname.variables['lon'][:]
+            lat = fname.variables['lat'][:]
+            LON, LAT = np.meshgrid(lon, lat)
+
+            dx = 2*np.pi*3400
+
+            # Check if the frequency domain is allowed and display some information
+            if any(nn > len(lat)/2 for nn in np.atleast_1d(nk)):
+                prRed('***Warning***  maximum wavenumber cut-off cannot be larger than the Nyquist criteria of nlat/2= %i' % (len(lat)/2))
+            elif btype == 'low':
+                L_max = (1./nk)*dx
+                prYellow('Low pass filter, allowing only wavelength > %g km' % (L_max[0]))
+            elif btype == 'high':
+                L_min = (1./nk)*dx
+                prYellow('High pass filter, allowing only wavelength < %g km' % (L_min[0]))
+            elif btype == 'band':
+                L_min = (1./nk[1])*dx
+                L_max = 1./max(nk[0], 1.e-20)*dx
+                if L_max > 1.e20:
+                    L_max = np.inf
+                prYellow('Band pass filter, allowing only %g km < wavelength < %g km' % (L_min, L_max))
+
+            # Define a netcdf object from the netcdf wrapper module
+            fnew = Ncdf(fullnameOUT)
+            # Copy all dimensions but 'time' from the old file to the new file
+            fnew.copy_all_dims_from_Ncfile(fname)
+
+            if btype == 'low':
+                fnew.add_constant(
+                    'kmax', nk, "Low-pass filter zonal wavenumber ", "wavenumber")
+            elif btype == 'high':
+                fnew.add_constant(
+                    'kmin', nk, "High-pass filter zonal wavenumber ", "wavenumber")
+            elif btype == 'band':
+                fnew.add_constant(
+                    'kmin', nk[0], "Band-pass filter low zonal wavenumber ", "wavenumber")
+                fnew.add_constant(
+                    'kmax', nk[1], "Band-pass filter high zonal wavenumber ", "wavenumber")
+
+            low_highcut = nk
+
+            # Loop over all variables in the file
+            for ivar in var_list:
+                varNcf = fname.variables[ivar]
+
+                # Only filter the time-varying fields, time-invariant fields such as 'zsurf' are copied unchanged
+                if varNcf.dimensions[0] == 'time' and varNcf.dimensions[-2:] == ('lat', 'lon'):
+                    prCyan("Processing: %s ..." % (ivar))
+                    var_in = varNcf[:]
+                    # Step 1 : Detrend the data
+                    TREND = get_trend_2D(var_in, LON, LAT, 'wmean')
+                    # Step 2 : Calculate spherical harmonic coefficients
+                    COEFF, PSD = zonal_decomposition(
+                        var_in-TREND, lat, lon, nproc=parser.parse_args().nproc)
+                    # Step 3 : Recompose the variable out of the coefficients
+                    VAR_filtered = zonal_construct(COEFF, var_in.shape, btype=btype, low_highcut=low_highcut,
+                                                   lat=lat, lon=lon, nproc=parser.parse_args().nproc)
+                    # Step 4: Add the trend, if requested
+                    if parser.parse_args().no_trend:
+                        var_out = VAR_filtered
+                    else:
+                        var_out = VAR_filtered+TREND
+
+                    longname_txt, units_txt = get_longname_units(fname, ivar)
+                    fnew.log_variable(
+                        ivar, var_out, varNcf.dimensions, longname_txt, units_txt)
+                else:
+                    if ivar in ['pfull', 'lat', 'lon', 'phalf', 'pk', 'bk', 'pstd', 'zstd', 'zagl', 'time']:
+                        prCyan("Copying axis: %s..." % (ivar))
+                        fnew.copy_Ncaxis_with_content(fname.variables[ivar])
+                    else:
+                        prCyan("Copying variable: %s..." % (ivar))
+                        fnew.copy_Ncvar(fname.variables[ivar])
+            fname.close()
+            fnew.close()
 
     # ===========================================================================
     # ============================  Tidal Analysis ==============================
     # ===========================================================================
 
     elif parser.parse_args().tidal:
-        from amescap.Spectral_utils import diurn_extract, reconstruct_diurn
+        from amescap.Spectral_utils import diurn_extract, reconstruct_diurn_harmonics
         N = parser.parse_args().tidal[0]
         if len(np.atleast_1d(N)) != 1:
             prRed('***Error*** N accepts only one value')
@@ -922,11 +970,10 @@ def main():
                     amp, phas = diurn_extract(
                         varIN.swapaxes(0, 1), N, tod_in, lon)
                     if parser.parse_args().reconstruct:
-                        VARN = reconstruct_diurn(
-                            amp, phas, tod_in, lon, sumList=[])
-                        for nn in range(N):
-                            fnew.log_variable("%s_N%i" % (ivar, nn+1), VARN[nn, ...].swapaxes(
-                                0, 1), varNcf.dimensions, "harmonic N=%i for %s" % (nn+1, longname_txt), units_txt)
+                        # Harmonics are reconstructed and written one at a time
+                        for nn, VARN in reconstruct_diurn_harmonics(amp, phas, tod_in, lon):
+                            fnew.log_variable("%s_N%i" % (ivar, nn), VARN.swapaxes(
+                                0, 1), varNcf.dimensions, "harmonic N=%i for %s" % (nn, longname_txt), units_txt)
 
                     else:
                         #Update the dimensions
@@ -970,6 +1017,12 @@ def main():
             name_target = path2data + '/' + name_target
         fNcdf_t = Dataset(name_target, 'r')
 
+        # The interpolation weights are computed once per grid pair and shared by all the files
+        if parser.parse_args().save_weights:
+            weights_file = name_target[:-3]+'_regrid_weights.npz'
+        else:
+            weights_file = None
+
         for filei in file_list:
             # Add path unless full path is provided
             if not ('/' in filei):
@@ -1004,11 +1057,12 @@ def main():
                         fnew.copy_Ncaxis_with_content(fNcdf_t.variables[ivar])
                 elif varNcf.dimensions[-2:]==('lat', 'lon'): #Ignore variables like  'time_bounds', 'scalar_axis' or 'grid_xt_bnds'...
                     prCyan("Regridding: %s..."%(ivar))
-                    var_OUT=regrid_Ncfile(varNcf,f_in,fNcdf_t)
+                    var_OUT=regrid_Ncfile(varNcf,f_in,fNcdf_t,weights_file=weights_file)
                     fnew.log_variable(ivar,var_OUT,varNcf.dimensions,longname_txt,units_txt)
 
             fnew.close()
-            fNcdf_t.close()
+            f_in.close()
+        fNcdf_t.close()
 
     # ===========================================================================
     # =======================  Zonal averaging    ===============================
@@ -9,10 +9,11 @@ import time       # monitor interpolation time
 import re         # string matching module to handle time_of_day_XX
 
 # ==========
-from amescap.FV3_utils import fms_press_calc, fms_Z_calc, vinterp, find_n, polar2XYZ, interp_KDTree, axis_interp
+from amescap.FV3_utils import fms_press_calc, fms_press_calc_chunks, fms_Z_calc, vinterp, find_n, polar2XYZ, interp_KDTree, axis_interp
+from amescap.FV3_utils import VerticalInterpPlan
 from amescap.Script_utils import check_file_tape, prYellow, prRed, prCyan, prGreen, prPurple, print_fileContent
 from amescap.Script_utils import section_content_amescap_profile, find_tod_in_diurn, filter_vars, find_fixedfile, ak_bk_loader
-from amescap.Ncdf_wrapper import Ncdf
+from amescap.Ncdf_wrapper import Ncdf, set_nc_defaults, parse_nc_chunks
 # ==========
 
 # Attempt to import specific scientic modules that may or may not
@@ -70,6 +71,16 @@ parser.add_argument('-g', '--grid', action='store_true',
                     help="""> Output current grid information to standard output. This will not run the interpolation. """
                     """>  Usage: MarsInterp.py ****.atmos.average.nc -t pstd -l p44 -g \n""")
 
+parser.add_argument('--nc-compress', '--nc_compress', type=int, default=None,
+                    help="""Compress the new variables with zlib, from 1 (fastest) to 9 (smallest file). \n"""
+                         """> Usage: MarsInterp.py *.atmos_average.nc --nc-compress 4 --nc-chunks time=1 \n"""
+                    """\n""")
+
+parser.add_argument('--nc-chunks', '--nc_chunks', nargs='+', default=None,
+                    help="""Chunk sizes of the new variables as dimension=size, dimensions not listed are not split. \n"""
+                         """Use time=1 for fast time-slice reads, e.g. with MarsPlot. \n"""
+                    """\n""")
+
 parser.add_argument('--debug',  action='store_true',
                     help='Debug flag: release the exceptions.')
 
@@ -97,6 +108,9 @@ def main():
     debug        = parser.parse_args().debug
     # Load all of the netcdf files
     file_list    = parser.parse_args().input_file
+    # Compression and chunking of the new variables
+    set_nc_defaults(complevel=parser.parse_args().nc_compress or 0,
+                    chunks=parse_nc_chunks(parser.parse_args().nc_chunks))
     interp_type  = parser.parse_args().type  # e.g. 'pstd'
     custom_level = parser.parse_args().level # e.g. 'p44'
     grid_out     = parser.parse_args().grid
@@ -216,7 +230,10 @@ def main():
         with np.errstate(divide='ignore', invalid='ignore'):
             if interp_type == 'pstd':
                 # Permute by default dimension, e.g lev is first
-                L_3D_P = fms_press_calc(ps, ak, bk, lev_type='full')
+                # Filled by chunks of time steps to limit the memory used by intermediate arrays
+                L_3D_P = np.empty(np.append(len(ak)-1, ps.shape))
+                for it, PRESS in fms_press_calc_chunks(ps, ak, bk, lev_type='full'):
+                    L_3D_P[:, it, ...] = PRESS
 
             elif interp_type == 'zagl':
                 temp = fNcdf.variables['temp'][:]
@@ -258,7 +275,7 @@ def main():
         if do_diurn:
             fnew.copy_Ncaxis_with_content(fNcdf.variables[tod_name])
 
-        # Re-use the indices for each file, this speeds up the calculation
+        # Re-use the indices and weights for each file, this speeds up the calculation
         compute_indices = True
         for ivar in var_list:
             if (fNcdf.variables[ivar].dimensions == ('time', 'pfull', 'lat', 'lon') or
@@ -266,17 +283,16 @@ def main():
                     fNcdf.variables[ivar].dimensions == ('time', 'pfull', 'grid_yt', 'grid_xt')):
                 if compute_indices:
                     prCyan("Computing indices ...")
-                    index = find_n(
-                        L_3D_P, lev_in, reverse_input=need_to_reverse)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        interp_plan = VerticalInterpPlan(L_3D_P, lev_in, type_int=interp_technic,
+                                                         reverse_input=need_to_reverse, masktop=True)
                     compute_indices = False
 
                 prCyan("Interpolating: %s ..." % (ivar))
                 varIN = fNcdf.variables[ivar][:]
                 # This with the loop suppresses "divide by zero" errors
                 with np.errstate(divide='ignore', invalid='ignore'):
-                    varOUT = vinterp(varIN.transpose(permut), L_3D_P,
-                                     lev_in, type_int=interp_technic, reverse_input=need_to_reverse,
-                                     masktop=True, index=index).transpose(permut)
+                    varOUT = interp_plan.apply(varIN.transpose(permut)).transpose(permut)
 
                 long_name_txt = getattr(fNcdf.variables[ivar], 'long_name', '')
                 units_txt = getattr(fNcdf.variables[ivar], 'units', '')
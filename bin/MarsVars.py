@@ -7,11 +7,11 @@ import subprocess # run command
 import sys        # system command
 import warnings   # suppress certain errors when dealing with NaN arrays
 
-from amescap.FV3_utils import fms_press_calc, fms_Z_calc, dvar_dh, cart_to_azimut_TR
+from amescap.FV3_utils import fms_press_calc, fms_press_calc_chunks, fms_Z_calc, fms_PZ_calc, dvar_dh, cart_to_azimut_TR
 from amescap.FV3_utils import mass_stream, zonal_detrend, spherical_div, spherical_curl, frontogenesis
 from amescap.Script_utils import check_file_tape, prYellow, prRed, prCyan, prGreen, prPurple, print_fileContent
 from amescap.Script_utils import FV3_file_type, filter_vars, find_fixedfile, get_longname_units, ak_bk_loader
-from amescap.Ncdf_wrapper import Ncdf
+from amescap.Ncdf_wrapper import Ncdf, set_nc_defaults, parse_nc_chunks, nc_variable_kwargs
 
 # Attempt to import specific scientic modules that may or may not
 # be included in the default Python installation on NAS.
@@ -142,6 +142,16 @@ parser.add_argument('-unit', '--unit', type=str, default=None,
 parser.add_argument('-multiply', '--multiply', type=float,
                     default=None, help=argparse.SUPPRESS)               # To be used jointly with --edit
 
+parser.add_argument('--nc-compress', '--nc_compress', type=int, default=None,
+                    help="""Compress the new variables with zlib, from 1 (fastest) to 9 (smallest file). \n"""
+                         """> Usage: MarsVars.py *.atmos_average.nc -add rho --nc-compress 4 --nc-chunks time=1 \n"""
+                    """\n""")
+
+parser.add_argument('--nc-chunks', '--nc_chunks', nargs='+', default=None,
+                    help="""Chunk sizes of the new variables as dimension=size, dimensions not listed are not split. \n"""
+                         """Use time=1 for fast time-slice reads, e.g. with MarsPlot. \n"""
+                    """\n""")
+
 parser.add_argument('--debug',  action='store_true',
                     help='Debug flag: release the exception')
 
@@ -230,11 +240,40 @@ def compute_p_3D(ps, ak, bk, shape_out):
     The shape_out argument ensures that when time = 1 (one timestep), results are returned
     as (1, lev, lat, lon) not (lev, lat, lon)
     """
-    p_3D = fms_press_calc(ps, ak, bk, lev_type='full')
+    # Filled by chunks of time steps to limit the memory used by intermediate arrays
+    p_3D = np.empty(np.append(len(ak)-1, ps.shape))
+    for it, PRESS in fms_press_calc_chunks(ps, ak, bk, lev_type='full'):
+        p_3D[:, it, ...] = PRESS
     # p_3D [lev, tim, lat, lon] ->[tim, lev, lat, lon]
     p_3D = p_3D.transpose(lev_T)
     return p_3D.reshape(shape_out)
 
+# =====================================================================
+def compute_msf(vcomp_Ncvar, lat, lev, interp_type, f_type, chunk_size=10):
+    """
+    Returns the mass stream function in [1.e8 x kg/s].
+    *** NOTE***
+    vcomp is read from the file 'chunk_size' time steps at the time, and the columns of each
+    chunk are integrated by blocks of the same size in mass_stream(), which limits the memory
+    used by the intermediate arrays on long daily files.
+    """
+    shape_out = vcomp_Ncvar.shape
+    OUT = np.ma.zeros(shape_out)
+    for t0 in range(0, shape_out[0], chunk_size):
+        t1 = min(t0+chunk_size, shape_out[0])
+        vcomp = vcomp_Ncvar[t0:t1, ...]
+        if f_type == 'diurn':
+            # [time, tod, lev, lat, lon] -> [lev, lat, time, tod, lon] -> [time, tod, lev, lat, lon]
+            # (0 1 2 3 4) -> (2 3 0 1 4) -> (2 3 0 1 4)
+            OUT[t0:t1, ...] = mass_stream(vcomp.transpose(
+                [2, 3, 0, 1, 4]), lat, lev, type=interp_type, chunk_size=chunk_size).transpose([2, 3, 0, 1, 4])
+        else:
+            # [time, lev, lat, lon] -> [lev, lat, lon, time]  ->  [time, lev, lat, lon]
+            # (0 1 2 3) -> (1 2 3 0) -> (3 0 1 2)
+            OUT[t0:t1, ...] = mass_stream(vcomp.transpose(
+                [1, 2, 3, 0]), lat, lev, type=interp_type, chunk_size=chunk_size).transpose([3, 0, 1, 2])
+    return OUT
+
 # =====================================================================
 def compute_rho(p_3D, temp):
     """
@@ -342,14 +381,38 @@ def compute_theta(p_3D, ps, temp, f_type):
 def compute_w(rho, omega):
     return -omega/(rho*g)
 
+# =====================================================================
+# Altitude at the layer midpoints and interfaces, shared by 'zfull', 'DZ', 'N', 'Ri' and 'scorer_wl'.
+# Keyed on the values of the inputs, and cleared for each new file to release the memory.
+Z_cache = dict()
+
+def compute_Z_levels(ps, ak, bk, temp):
+    """
+    Returns the altitude of the layer midpoints and interfaces AGL in [m] (vertical axis first)
+    from a single pass of the hydrostatic solver. The results are reused as long as ps, ak, bk
+    and temp hold the same values as for the cached solution.
+    """
+    inputs = (ps, ak, bk, temp)
+    if not ('inputs' in Z_cache and all(np.shape(a) == np.shape(b) and
+                                        np.array_equal(np.ma.getdata(a), np.ma.getdata(b))
+                                        for a, b in zip(inputs, Z_cache['inputs']))):
+        Z_cache.clear()
+        # temp: [tim, lev, lat, lon] ->[lev, time,  lat,  lon]
+        temp_T = temp.transpose(lev_T)
+        # Match the columns of temp to the flattened 'ps' as in fms_Z_calc()
+        temp_T = np.reshape(temp_T, np.append(temp_T.shape[0], ps.shape))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            _, _, Z_cache['zfull'], Z_cache['zhalf'] = fms_PZ_calc(ps, ak, bk, temp_T, topo=0.)
+        Z_cache['inputs'] = inputs
+    return Z_cache['zfull'], Z_cache['zhalf']
+
 # =====================================================================
 def compute_zfull(ps, ak, bk, temp):
     """
     Returns the altitude of the layer midpoints AGL in [m].
     """
     dim_out = temp.shape
-    zfull = fms_Z_calc(ps, ak, bk, temp.transpose(
-        lev_T), topo=0., lev_type='full')  # (lev, time, tod, lat, lon)
+    zfull = compute_Z_levels(ps, ak, bk, temp)[0]  # (lev, time, tod, lat, lon)
     # p_3D [lev, tim, lat, lon] -> [tim, lev, lat, lon]
     # temp [tim, tod, lev, lat, lon, lev] -> [lev, time, tod,lat, lon]
     zfull = zfull.transpose(lev_T_out)
@@ -362,8 +425,7 @@ def compute_zhalf(ps, ak, bk, temp):
     """
     dim_out = temp.shape
     # temp: [tim, lev, lat, lon, lev] ->[lev, time,  lat,  lon]
-    zhalf = fms_Z_calc(ps, ak, bk, temp.transpose(
-        lev_T), topo=0., lev_type='half')
+    zhalf = compute_Z_levels(ps, ak, bk, temp)[1]
     # p_3D [lev+1, tim, lat, lon] ->[tim, lev+1, lat, lon]
     zhalf = zhalf.transpose(lev_T_out)
     return zhalf
@@ -467,8 +529,7 @@ def compute_DZ_3D(ps, ak, bk, temp, shape_out):
     """
     Returns the layer thickness in [Pa].
     """
-    z_half3D = fms_Z_calc(ps, ak, bk, temp.transpose(
-        lev_T), topo=0., lev_type='half')
+    z_half3D = compute_Z_levels(ps, ak, bk, temp)[1]
     # Note the reversed order: Z decreases with increasing levels
     DZ_3D = z_half3D[0:-1, ...]-z_half3D[1:, ..., ]
     # DZ_3D [lev, tim, lat, lon] ->[tim, lev, lat, lon]
@@ -529,6 +590,9 @@ filepath = os.getcwd()
 def main():
     # Load all the .nc files
     file_list       = parser.parse_args().input_file
+    # Compression and chunking of the new variables
+    set_nc_defaults(complevel=parser.parse_args().nc_compress or 0,
+                    chunks=parse_nc_chunks(parser.parse_args().nc_chunks))
     add_list        = parser.parse_args().add
     zdiff_list      = parser.parse_args().zdiff
     zdetrend_list   = parser.parse_args().zonal_detrend
@@ -556,6 +620,8 @@ def main():
     for ifile in file_list:
         # First check if file is on the disk (Lou only)
         check_file_tape(ifile)
+        # Altitude levels are computed once per file
+        Z_cache.clear()
 
         # =================================================================
         # ========================= Remove ================================
@@ -801,18 +867,8 @@ def main():
                         lev = fileNC.variables[interp_type][:]
 
                     if ivar == 'msf':
-                        vcomp = fileNC.variables['vcomp'][:]
                         lat = fileNC.variables['lat'][:]
-                        if f_type == 'diurn':
-                            # [lev, lat, time, tod, lon] -> [time, tod, lev, lat, lon]
-                            # (0 1 2 3 4) -> (2 3 0 1 4) -> (2 3 0 1 4)
-                            OUT = mass_stream(vcomp.transpose(
-                                [2, 3, 0, 1, 4]), lat, lev, type=interp_type).transpose([2, 3, 0, 1, 4])
-                        else:
-                            OUT = mass_stream(vcomp.transpose(
-                                [1, 2, 3, 0]), lat, lev, type=interp_type).transpose([3, 0, 1, 2])
-                            # [time, lev, lat, lon] -> [lev, lat, lon, time]  ->  [time, lev, lat, lon]
-                            # (0 1 2 3) -> (1 2 3 0) -> (3 0 1 2)
+                        OUT = compute_msf(fileNC.variables['vcomp'], lat, lev, interp_type, f_type)
 
                     if ivar == 'ep':
                         OUT = compute_Ep(temp)
@@ -858,7 +914,7 @@ def main():
                             OUT[OUT < -1.e30] = np.NaN
 
                     # Log the variable
-                    var_Ncdf = fileNC.createVariable(ivar, 'f4', dim_out)
+                    var_Ncdf = fileNC.createVariable(ivar, 'f4', dim_out, **nc_variable_kwargs(fileNC, dim_out))
                     var_Ncdf.long_name = VAR[ivar][0]
                     var_Ncdf.units = VAR[ivar][1]
                     var_Ncdf[:] = OUT
@@ -942,7 +998,7 @@ def main():
 
                     # Log the variable
                     var_Ncdf = fileNC.createVariable(
-                        'd_dz_'+idiff, 'f4', dim_out)
+                        'd_dz_'+idiff, 'f4', dim_out, **nc_variable_kwargs(fileNC, dim_out))
                     var_Ncdf.long_name = newLong_name
                     var_Ncdf.units = newUnits
                     var_Ncdf[:] = darr_dz
@@ -984,7 +1040,7 @@ def main():
 
                     # Log the variable
                     var_Ncdf = fileNC.createVariable(
-                        izdetrend+'_p', 'f4', dim_out)
+                        izdetrend+'_p', 'f4', dim_out, **nc_variable_kwargs(fileNC, dim_out))
                     var_Ncdf.long_name = newLong_name
                     var_Ncdf.units = units_txt
                     #var_Ncdf.units = newUnits # alex's version
@@ -1025,7 +1081,7 @@ def main():
 
                     # Log the variable
                     var_Ncdf = fileNC.createVariable(
-                        idp_to_dz+'_dp_to_dz', 'f4', dim_out)
+                        idp_to_dz+'_dp_to_dz', 'f4', dim_out, **nc_variable_kwargs(fileNC, dim_out))
                     var_Ncdf.long_name = newLong_name
                     var_Ncdf.units = newUnits
                     var_Ncdf[:] = var*fileNC.variables['DP'][:] / \
@@ -1063,7 +1119,7 @@ def main():
 
                     # Log the variable
                     var_Ncdf = fileNC.createVariable(
-                        idz_to_dp+'_dz_to_dp', 'f4', dim_out)
+                        idz_to_dp+'_dz_to_dp', 'f4', dim_out, **nc_variable_kwargs(fileNC, dim_out))
                     var_Ncdf.long_name = newLong_name
                     var_Ncdf.units = newUnits
                     var_Ncdf[:] = var*fileNC.variables['DZ'][:] / \
@@ -1139,7 +1195,7 @@ def main():
 
                     # Log the variable
                     var_Ncdf = fileNC.createVariable(
-                        icol+'_col', 'f4', dim_out)
+                        icol+'_col', 'f4', dim_out, **nc_variable_kwargs(fileNC, dim_out))
                     var_Ncdf.long_name = newLong_name
                     var_Ncdf.units = newUnits
                     var_Ncdf[:] = out